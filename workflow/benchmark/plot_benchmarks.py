@@ -0,0 +1,64 @@
+"""
+Snakemake pipeline benchmark.
+
+Scaling plots of the benchmark results written by run_benchmarks.py: wall time, CPU time and peak RSS of every stage
+against the number of genes, on log-log axes (the slope of a line is the scaling exponent of the stage). Repeated runs are
+summarised by their median. Skipped and failed runs are left out.
+
+Requires matplotlib, which is not part of the pipeline environment.
+
+Command:
+$ python3 plot_benchmarks.py benchmark_results.json benchmark_scaling.png
+
+"""
+
+import json
+import argparse
+from collections import defaultdict
+import numpy as np
+import matplotlib
+matplotlib.use("Agg") # no display needed
+import matplotlib.pyplot as plt
+
+METRICS = [("wall_s", "Wall time (s)"), ("cpu_s", "CPU time (s)"), ("peak_rss_mb", "Peak RSS (MB)")]
+
+
+# Median of each metric per (mode, stage) and number of genes, as {(mode, stage): {metric: (genes, values)}}
+def summarise(results):
+    runs = defaultdict(lambda: defaultdict(list))
+    for result in results:
+        if "skipped" in result or result.get("returncode") != 0:
+            continue
+        runs[(result["mode"], result["stage"])][result["genes"]].append(result)
+    summary = {}
+    for key, sizes in runs.items():
+        genes = sorted(sizes)
+        summary[key] = {metric: (genes, [float(np.median([run[metric] for run in sizes[size]])) for size in genes])
+                        for metric, _ in METRICS}
+    return summary
+
+def plot(results_file, output_file):
+    with open(results_file) as file:
+        report = json.load(file)
+    summary = summarise(report["results"])
+    figure, axes = plt.subplots(1, len(METRICS), figsize=(6 * len(METRICS), 5))
+    for axis, (metric, label) in zip(axes, METRICS):
+        for (mode, stage), values in summary.items():
+            genes, medians = values[metric]
+            axis.plot(genes, medians, marker="o", linestyle="--" if mode == "end_to_end" else "-", label=stage)
+        axis.set_xscale("log")
+        axis.set_yscale("log")
+        axis.set_xlabel("Number of genes")
+        axis.set_ylabel(label)
+        axis.grid(True, which="both", alpha=0.3)
+    axes[-1].legend(fontsize="small", loc="center left", bbox_to_anchor=(1.02, 0.5))
+    metadata = report["metadata"]
+    figure.suptitle(f"ProbeST scaling, {metadata['processes']} processes on {metadata['cpu_count']} CPUs ({metadata['date']})")
+    figure.savefig(output_file, dpi=150, bbox_inches="tight")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Plot the scaling of the ProbeST stages from the benchmark results.")
+    parser.add_argument("results_file", nargs="?", default="benchmark_results.json", help="JSON results of run_benchmarks.py.")
+    parser.add_argument("output_file", nargs="?", default="benchmark_scaling.png", help="Output image.")
+    args = parser.parse_args()
+    plot(args.results_file, args.output_file)
@@ -0,0 +1,272 @@
+"""
+Snakemake pipeline benchmark.
+
+Scaling benchmark of the ProbeST stages on synthetic transcriptomes (synthetic_transcriptome.py) of increasing size.
+
+For every size, the stages are run one after the other as separate processes, each on the outputs of the previous ones, so
+that every stage is timed in isolation:
+    - primer3_input_design, primer3 (primer3_core), generate_probe_pairs
+    - makeblastdb, blastn and parse_blast_output (BLAST off-target path), pack_reference and kmer_offtarget (k-mer
+      off-target path, on the packed reference)
+    - select_probe_pairs
+    - design_in_memory: the same design from the CDS and reference files in a single process (probest.py)
+    - design_pipelined: the same, with the stages running concurrently on batches of 64 sequences
+    - the cross-hybridisation scripts: extract_probes_from_part1, prepare_queries, makeblastdb and blastn against the
+      synthetic contaminants, filter_for_hits, generate_output_with_hits
+With snakemake installed, both Snakefiles are also run end-to-end on the same inputs, with --processes cores.
+
+Each run records the wall time, the CPU time (user + system, including the child processes of the stage) and the peak
+resident set size of the stage, taken from the resource usage of the stage process (os.wait4). Stages whose tool is not
+installed are recorded as skipped: without primer3_core the candidates are generated with the native engine, and without
+blastn the selection uses the k-mer off-target hits and the cross-hybridisation check runs on an empty BLAST output.
+Everything runs offline, the BLAST databases are built from the synthetic files.
+
+Output:
+- a JSON file with the run metadata (host, CPU count, tools found, settings) and one result per stage, size and repeat
+- a table of the results on stdout
+The scaling plots are drawn from the JSON file with plot_benchmarks.py.
+
+Command:
+$ python3 run_benchmarks.py --sizes 100 1000 10000 100000 --output benchmark_results.json
+
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import subprocess
+import yaml
+
+from synthetic_transcriptome import generate
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+WORKFLOW_DIR = os.path.dirname(BENCHMARK_DIR)
+SCRIPTS_DIR = os.path.join(WORKFLOW_DIR, "scripts")
+CROSS_HYB_DIR = os.path.join(WORKFLOW_DIR, "cross_hybridisation", "workflow")
+CROSS_HYB_SCRIPTS_DIR = os.path.join(CROSS_HYB_DIR, "scripts")
+TOOLS = ["primer3_core", "makeblastdb", "blastn", "snakemake"]
+
+# BLAST settings of the Snakefile rules
+BLAST_REF_ARGS = ('-outfmt "6 qseqid sseqid qstart qend sstart send pident mismatch" -evalue 30000 -word_size 7 '
+                  '-gapopen 3 -penalty -1 -task blastn-short')
+BLAST_CROSS_ARGS = "-outfmt 6 -evalue 1e-10 -word_size 15 -reward 1 -penalty -1 -task blastn-short"
+
+
+def script(name):
+    return f"{sys.executable} {os.path.join(SCRIPTS_DIR, name)}"
+
+def cross_hyb_script(name):
+    return f"{sys.executable} {os.path.join(CROSS_HYB_SCRIPTS_DIR, name)}"
+
+# Stages in run order, as (name, working subdirectory, required tool, input files, shell command).
+# The command is formatted with the run settings: engine, offtarget_engine, candidates, trimmed, processes, blast_output.
+STAGES = [
+    ("primer3_input_design", ".", None, ["CDS_gene_targets.fa"],
+     script("primer3_input_design.py") + " CDS_gene_targets.fa primer3_input_snakemake.txt"),
+    ("primer3", ".", "primer3_core", ["primer3_input_snakemake.txt"],
+     "primer3_core < primer3_input_snakemake.txt > primer3_output.txt"),
+    ("generate_probe_pairs", ".", None, ["{candidates}"],
+     script("generate_probe_pairs.py") + " --engine {engine} {candidates} probes_hybparts_snakemake.fasta"),
+    ("makeblastdb", ".", "makeblastdb", ["CDS_all.fa"],
+     "mkdir -p db && makeblastdb -in CDS_all.fa -dbtype nucl -parse_seqids -out db/ref_genome-db"),
+    ("blastn", ".", "blastn", ["probes_hybparts_snakemake.fasta", "db/ref_genome-db.nsq"],
+     "blastn -db db/ref_genome-db -query probes_hybparts_snakemake.fasta -num_threads {processes} " + BLAST_REF_ARGS
+     + " -out blast_output.txt"),
+    ("parse_blast_output", ".", None, ["blast_output.txt"],
+     script("parse_blast_output.py") + " blast_output.txt trimmed_probes_hybparts_off_targets.txt"),
+    ("pack_reference", ".", None, ["CDS_all.fa"], script("sequence_store.py") + " CDS_all.fa CDS_all.pack"),
+    ("kmer_offtarget", ".", None, ["probes_hybparts_snakemake.fasta", "CDS_all.pack"],
+     script("kmer_offtarget.py") + " probes_hybparts_snakemake.fasta CDS_all.pack kmer_probes_hybparts_off_targets.txt"),
+    ("select_probe_pairs", ".", None, ["{candidates}", "{trimmed}"],
+     script("select_probe_pairs.py") + " {candidates} {trimmed} probe_set.csv selected_probes.txt probe_quantifications.txt "
+     "process_log.txt --table selected_probes.parquet --engine {engine} --processes {processes}"),
+    ("design_in_memory", ".", None, ["CDS_gene_targets.fa", "CDS_all.fa"],
+     "mkdir -p in_memory && " + script("probest.py") + " CDS_gene_targets.fa CDS_all.fa --output-dir in_memory --engine {engine} "
+     "--offtarget-engine {offtarget_engine} --processes {processes}"),
+    ("design_pipelined", ".", None, ["CDS_gene_targets.fa", "CDS_all.fa"],
+     "mkdir -p pipelined && " + script("probest.py") + " CDS_gene_targets.fa CDS_all.fa --output-dir pipelined --engine {engine} "
+     "--offtarget-engine {offtarget_engine} --processes {processes} --batch-size 64"),
+    ("extract_probes_from_part1", "cross_hyb", None, ["selected_probes.parquet"],
+     cross_hyb_script("extract_probes_from_part1.py") + " selected_probes.parquet probes.fasta"),
+    ("prepare_queries", "cross_hyb", None, ["selected_probes.parquet"],
+     cross_hyb_script("prepare_queries.py") + " selected_probes.parquet cleaned_sequences_from_prefix.fasta"),
+    ("makeblastdb_cross_hybridisation", "cross_hyb", "makeblastdb", ["../contaminants.fa"],
+     "mkdir -p db && makeblastdb -in ../contaminants.fa -dbtype nucl -out db/contaminants"),
+    ("blastn_cross_hybridisation", "cross_hyb", "blastn", ["cleaned_sequences_from_prefix.fasta", "db/contaminants.nsq"],
+     "mkdir -p blast_cross_results && blastn -db db/contaminants -query cleaned_sequences_from_prefix.fasta "
+     "-num_threads {processes} " + BLAST_CROSS_ARGS + " -out blast_cross_results/results_contaminants_nt.txt"),
+    ("filter_for_hits", "cross_hyb", None, ["{blast_output}", "probes.fasta"],
+     cross_hyb_script("filter_for_hits.py") + " --blast_outputs {blast_output} --input_fasta probes.fasta "
+     "--output_fasta filtered_probes.fasta --hit_stats cross_hybridization_hit_stats.tsv --processes {processes}"),
+    ("generate_output_with_hits", "cross_hyb", None, ["filtered_probes.fasta"],
+     cross_hyb_script("generate_output_with_hits.py") + " --input_fasta filtered_probes.fasta --formats csv parquet"),
+]
+
+
+# Run a shell command in a directory and measure it: wall time (s), CPU time (s, user + system of the shell and all the
+# processes it waited for) and peak RSS (MB, largest of these processes). The output goes to a log file.
+def measure(command, cwd, log_path):
+    with open(log_path, "w") as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, shell=True, cwd=cwd, stdout=log, stderr=subprocess.STDOUT, executable="/bin/bash")
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status) #already reaped by os.wait4
+    peak_rss = usage.ru_maxrss / (1 << 20) if sys.platform == "darwin" else usage.ru_maxrss / 1024 #bytes on macOS, KB on Linux
+    return {"returncode": process.returncode, "wall_s": round(wall, 4), "cpu_s": round(usage.ru_utime + usage.ru_stime, 4),
+            "peak_rss_mb": round(peak_rss, 2)}
+
+# Part 1 and cross-hybridisation config.yaml of a run, from the templates of the repository
+def write_configs(run_dir, engine, offtarget_engine, processes):
+    with open(os.path.join(WORKFLOW_DIR, "config", "config.yaml")) as file:
+        config = yaml.safe_load(file)
+    config.update({"engine": engine, "offtarget_engine": offtarget_engine, "blast_threads": 1, "blast_shards": processes})
+    with open(os.path.join(run_dir, "config.yaml"), "w") as file:
+        yaml.safe_dump(config, file, sort_keys=False)
+
+    with open(os.path.join(CROSS_HYB_DIR, "config", "config.yaml")) as file:
+        cross_hyb_config = yaml.safe_load(file)
+    cross_hyb_config.update({"blast_db_dir": "db", "blast_dbs": ["contaminants"], "blast_threads": 1,
+                             "output_formats": ["csv", "parquet"]})
+    with open(os.path.join(run_dir, "cross_hyb", "config.yaml"), "w") as file:
+        yaml.safe_dump(cross_hyb_config, file, sort_keys=False)
+
+# Run every stage in isolation on one synthetic data set. Returns the results, one dict per stage.
+def run_stages(run_dir, genes, repeat, tools, processes, stages):
+    engine = "primer3" if tools["primer3_core"] else "native"
+    settings = {
+        "engine": engine,
+        "candidates": "primer3_output.txt" if engine == "primer3" else "CDS_gene_targets.fa",
+        "offtarget_engine": "blast" if tools["blastn"] else "kmer",
+        "trimmed": "trimmed_probes_hybparts_off_targets.txt" if tools["blastn"] else "kmer_probes_hybparts_off_targets.txt",
+        "blast_output": "blast_cross_results/results_contaminants_nt.txt",
+        "processes": processes,
+    }
+    results = []
+    for name, subdir, tool, inputs, command in STAGES:
+        if stages and name not in stages:
+            continue
+        cwd = os.path.join(run_dir, subdir)
+        result = {"stage": name, "mode": "isolated", "genes": genes, "repeat": repeat, "processes": processes}
+        if name == "generate_probe_pairs":
+            result["engine"] = engine
+        if name == "filter_for_hits" and not tools["blastn"]:
+            # no cross-hybridisation BLAST: filter on an empty BLAST output
+            os.makedirs(os.path.join(cwd, "blast_cross_results"), exist_ok=True)
+            open(os.path.join(cwd, settings["blast_output"]), "w").close()
+            result["note"] = "empty BLAST output, blastn not found"
+        missing = [path for path in (input_file.format(**settings) for input_file in inputs) if not os.path.exists(os.path.join(cwd, path))]
+        if tool is not None and not tools[tool]:
+            result.update({"skipped": f"{tool} not found"})
+        elif missing:
+            result.update({"skipped": "missing input: " + ", ".join(missing)})
+        else:
+            result.update(measure(command.format(**settings), cwd, os.path.join(run_dir, "logs", f"{name}.log")))
+            if name == "select_probe_pairs" and result["returncode"] == 0:
+                shutil.copy(os.path.join(cwd, "selected_probes.parquet"), os.path.join(run_dir, "cross_hyb"))
+        results.append(result)
+    return results
+
+# Run both Snakefiles end-to-end on one synthetic data set, with the scripts copied next to them as for a real run
+def run_end_to_end(run_dir, genes, repeat, tools, processes):
+    results = []
+    for name, snakefile, subdir, files in (
+        ("snakemake_part1", os.path.join(WORKFLOW_DIR, "Snakefile"), "e2e",
+         ["CDS_gene_targets.fa", "CDS_all.fa", "config.yaml"]),
+        ("snakemake_cross_hybridisation", os.path.join(CROSS_HYB_DIR, "Snakefile_cross-hyb"), os.path.join("e2e", "cross_hyb"),
+         [os.path.join("cross_hyb", "config.yaml")]),
+    ):
+        result = {"stage": name, "mode": "end_to_end", "genes": genes, "repeat": repeat, "processes": processes}
+        results.append(result)
+        if not tools["snakemake"]:
+            result["skipped"] = "snakemake not found"
+            continue
+        if not tools["blastn"] or not tools["makeblastdb"]:
+            result["skipped"] = "blastn not found"
+            continue
+        cwd = os.path.join(run_dir, subdir)
+        os.makedirs(cwd, exist_ok=True)
+        scripts_dir = SCRIPTS_DIR if name == "snakemake_part1" else CROSS_HYB_SCRIPTS_DIR
+        for file_name in os.listdir(scripts_dir):
+            shutil.copy(os.path.join(scripts_dir, file_name), cwd)
+        if name == "snakemake_cross_hybridisation":
+            shutil.copy(os.path.join(SCRIPTS_DIR, "run_report.py"), cwd) #the run report script is shared with part 1
+        for path in files:
+            shutil.copy(os.path.join(run_dir, path), cwd)
+        if name == "snakemake_cross_hybridisation":
+            missing = [path for path in (os.path.join(run_dir, "cross_hyb", "db"), os.path.join(run_dir, "e2e", "selected_probes.parquet"))
+                       if not os.path.exists(path)]
+            if missing:
+                result["skipped"] = "missing input: " + ", ".join(missing)
+                continue
+            shutil.copytree(os.path.join(run_dir, "cross_hyb", "db"), os.path.join(cwd, "db"), dirs_exist_ok=True)
+            shutil.copy(os.path.join(run_dir, "e2e", "selected_probes.parquet"), cwd)
+        result.update(measure(f"snakemake -s {snakefile} -c {processes}", cwd, os.path.join(run_dir, "logs", f"{name}.log")))
+    return results
+
+def print_table(results):
+    print(f"{'genes':>8} {'stage':<32} {'mode':<10} {'wall (s)':>10} {'CPU (s)':>10} {'peak RSS (MB)':>14}")
+    for result in results:
+        if "skipped" in result:
+            print(f"{result['genes']:>8} {result['stage']:<32} {result['mode']:<10} skipped: {result['skipped']}")
+        else:
+            failed = "" if result["returncode"] == 0 else f"  failed ({result['returncode']})"
+            print(f"{result['genes']:>8} {result['stage']:<32} {result['mode']:<10} {result['wall_s']:>10.2f} "
+                  f"{result['cpu_s']:>10.2f} {result['peak_rss_mb']:>14.1f}{failed}")
+
+def main(args):
+    tools = {tool: shutil.which(tool) is not None for tool in TOOLS}
+    report = {
+        "metadata": {
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "host": platform.node(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpu_count": os.cpu_count(),
+            "tools": tools,
+            "processes": args.processes,
+            "seed": args.seed,
+        },
+        "results": [],
+    }
+    for genes in args.sizes:
+        for repeat in range(args.repeats):
+            run_dir = os.path.join(args.workdir, f"genes_{genes}")
+            if os.path.exists(run_dir):
+                shutil.rmtree(run_dir)
+            os.makedirs(os.path.join(run_dir, "cross_hyb"))
+            os.makedirs(os.path.join(run_dir, "logs"))
+            counts = generate(run_dir, genes, seed=args.seed)
+            write_configs(run_dir, "primer3" if tools["primer3_core"] else "native", "blast" if tools["blastn"] else "kmer", args.processes)
+
+            results = run_stages(run_dir, genes, repeat, tools, args.processes, args.stages)
+            if args.end_to_end:
+                results += run_end_to_end(run_dir, genes, repeat, tools, args.processes)
+            for result in results:
+                result["target_transcripts"] = counts["targets"]
+                result["reference_sequences"] = counts["reference"]
+            print_table(results)
+            report["results"] += results
+
+            # write after every size, so that the results of the small sizes are kept if a large one is interrupted
+            with open(args.output, "w") as file:
+                json.dump(report, file, indent=2)
+            if not args.keep:
+                shutil.rmtree(run_dir)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Scaling benchmark of the ProbeST stages on synthetic transcriptomes.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100, 1000, 10000], help="Numbers of target genes.")
+    parser.add_argument("--repeats", type=int, default=1, help="Runs of every size.")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="Processes / threads given to the parallel stages.")
+    parser.add_argument("--stages", nargs="+", choices=[stage[0] for stage in STAGES], help="Only run these stages (the others must not be needed as inputs).")
+    parser.add_argument("--end-to-end", action="store_true", help="Also run both Snakefiles end-to-end (requires snakemake and BLAST).")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed of the synthetic data.")
+    parser.add_argument("--workdir", default="benchmark_runs", help="Directory of the synthetic data and stage outputs.")
+    parser.add_argument("--keep", action="store_true", help="Keep the synthetic data and stage outputs of every size.")
+    parser.add_argument("--output", default="benchmark_results.json", help="JSON results file.")
+    main(parser.parse_args())
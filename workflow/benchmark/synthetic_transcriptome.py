@@ -0,0 +1,137 @@
+"""
+Snakemake pipeline benchmark.
+
+Generator of synthetic transcriptomes for the scaling benchmark (run_benchmarks.py), so that the pipeline can be timed on
+any number of genes without downloading a genome.
+
+Output, in the output directory:
+- CDS_gene_targets.fa: the CDS sequences of interest, with headers in the format required by the pipeline
+        >gene_ID:SYN000001.1 gene_name:syn1 transcript_ID:SYN000001.1_1
+  A fraction of the genes has a second isoform (transcript_ID ..._2) lacking an internal segment of the first one.
+- CDS_all.fa: the reference, with every target transcript, paralogs of a fraction of the targets (copies with a few
+  substitutions, giving off-target hits with few mismatches) and unrelated decoy genes. The transcript IDs are
+  <gene>.<n>, so that the gene ID of a hit is the part before the ".", as for the GenBank protein IDs.
+- contaminants.fa: unrelated sequences for the cross-hybridisation BLAST database, a fraction of them carrying a fragment
+  of a target, so that some selected probe pairs are removed by the cross-hybridisation check.
+
+CDS lengths follow a log-normal distribution (median length_median, clipped to [300, 6000] nt) and the GC content of each
+gene is drawn around gc_mean, so that part of the windows fails the GC constraints as in real genomes. The output only
+depends on the arguments and the seed.
+
+Command:
+$ python3 synthetic_transcriptome.py --genes 1000 --output-dir bench/genes_1000
+
+"""
+
+import os
+import argparse
+import numpy as np
+
+BASES = np.frombuffer(b"ACGT", dtype=np.uint8)
+STOP_CODONS = {"TAA", "TAG", "TGA"}
+MIN_LENGTH = 300
+MAX_LENGTH = 6000
+LINE_WIDTH = 80
+
+
+# Random nucleotide string of a given length and GC fraction
+def random_sequence(rng, length, gc):
+    weights = np.array([(1 - gc) / 2, gc / 2, gc / 2, (1 - gc) / 2])
+    return BASES[rng.choice(4, size=length, p=weights)].tobytes().decode("ascii")
+
+# Random CDS: start codon, sense codons without stop and a stop codon
+def random_cds(rng, length, gc):
+    codons = []
+    while len(codons) < length // 3 - 2:
+        sequence = random_sequence(rng, 3 * (length // 3), gc)
+        codons += [sequence[i:i + 3] for i in range(0, len(sequence), 3) if sequence[i:i + 3] not in STOP_CODONS]
+    return "ATG" + "".join(codons[:length // 3 - 2]) + "TAA"
+
+# Copy of a sequence with a fraction of random substitutions
+def mutate(rng, sequence, rate):
+    bases = bytearray(sequence.encode("ascii"))
+    for position in np.flatnonzero(rng.random(len(bases)) < rate):
+        bases[position] = BASES[(BASES.tolist().index(bases[position]) + rng.integers(1, 4)) % 4]
+    return bases.decode("ascii")
+
+def cds_lengths(rng, n, length_median):
+    lengths = rng.lognormal(np.log(length_median), 0.5, size=n).astype(int)
+    return np.clip(lengths, MIN_LENGTH, MAX_LENGTH) // 3 * 3
+
+def write_record(file, header, sequence):
+    file.write(f">{header}\n")
+    for i in range(0, len(sequence), LINE_WIDTH):
+        file.write(sequence[i:i + LINE_WIDTH] + "\n")
+
+# Write CDS_gene_targets.fa, CDS_all.fa and contaminants.fa to output_dir. Returns the number of records of each file.
+def generate(output_dir, genes, seed=0, length_median=1000, gc_mean=0.52, isoform_fraction=0.1, paralog_fraction=0.05,
+             paralog_divergence=0.02, decoys_per_gene=1.0, contaminants_per_gene=0.2, contaminated_fraction=0.01):
+    rng = np.random.default_rng(seed)
+    os.makedirs(output_dir, exist_ok=True)
+    counts = {"targets": 0, "reference": 0, "contaminants": 0}
+    targets = []
+    with open(os.path.join(output_dir, "CDS_gene_targets.fa"), "w", buffering=1 << 20) as target_file, \
+         open(os.path.join(output_dir, "CDS_all.fa"), "w", buffering=1 << 20) as reference_file:
+        gcs = np.clip(rng.normal(gc_mean, 0.06, size=genes), 0.3, 0.75)
+        for gene, (length, gc) in enumerate(zip(cds_lengths(rng, genes, length_median), gcs)):
+            gene_id = f"SYN{gene + 1:06d}"
+            sequence = random_cds(rng, length, gc)
+            isoforms = [sequence]
+            if rng.random() < isoform_fraction:
+                # second isoform without an internal, codon aligned segment
+                start = 3 * rng.integers(1, length // 9)
+                end = start + 3 * rng.integers(length // 18, length // 9)
+                isoforms.append(sequence[:start] + sequence[end:])
+            for isoform, isoform_sequence in enumerate(isoforms, 1):
+                write_record(target_file, f"gene_ID:{gene_id}.{isoform} gene_name:syn{gene + 1} transcript_ID:{gene_id}.{isoform}_{isoform}", isoform_sequence)
+                write_record(reference_file, f"{gene_id}.{isoform}", isoform_sequence)
+                counts["targets"] += 1
+                counts["reference"] += 1
+            targets.append(sequence)
+
+        # paralogs and decoys, numbered after the targets
+        next_gene = genes
+        for sequence in targets:
+            if rng.random() < paralog_fraction:
+                next_gene += 1
+                write_record(reference_file, f"SYN{next_gene:06d}.1", mutate(rng, sequence, paralog_divergence))
+                counts["reference"] += 1
+        decoys = int(round(decoys_per_gene * genes))
+        decoy_gcs = np.clip(rng.normal(gc_mean, 0.06, size=decoys), 0.3, 0.75)
+        for length, gc in zip(cds_lengths(rng, decoys, length_median), decoy_gcs):
+            next_gene += 1
+            write_record(reference_file, f"SYN{next_gene:06d}.1", random_cds(rng, length, gc))
+            counts["reference"] += 1
+
+    with open(os.path.join(output_dir, "contaminants.fa"), "w", buffering=1 << 20) as contaminant_file:
+        contaminants = max(1, int(round(contaminants_per_gene * genes)))
+        for contaminant, length in enumerate(cds_lengths(rng, contaminants, 2 * length_median)):
+            sequence = random_sequence(rng, length, gc_mean)
+            if rng.random() < contaminated_fraction * genes / contaminants:
+                # fragment of a target, long enough to carry a full probe pair
+                target = targets[rng.integers(len(targets))]
+                start = rng.integers(0, len(target) - 200)
+                position = rng.integers(0, length - 200)
+                sequence = sequence[:position] + target[start:start + 200] + sequence[position + 200:]
+            write_record(contaminant_file, f"CONT{contaminant + 1:06d}", sequence)
+            counts["contaminants"] += 1
+    return counts
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic CDS set, reference and contaminant set for the benchmark.")
+    parser.add_argument("--genes", type=int, required=True, help="Number of target genes.")
+    parser.add_argument("--output-dir", required=True, help="Output directory.")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+    parser.add_argument("--length-median", type=int, default=1000, help="Median CDS length (nt).")
+    parser.add_argument("--gc-mean", type=float, default=0.52, help="Mean GC fraction of the genes.")
+    parser.add_argument("--isoform-fraction", type=float, default=0.1, help="Fraction of the genes with a second isoform.")
+    parser.add_argument("--paralog-fraction", type=float, default=0.05, help="Fraction of the genes with a paralog in the reference.")
+    parser.add_argument("--paralog-divergence", type=float, default=0.02, help="Substitution rate of the paralogs.")
+    parser.add_argument("--decoys-per-gene", type=float, default=1.0, help="Unrelated reference genes per target gene.")
+    parser.add_argument("--contaminants-per-gene", type=float, default=0.2, help="Contaminant sequences per target gene.")
+    parser.add_argument("--contaminated-fraction", type=float, default=0.01, help="Fraction of the genes with a fragment in the contaminants.")
+    args = parser.parse_args()
+    counts = generate(args.output_dir, args.genes, args.seed, args.length_median, args.gc_mean, args.isoform_fraction,
+                      args.paralog_fraction, args.paralog_divergence, args.decoys_per_gene, args.contaminants_per_gene,
+                      args.contaminated_fraction)
+    print(f"{counts['targets']} target transcripts, {counts['reference']} reference sequences, {counts['contaminants']} contaminant sequences")
@@ -1,3 +1,16 @@
+import argparse
+import pandas as pd
+
+# Read the selected probe table written by part 1 (selected_probes.parquet)
+def read_selected_table(file_path):
+    return pd.read_parquet(file_path, columns=["lhs_id", "rhs_id", "start", "end", "lhs", "rhs"])
+
+def extract_probes_from_table(file_path):
+    table = read_selected_table(file_path)
+    return [{"LHS ID": lhs_id, "RHS ID": rhs_id, "START": str(start), "END": str(end), "LHS sequence": lhs, "RHS sequence": rhs}
+            for lhs_id, rhs_id, start, end, lhs, rhs in table.itertuples(index=False)]
+
+# Parse the probes from the text overview of part 1 (selected_probes.txt), for results of earlier versions
 def extract_probes_from_file(file_path):
     probes = []
     with open(file_path, 'r') as file:
@@ -32,8 +45,15 @@ def write_fasta(probes, output_file):
                 file.write(f'>{probe["RHS ID"]}\n{probe["RHS sequence"]}\n')
 
 if __name__ == "__main__":
-    probes = extract_probes_from_file("selected_probes.txt")
-    write_fasta(probes, "probes.fasta")
+    parser = argparse.ArgumentParser(description="Write the LHS and RHS probes selected by part 1 to a fasta file.")
+    parser.add_argument("selected_probes", nargs="?", default="selected_probes.parquet", help="Selected probe table (.parquet) or selected_probes.txt")
+    parser.add_argument("output_fasta", nargs="?", default="probes.fasta", help="Output FASTA file.")
+    args = parser.parse_args()
+    if args.selected_probes.endswith(".txt"):
+        probes = extract_probes_from_file(args.selected_probes)
+    else:
+        probes = extract_probes_from_table(args.selected_probes)
+    write_fasta(probes, args.output_fasta)
     #print("FASTA file generated successfully!")
 
 
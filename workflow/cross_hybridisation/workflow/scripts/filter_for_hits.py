@@ -1,42 +1,111 @@
+import os
 import argparse
-from Bio import SeqIO
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+CHUNK_SIZE = 1 << 28 # bytes of BLAST output parsed by one worker task
+
+# Byte ranges of about chunk_size bytes covering a file, to be parsed by separate workers
+def file_chunks(blast_file, chunk_size=CHUNK_SIZE):
+    size = os.path.getsize(blast_file)
+    return [(blast_file, start, min(start + chunk_size, size)) for start in range(0, size, chunk_size)]
+
+# Parse the lines starting in one byte range of a BLAST outfmt 6 file (qseqid sseqid pident length ...). Only the first
+# four columns are split. Once a query is excluded, the rest of its block of consecutive lines is only counted.
+# Returns the excluded queries and, per query, [number of hits, best identity, best alignment length].
+def parse_chunk(blast_file, start, end, threshold=99.0):
+    exclude_entries = set()
+    stats = {}
+    with open(blast_file, 'rb') as f:
+        if start > 0: # skip the line started in the previous range
+            f.seek(start - 1)
+            f.readline()
+        skip_prefix = None
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            if skip_prefix is not None and line.startswith(skip_prefix):
+                stats[skip_query][0] += 1
+                continue
+            skip_prefix = None
+            columns = line.split(b'\t', 4)
+            if len(columns) < 4:
+                continue
+            entry_name = columns[0].decode()
+            percent_identity = float(columns[2])
+            alignment_length = int(columns[3])
+            entry_stats = stats.get(entry_name)
+            if entry_stats is None:
+                stats[entry_name] = [1, percent_identity, alignment_length]
+            else:
+                entry_stats[0] += 1
+                entry_stats[1] = max(entry_stats[1], percent_identity)
+                entry_stats[2] = max(entry_stats[2], alignment_length)
+            if percent_identity > threshold:
+                exclude_entries.add(entry_name)
+                skip_query, skip_prefix = entry_name, columns[0] + b'\t'
+    return exclude_entries, stats
+
+# Parse all BLAST output files in parallel byte ranges and merge the results.
+# Returns the set of excluded queries and a table of per-query hit statistics. The best identity and alignment length of
+# an excluded query only cover its hits up to the one that excluded it.
+def parse_blast_hits(blast_files, threshold=99.0, processes=1, chunk_size=CHUNK_SIZE):
+    chunks = [chunk for blast_file in blast_files for chunk in file_chunks(blast_file, chunk_size)]
+    if processes > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = list(executor.map(parse_chunk, *zip(*chunks), [threshold] * len(chunks)))
+    else:
+        results = [parse_chunk(*chunk, threshold) for chunk in chunks]
 
-def parse_blast_hits(blast_files, threshold=99.0):
     exclude_entries = set()
-    for blast_file in blast_files:
-        with open(blast_file, 'r') as f:
-            for line in f:
-                columns = line.split('\t')
-                percent_identity = float(columns[2].strip())
-                if percent_identity > threshold:
-                    entry_name = columns[0].strip()
-                    exclude_entries.add(entry_name)
-    return exclude_entries
+    stats = {}
+    for chunk_excluded, chunk_stats in results:
+        exclude_entries |= chunk_excluded
+        for entry_name, (count, identity, length) in chunk_stats.items():
+            entry_stats = stats.get(entry_name)
+            if entry_stats is None:
+                stats[entry_name] = [count, identity, length]
+            else:
+                entry_stats[0] += count
+                entry_stats[1] = max(entry_stats[1], identity)
+                entry_stats[2] = max(entry_stats[2], length)
+    hit_stats = pd.DataFrame([(name, *values) for name, values in stats.items()],
+                             columns=["probe_id", "hits", "best_identity", "best_alignment_length"])
+    hit_stats["excluded"] = hit_stats["probe_id"].isin(exclude_entries)
+    return exclude_entries, hit_stats.sort_values("probe_id", kind="stable").reset_index(drop=True)
+
+# Name of the probe pair (<probe>_<n>, as in the BLAST queries) of a LHS or RHS fasta entry (<probe>_LHS_<n>, <probe>_RHS_<n>)
+def pair_name(entry_name):
+    for side in ("_LHS_", "_RHS_"):
+        if side in entry_name:
+            return entry_name.replace(side, "_", 1)
+    return entry_name
 
+# Copy the fasta entries whose probe pair was not excluded. Both sides of an excluded pair are removed.
 def filter_fasta(input_fasta, output_fasta, exclude_entries):
     with open(input_fasta, 'r') as infile, open(output_fasta, 'w') as outfile:
         write_seq = False
         for line in infile:
             if line.startswith('>'):
                 entry_name = line[1:].strip()
-                if entry_name not in exclude_entries:
-                    outfile.write(line)
-                    write_seq = True
-                else:
-                    write_seq = False
-            else:
-                if write_seq:
-                    outfile.write(line)
+                write_seq = entry_name not in exclude_entries and pair_name(entry_name) not in exclude_entries
+            if write_seq:
+                outfile.write(line)
 
 def main(args):
-    exclude_entries = parse_blast_hits(args.blast_outputs)
+    exclude_entries, hit_stats = parse_blast_hits(args.blast_outputs, args.threshold, args.processes)
     filter_fasta(args.input_fasta, args.output_fasta, exclude_entries)
+    if args.hit_stats:
+        hit_stats.to_csv(args.hit_stats, sep="\t", index=False)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Filter FASTA entries based on BLAST hits.")
     parser.add_argument("--blast_outputs", required=True, nargs='+', help="BLAST output files.")
     parser.add_argument("--input_fasta", required=True, help="Input FASTA file.")
     parser.add_argument("--output_fasta", required=True, help="Output FASTA file.")
+    parser.add_argument("--hit_stats", help="Output table of hit statistics per probe pair (hits, best identity, best alignment length).")
+    parser.add_argument("--threshold", type=float, default=99.0, help="Probe pairs with a hit above this percent identity are removed.")
+    parser.add_argument("--processes", type=int, default=1, help="Number of worker processes parsing the BLAST outputs.")
     args = parser.parse_args()
     main(args)
-
@@ -1,7 +1,11 @@
+import csv
 import argparse
-from Bio import SeqIO
-import pandas as pd
 import yaml
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+
+COLUMNS = ["Gene ID", "Sequence"]
+VIEWS = ["combined", "lhs", "rhs"]
+FORMATS = ["xlsx", "csv", "parquet"]
 
 def load_config(config_file):
     """Load the configuration from a YAML file."""
@@ -9,70 +13,119 @@ def load_config(config_file):
         config = yaml.safe_load(file)
     return config
 
+# Streaming table writers, one row at a time
+class CsvWriter:
+    def __init__(self, path):
+        self.file = open(path, 'w', newline='')
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(COLUMNS)
+
+    def write(self, row):
+        self.writer.writerow(row)
+
+    def close(self):
+        self.file.close()
+
+class ParquetWriter:
+    def __init__(self, path, batch_size=65536):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        self.pa = pa
+        self.schema = pa.schema([(column, pa.string()) for column in COLUMNS])
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.batch_size = batch_size
+        self.rows = []
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        columns = list(zip(*self.rows)) if self.rows else [[] for _ in COLUMNS]
+        self.writer.write_table(self.pa.table([list(column) for column in columns], schema=self.schema))
+        self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+class ExcelWriter:
+    def __init__(self, path):
+        from openpyxl import Workbook # Excel output is optional
+        self.path = path
+        self.workbook = Workbook(write_only=True)
+        self.sheet = self.workbook.create_sheet()
+        self.sheet.append(COLUMNS)
+
+    def write(self, row):
+        self.sheet.append(row)
+
+    def close(self):
+        self.workbook.save(self.path)
+
+WRITERS = {"xlsx": ExcelWriter, "csv": CsvWriter, "parquet": ParquetWriter}
+
+# Split a probe ID <sequence ID>_<LHS|RHS>_<index> into its sequence ID, side and numeric index
+def parse_probe_id(probe_id):
+    sequence_id, side, index = probe_id.rsplit("_", 2)
+    return sequence_id, side, int(index)
+
+# Generator yielding (sequence ID, LHS entries, RHS entries) per sequence, each side a {index: (probe ID, sequence)} dict.
+# The probes of one sequence are listed together in the probe fasta file.
+def iter_sequences(input_fasta):
+    current, entries = None, {'LHS': {}, 'RHS': {}}
+    with open(input_fasta, 'r') as fasta:
+        for probe_id, sequence in SimpleFastaParser(fasta):
+            probe_id = probe_id.split()[0]
+            sequence_id, side, index = parse_probe_id(probe_id)
+            if sequence_id != current:
+                if current is not None:
+                    yield current, entries['LHS'], entries['RHS']
+                current, entries = sequence_id, {'LHS': {}, 'RHS': {}}
+            if side in entries:
+                entries[side][index] = (probe_id, sequence)
+    if current is not None:
+        yield current, entries['LHS'], entries['RHS']
+
+# Generator yielding the (LHS entry, RHS entry) probe pairs kept per sequence: up to num_probe_pairs pairs with both sides,
+# in numeric index order
+def iter_pairs(input_fasta, num_probe_pairs):
+    for sequence_id, lhs_entries, rhs_entries in iter_sequences(input_fasta):
+        indexes = sorted(lhs_entries.keys() & rhs_entries.keys())
+        for index in indexes[:num_probe_pairs]:
+            yield lhs_entries[index], rhs_entries[index]
+
+# Write the combined, LHS and RHS views in the given formats in one pass over the filtered probes.
+# Returns the written file names.
+def write_outputs(input_fasta, num_probe_pairs, formats, output_prefix="output_after_cross_check"):
+    writers = {view: [WRITERS[output_format](f"{output_prefix}_{view}.{output_format}") for output_format in formats] for view in VIEWS}
+    try:
+        for lhs_entry, rhs_entry in iter_pairs(input_fasta, num_probe_pairs):
+            for view, rows in (("combined", (lhs_entry, rhs_entry)), ("lhs", (lhs_entry,)), ("rhs", (rhs_entry,))):
+                for writer in writers[view]:
+                    for row in rows:
+                        writer.write(row)
+    finally:
+        for view_writers in writers.values():
+            for writer in view_writers:
+                writer.close()
+    return [f"{output_prefix}_{view}.{output_format}" for view in VIEWS for output_format in formats]
+
 def main(args):
     # Load configuration
     config = load_config('config.yaml')
     num_probe_pairs = config.get('num_probe_pairs', 1)  # Default to 1 if not specified
+    formats = args.formats or config.get('output_formats', ["xlsx"])
 
-    # Output file names based on config
-    output_excel_combined = "output_after_cross_check_combined.xlsx"
-    output_excel_lhs = "output_after_cross_check_lhs.xlsx"
-    output_excel_rhs = "output_after_cross_check_rhs.xlsx"
-
-    # Dictionary to store the LHS and RHS entries for each gene
-    gene_entries = {}
-
-    # Read the input FASTA file
-    for record in SeqIO.parse(args.input_fasta, "fasta"):
-        gene_id = record.id.split("_")[0]
-        entry_type = record.id.split("_")[3]
-        index = record.id.split("_")[4] if len(record.id.split("_")) > 2 else ""
-
-        # Initialize dictionary entry if it doesn't exist
-        if gene_id not in gene_entries:
-            gene_entries[gene_id] = {'LHS': [], 'RHS': []}
-
-        # Append to the list of entries
-        if entry_type in gene_entries[gene_id]:
-            gene_entries[gene_id][entry_type].append((index, record))
-
-    # Lists to store the data for Excel files
-    combined_data = []
-    lhs_data = []
-    rhs_data = []
-
-    # Collect the filtered entries for the Excel files
-    for gene_id, entries in gene_entries.items():
-        # Sort entries by their occurrence index
-        lhs_records = sorted(entries.get("LHS", []), key=lambda r: r[0])
-        rhs_records = sorted(entries.get("RHS", []), key=lambda r: r[0])
-
-        # Create pairs up to num_probe_pairs
-        num_pairs = min(len(lhs_records), len(rhs_records), num_probe_pairs)
-        for i in range(num_pairs):
-            lhs_record = lhs_records[i][1]
-            rhs_record = rhs_records[i][1]
-            combined_data.append([lhs_record.id, str(lhs_record.seq)])
-            combined_data.append([rhs_record.id, str(rhs_record.seq)])
-            lhs_data.append([lhs_record.id, str(lhs_record.seq)])
-            rhs_data.append([rhs_record.id, str(rhs_record.seq)])
-
-    # Create DataFrames and save to Excel files
-    combined_df = pd.DataFrame(combined_data, columns=["Gene ID", "Sequence"])
-    lhs_df = pd.DataFrame(lhs_data, columns=["Gene ID", "Sequence"])
-    rhs_df = pd.DataFrame(rhs_data, columns=["Gene ID", "Sequence"])
-
-    combined_df.to_excel(output_excel_combined, index=False)
-    lhs_df.to_excel(output_excel_lhs, index=False)
-    rhs_df.to_excel(output_excel_rhs, index=False)
-
-    print(f"\nFiltered combined entries have been saved to {output_excel_combined}")
-    print(f"Filtered LHS entries have been saved to {output_excel_lhs}")
-    print(f"Filtered RHS entries have been saved to {output_excel_rhs}")
+    output_files = write_outputs(args.input_fasta, num_probe_pairs, formats, args.output_prefix)
+    for output_file in output_files:
+        print(f"Filtered entries have been saved to {output_file}")
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Generate Excel output based on filtered FASTA entries.")
+    parser = argparse.ArgumentParser(description="Generate the output tables based on filtered FASTA entries.")
     parser.add_argument("--input_fasta", required=True, help="Input FASTA file.")
+    parser.add_argument("--formats", nargs='+', choices=FORMATS, help="Output formats, default: output_formats in config.yaml, or xlsx.")
+    parser.add_argument("--output_prefix", default="output_after_cross_check", help="Prefix of the output files.")
     args = parser.parse_args()
     main(args)
-
@@ -0,0 +1,67 @@
+import argparse
+import pyarrow.parquet as pq
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+
+# The LHS probe handle, trimmed from the merged probe pairs
+PREFIX_SEQUENCE = 'CCTTGGCACCCGAGAATTCCA'
+
+# Generator yielding (name, LHS sequence, RHS sequence) per probe pair of the selected probe table of part 1
+# (selected_probes.parquet), reading one batch of rows at a time
+def iter_table_pairs(selected_table, batch_size=65536):
+    for batch in pq.ParquetFile(selected_table).iter_batches(batch_size=batch_size, columns=["sequence_id", "index", "lhs", "rhs"]):
+        columns = batch.to_pydict()
+        for sequence_id, index, lhs, rhs in zip(columns["sequence_id"], columns["index"], columns["lhs"], columns["rhs"]):
+            yield f"{sequence_id}_{index}", lhs, rhs
+
+# Generator yielding (name, LHS sequence, RHS sequence) per probe pair of a fasta file with <probe>_LHS_<n> and <probe>_RHS_<n>
+# records (probes.fasta). The RHS of a pair does not need to follow its LHS directly.
+def iter_fasta_pairs(probes_fasta):
+    pending = {}
+    with open(probes_fasta, 'r') as fasta:
+        for name, sequence in SimpleFastaParser(fasta):
+            for side, other in (("LHS", "RHS"), ("RHS", "LHS")):
+                parts = name.split(f"_{side}_")
+                if len(parts) == 2:
+                    pair_name = f"{parts[0]}_{parts[1]}"
+                    if (pair_name, other) in pending:
+                        mate = pending.pop((pair_name, other))
+                        yield (pair_name, sequence, mate) if side == "LHS" else (pair_name, mate, sequence)
+                    else:
+                        pending[(pair_name, side)] = sequence
+                    break
+
+# Merge the LHS and RHS of each probe pair
+def merge_pairs(pairs):
+    for name, lhs, rhs in pairs:
+        yield name, lhs + rhs
+
+# Trim the poly-A tail (RHS handle) from each sequence
+def trim_poly_a_tail(records):
+    for name, sequence in records:
+        yield name, sequence.rstrip('A')
+
+# Trim the LHS handle from each sequence
+def trim_prefix(records, prefix=PREFIX_SEQUENCE):
+    for name, sequence in records:
+        yield name, sequence[len(prefix):] if sequence.startswith(prefix) else sequence
+
+# Hybridising sequences of the probe pairs, as (name, sequence) records for the cross-hybridisation BLAST
+def cross_hybridization_queries(pairs, prefix=PREFIX_SEQUENCE):
+    return trim_prefix(trim_poly_a_tail(merge_pairs(pairs)), prefix)
+
+# Write the BLAST query fasta file in one pass over the selected probe table (.parquet) or probe fasta file
+def prepare_queries(selected_probes, output_fasta, prefix=PREFIX_SEQUENCE):
+    pairs = iter_fasta_pairs(selected_probes) if selected_probes.endswith((".fasta", ".fa")) else iter_table_pairs(selected_probes)
+    count = 0
+    with open(output_fasta, 'w', buffering=1 << 20) as output:
+        for name, sequence in cross_hybridization_queries(pairs, prefix):
+            output.write(f">{name}\n{sequence}\n")
+            count += 1
+    return count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge the LHS and RHS of each probe pair and trim the probe handles, for the cross-hybridisation BLAST.")
+    parser.add_argument("selected_probes", nargs="?", default="selected_probes.parquet", help="Selected probe table of part 1, or probes.fasta.")
+    parser.add_argument("output_fasta", nargs="?", default="cleaned_sequences_from_prefix.fasta", help="BLAST query FASTA file.")
+    args = parser.parse_args()
+    prepare_queries(args.selected_probes, args.output_fasta)
@@ -0,0 +1,113 @@
+"""
+Snakemake pipeline.
+
+Persistent per-sequence design cache (SQLite), enabled with design_cache: "<file>" in config.yaml.
+
+Every target sequence is keyed on the hash of its CDS sequence plus the hash of the design settings (design_config.params_key).
+The cache stores, per key:
+    - candidates: the probe table rows of the sequence
+    - hits: the trimmed BLAST hits of its probes, per reference (keyed on the hash of the reference fasta file and the
+      off-target engine)
+
+When the cache is enabled, primer3 (or the native engine) only runs on sequences without cached candidates, and BLAST only
+on the probes of sequences without cached hits. The final selection is not cached: it is recomputed from the candidates and
+hits, which is cheap. Adding a few genes to a large panel, or changing one sequence, therefore
+only recomputes those genes.
+
+"""
+
+import io
+import hashlib
+import sqlite3
+import numpy as np
+import pandas as pd
+
+from probe_table import ProbeTable, PROBE_DTYPE
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS candidates (sequence_key TEXT PRIMARY KEY, probes BLOB);
+CREATE TABLE IF NOT EXISTS hits (sequence_key TEXT, reference_key TEXT, hits TEXT, PRIMARY KEY (sequence_key, reference_key));
+"""
+
+# Cache key of one target sequence under the given design settings
+def sequence_key(template, params_key):
+    return hashlib.sha256(template.upper().encode()).hexdigest() + ":" + params_key
+
+# Cache key of the off-target hits: the hash of the reference fasta file content and the off-target engine
+def reference_key(path, config):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest() + ":" + config["offtarget_engine"]
+
+
+class DesignCache:
+    def __init__(self, path, params_key):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(SCHEMA)
+        self.params_key = params_key #hash of the design settings of this run
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+    def key(self, template):
+        return sequence_key(template, self.params_key)
+
+    def get_candidates(self, key):
+        row = self.connection.execute("SELECT probes FROM candidates WHERE sequence_key = ?", (key,)).fetchone()
+        return None if row is None else np.frombuffer(row[0], dtype=PROBE_DTYPE).copy()
+
+    def put_candidates(self, key, probes):
+        self.connection.execute("INSERT OR REPLACE INTO candidates VALUES (?, ?)", (key, probes.tobytes()))
+
+    # Trimmed hits of one sequence, stored with probe IDs without the sequence ID (e.g. "LHS_3")
+    def get_hits(self, key, reference_key):
+        row = self.connection.execute("SELECT hits FROM hits WHERE sequence_key = ? AND reference_key = ?", (key, reference_key)).fetchone()
+        return None if row is None else pd.read_csv(io.StringIO(row[0]), sep=' ', dtype={'probe_id': str})
+
+    def put_hits(self, key, reference_key, hits):
+        self.connection.execute("INSERT OR REPLACE INTO hits VALUES (?, ?, ?)", (key, reference_key, hits.to_csv(sep=' ', index=False)))
+
+    # Target sequences without cached candidates
+    def missing_candidates(self, targets):
+        return [(sequence_id, template) for sequence_id, template in targets if self.get_candidates(self.key(template)) is None]
+
+    # Store the candidates of every sequence of a freshly built probe table
+    def store_candidates(self, table):
+        for gene, template in enumerate(table.templates):
+            self.put_candidates(self.key(template), table.block(gene))
+        self.connection.commit()
+
+    # Probe table of all target sequences, in fasta order, read from the cache
+    def load_table(self, targets):
+        gene_ids, templates, blocks = [], [], []
+        for sequence_id, template in targets:
+            probes = self.get_candidates(self.key(template))
+            gene_ids.append(sequence_id)
+            templates.append(template)
+            blocks.append(probes if probes is not None else np.zeros(0, dtype=PROBE_DTYPE))
+        return ProbeTable.from_blocks(gene_ids, templates, blocks)
+
+    # Boolean mask of the table rows whose sequence has no cached hits against the reference
+    def missing_hits(self, table, reference_key):
+        missing = np.array([self.get_hits(self.key(template), reference_key) is None for template in table.templates], dtype=bool)
+        return missing[table.probes["gene"]]
+
+    # Store the freshly trimmed hits per sequence, and return them together with the cached hits of the other sequences
+    def merge_hits(self, table, fresh_hits, reference_key):
+        fresh_sequence_ids = fresh_hits['probe_id'].str.rsplit('_', n=2).str[0]
+        fresh_by_sequence = {sequence_id: hits for sequence_id, hits in fresh_hits.groupby(fresh_sequence_ids, sort=False)}
+        merged = []
+        for sequence_id, template in zip(table.gene_ids, table.templates):
+            hits = self.get_hits(self.key(template), reference_key)
+            if hits is None:
+                hits = fresh_by_sequence.get(sequence_id, fresh_hits.iloc[0:0])
+                self.put_hits(self.key(template), reference_key, hits.assign(probe_id=hits['probe_id'].str[len(sequence_id) + 1:]))
+            else:
+                hits = hits.assign(probe_id=sequence_id + "_" + hits['probe_id'])
+            merged.append(hits)
+        self.connection.commit()
+        return pd.concat(merged, ignore_index=True) if merged else fresh_hits
+
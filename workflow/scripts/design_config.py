@@ -0,0 +1,55 @@
+"""
+Snakemake pipeline.
+
+Loads the part 1 configuration file (config.yaml). Keys missing from the file, or a missing file, fall back to the defaults below,
+so the scripts can also be run by hand outside of Snakemake.
+"""
+
+import os
+import json
+import hashlib
+import yaml
+
+DEFAULTS = {
+    "engine": "primer3",
+    "min_gc": 44,
+    "max_gc": 72,
+    "max_poly_x": 5,
+    "max_ns_accepted": 1,
+    "num_return": 100,
+    "offtarget_engine": "blast",
+    "design_cache": "",
+    "max_pairs": 3,
+    "min_spacing": 4,
+    "selection_score": ["upstream"],
+    "thermo_filter": False,
+    "min_tm": 55,
+    "max_tm": 80,
+    "max_hairpin_dg": -3,
+    "max_dimer_dg": -9,
+    "thermo_conditions": {},
+    "dimer_screen": False,
+    "dimer_seed": 8,
+    "pipeline_batch": None,
+    "isoform_coverage": 1.0,
+}
+
+# Settings which change the probe candidates of a sequence
+CANDIDATE_KEYS = ["engine", "min_gc", "max_gc", "max_poly_x", "max_ns_accepted", "num_return"]
+
+def load_config(config_file="config.yaml"):
+    """Load the configuration from a YAML file, completed with the defaults."""
+    config = dict(DEFAULTS)
+    if os.path.exists(config_file):
+        with open(config_file, 'r') as file:
+            config.update(yaml.safe_load(file) or {})
+    return config
+
+def gc_range(config):
+    """Minimum and maximum GC percentage of the hybridising parts of both probe sides."""
+    return config["min_gc"], config["max_gc"]
+
+def params_key(config, keys=CANDIDATE_KEYS):
+    """Short hash of the design settings, used in probe hash IDs and design cache keys."""
+    settings = json.dumps({key: config[key] for key in keys}, sort_keys=True)
+    return hashlib.sha256(settings.encode()).hexdigest()[:16]
@@ -0,0 +1,143 @@
+"""
+Snakemake pipeline.
+
+Panel-wide cross-dimer screen of the selected probe pairs, used by select_probe_pairs.py after the final selection when
+dimer_screen is enabled in config.yaml.
+
+All LHS and RHS probes of a panel are hybridised together, so any two probes of different pairs can form a dimer. Scoring all
+pairs of probes is quadratic in the panel size, so only the probes sharing a complementary seed are scored:
+    - every k-mer (k = dimer_seed) of every selected probe (with handles) is indexed
+    - the reverse complement k-mers of each probe are looked up in the index, giving the probes it can base-pair with
+      over at least k nucleotides
+    - those candidate pairs are scored with the primer3 heterodimer dG (thermodynamics.py), in a process pool
+
+A pair of probe pairs with a heterodimer below max_dimer_dg (kcal/mol) is an offending interaction. The probe pair with the
+most offending interactions is removed first and replaced by the best scoring alternate candidate of the same sequence
+(pair_selection.py scores) that respects the spacing to the other selected pairs of that sequence and forms no dimer with the
+panel. Without such an alternate, the probe pair is removed. This is repeated until no offending interaction is left.
+
+"""
+
+from collections import defaultdict
+import numpy as np
+
+from probe_table import LHS_HANDLE, RHS_HANDLE
+from thermodynamics import run_batches, dimer_batch, thermo_conditions
+from pair_selection import score
+
+MAX_ALTERNATES = 25 #alternate candidates tried per removed probe pair
+COMPLEMENT = str.maketrans("ACGTN", "TGCAN")
+
+
+def reverse_complement(sequence):
+    return sequence.translate(COMPLEMENT)[::-1]
+
+def kmers(sequence, k):
+    return {sequence[i:i + k] for i in range(len(sequence) - k + 1)}
+
+
+class PanelIndex:
+    """k-mer index of the LHS and RHS probes of the selected probe pairs, keyed on (table row, side)."""
+
+    def __init__(self, table, k):
+        self.k = k
+        self.lhs = [LHS_HANDLE + sequence for sequence in table.hyb_lhs()]
+        self.rhs = [sequence + RHS_HANDLE for sequence in table.hyb_rhs()]
+        self.seeds = defaultdict(set)
+
+    # Full probe sequences of a table row
+    def probes(self, row):
+        return (("LHS", self.lhs[row]), ("RHS", self.rhs[row]))
+
+    def add(self, row):
+        for side, sequence in self.probes(row):
+            for kmer in kmers(sequence, self.k):
+                self.seeds[kmer].add((row, side))
+
+    def remove(self, row):
+        for side, sequence in self.probes(row):
+            for kmer in kmers(sequence, self.k):
+                self.seeds[kmer].discard((row, side))
+
+    # Probes of other rows in the index sharing a complementary seed with the probes of a row, as
+    # ((row, side), (other row, other side)) pairs
+    def candidates(self, row):
+        pairs = set()
+        for side, sequence in self.probes(row):
+            for kmer in kmers(reverse_complement(sequence), self.k):
+                for other in self.seeds.get(kmer, ()):
+                    if other[0] != row:
+                        pairs.add(((row, side), other))
+        return pairs
+
+    def sequence(self, probe):
+        row, side = probe
+        return self.lhs[row] if side == "LHS" else self.rhs[row]
+
+# Offending interactions among candidate probe pairs, as a set of (row, other row) with the lowest dG of each
+def offending(index, candidates, config, processes=1):
+    candidates = sorted(candidates)
+    dgs = run_batches(dimer_batch, [(index.sequence(a), index.sequence(b)) for a, b in candidates], thermo_conditions(config), processes)
+    interactions = {}
+    for (a, b), dg in zip(candidates, dgs):
+        if dg < config["max_dimer_dg"]:
+            key = (min(a[0], b[0]), max(a[0], b[0]))
+            interactions[key] = min(dg, interactions.get(key, 0.0))
+    return interactions
+
+# Whether a candidate row keeps min_spacing with the selected rows of its sequence (START + min_spacing <= next END)
+def spaced(table, row, rows, min_spacing):
+    starts, ends = table.probes["start"], table.probes["end"]
+    for other in rows:
+        first, second = (row, other) if starts[row] <= starts[other] else (other, row)
+        if starts[first] + min_spacing > ends[second]:
+            return False
+    return True
+
+# Screen the selected probe pairs (boolean mask over the table) for cross-dimers and return the new selection mask
+def screen(table, selected, hits, config, log_file, processes=1):
+    selected = selected.copy()
+    index = PanelIndex(table, config["dimer_seed"])
+    rows = np.flatnonzero(selected).tolist()
+    for row in rows:
+        index.add(row)
+    candidates = set()
+    for row in rows:
+        candidates |= {(a, b) for a, b in index.candidates(row) if a[0] < b[0]}
+    interactions = offending(index, candidates, config, processes)
+    log_file.write(f"Cross-dimer screen: {len(candidates)} pairs of probes sharing a {index.k} nt complementary seed, "
+                   f"{len(interactions)} offending interactions (dG < {config['max_dimer_dg']} kcal/mol)\n")
+
+    weights = score(table, hits, config)
+    genes = table.probes["gene"]
+    lhs_ids = table.lhs_ids()
+    tried = set(rows)
+    while interactions:
+        # Remove the probe pair with the most offending interactions, the lowest scoring one on ties
+        degree = defaultdict(int)
+        for a, b in interactions:
+            degree[a] += 1
+            degree[b] += 1
+        row = max(degree, key=lambda r: (degree[r], -weights[r]))
+        interactions = {key: dg for key, dg in interactions.items() if row not in key}
+        selected[row] = False
+        index.remove(row)
+
+        # Replace it with the best alternate of the same sequence forming no dimer with the panel
+        gene_rows = np.flatnonzero(selected & (genes == genes[row])).tolist()
+        alternates = [r for r in np.flatnonzero(genes == genes[row]).tolist()
+                      if r not in tried and spaced(table, r, gene_rows, config["min_spacing"])]
+        alternates.sort(key=lambda r: -weights[r])
+        replacement = None
+        for alternate in alternates[:MAX_ALTERNATES]:
+            tried.add(alternate)
+            if not offending(index, index.candidates(alternate), config, processes):
+                replacement = alternate
+                break
+        if replacement is None:
+            log_file.write(f"Removed probe pair {lhs_ids[row]} ({degree[row]} cross-dimers), no alternate without cross-dimers\n")
+        else:
+            selected[replacement] = True
+            index.add(replacement)
+            log_file.write(f"Replaced probe pair {lhs_ids[row]} ({degree[row]} cross-dimers) with {lhs_ids[replacement]}\n")
+    return selected
@@ -2,16 +2,16 @@
 Snakemake pipeline. Author: Sofia Rouot.
 
 Input:
-- The output file from primer3, containing potential LHS probes. 
+- The output file from primer3, containing potential LHS probes. With --engine native, the CDS fasta file instead (see native_candidates.py).
 
 Output:
 - A FASTA file containing all the LHS and RHS hybridising sequences.
 
-In each sequence object, multiple probe pair objects are stored containing the following information: 
+The probe pairs of all sequences are stored in a columnar probe table (probe_table.py) containing the following information: 
     - Left hand side (LHS) and Right hand side (RHS) ID
     - Probe pair start site
     - Probe pair end site 
-    - LHS and RHS sequence (incl probe handle)
+    - LHS and RHS hybridising sequence (the probe handles are added when writing the probes)
     - LHS and RHS GC percentage. NOTE: this is only of the hybridising part, so it does not include the probe handle in the calculation 
 
 For each sequence, this script: 
@@ -19,7 +19,7 @@ For each sequence, this script:
 - expands the probe 25 nucleotides starting from this T to the right to build a 25 nt long RHS probe. Since the probes are reverse transcripts, on the sequence they are extended towards the left side.
 - adds the probe handles to both LHS nad RHS probes 
 - orders and indexes the probes based on their start site on the template sequence
-- removes probes of which the RHS GC content percentage does not fall within the range of 44 - 72 
+- removes probes of which the RHS GC content percentage does not fall within the configured GC range (min_gc - max_gc, 44 - 72 by default)
 - removes probes which would "fall off" the sequence template 
 
 LHS probe template: 5'-CCTTGGCACCCGAGAATTCCA-target_LHS-3' 
@@ -28,125 +28,147 @@ RHS probe template: /5Phos/-target_RHS-AAAAAAAAAAAAAAAAAAAAAAAAAAAAAA-3'
 """
 
 # Import packages 
-from Bio.SeqUtils import gc_fraction
-from Bio.Seq import Seq
-import os 
-import secrets
-
-# Define the class Probe 
-class Probe:
-    def __init__(self):
-        self.HASH_ID = ""
-        self.RHS_ID = "" #ID of RHS probe
-        self.LHS_ID = "" #ID of LHS probe 
-        self.START = 0 #index of first nucleotide of LHS probe on sequence template 
-        self.END = 0 #index of last nucleotide of RHS probe on sequence template
-        self.LHS = "" #left hand side sequence
-        self.LHS_GC = 0 #left hand side GC percentage
-        self.RHS = "" #right hand side sequence
-        self.RHS_GC = 0 #right hand side GC content
-
-# Define the class Sequence 
-class Sequence:
-    def __init__(self):
-        self.ID = "" #sequence ID 
-        self.TEMPLATE = "" #sequence template 
-        self.PROBES = [] #probes belonging to that sequence 
-
-# Generate the RHS probe based on the LHS probe 
-def create_rhs(Sequence, Probe):
-    my_dna = Seq(Sequence.TEMPLATE)
-    RHS_start = int(Probe.START) - 24
-    RHS_end = int(RHS_start) - 25
-    RHS_seq = my_dna[RHS_end:RHS_start].reverse_complement()
-    #RHS_seq = my_dna[RHS_start:RHS_end] #do not take complement, as input is DNA sequence rather than RNA sequence
-    RHS_GC = str(format(float(gc_fraction(RHS_seq)*100), '.3f')) #3 decimal places. Convert to string to allow for concatanation in printer function. 
-    RHS = str(RHS_seq) + "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAA" #add probe handle
-    return RHS, RHS_GC, str(RHS_end)
+import sys
+import argparse
+from probe_table import ProbeTable, Probe, Sequence, GC_RANGE
+from design_config import load_config, params_key, gc_range
+from design_cache import DesignCache, reference_key
+from primer3_input_design import iter_targets
 
 # Printer function, called by last rule (select probe pairs)
-def printer(Sequences):
+def printer(Sequences, file=sys.stdout):
     for sequence in Sequences:
-        print("/-------------------/")
-        print("Sequence id: " + sequence.ID)
-        print("Sequence template:\n" + sequence.TEMPLATE + "\n")
-        print("Probes: \n")
+        print("/-------------------/", file=file)
+        print("Sequence id: " + sequence.ID, file=file)
+        print("Sequence template:\n" + sequence.TEMPLATE + "\n", file=file)
+        print("Probes: \n", file=file)
         for probe in sequence.PROBES:
-            print("     probe pair HASH ID: " + probe.HASH_ID + "\n")
-            print("     probe pair LHS ID: " + probe.LHS_ID)
-            print("     probe pair RHS ID: " + probe.RHS_ID)
-            print("     probe pair START: " + probe.START)
-            print("     probe pair END: " + probe.END)
-            print("     probe LHS: " + probe.LHS)
-            print("     probe LHS GC: " + probe.LHS_GC)
-            print("     probe RHS: " + probe.RHS)
-            print("     probe RHS GC: " + probe.RHS_GC)
-            print("     -----------------\n")
-
+            print("     probe pair HASH ID: " + probe.HASH_ID + "\n", file=file)
+            print("     probe pair LHS ID: " + probe.LHS_ID, file=file)
+            print("     probe pair RHS ID: " + probe.RHS_ID, file=file)
+            print("     probe pair START: " + probe.START, file=file)
+            print("     probe pair END: " + probe.END, file=file)
+            print("     probe LHS: " + probe.LHS, file=file)
+            print("     probe LHS GC: " + probe.LHS_GC, file=file)
+            print("     probe RHS: " + probe.RHS, file=file)
+            print("     probe RHS GC: " + probe.RHS_GC, file=file)
+            print("     -----------------\n", file=file)
+
+
+# Translation table removing the primer index from primer3 tags, e.g. PRIMER_RIGHT_12_SEQUENCE -> PRIMER_RIGHT__SEQUENCE
+STRIP_DIGITS = str.maketrans('', '', '0123456789')
+
+# Generator reading the primer3 output file record by record. 
+# At each "=" line, one (sequence ID, template, LHS start sites, LHS hybridising sequences, LHS GC percentages) record is yielded,
+# so only the current record is held in memory.
+def iter_records(primer3_output_file):
+    sequence_id, template = "", ""
+    starts, lhs, lhs_gc = [], [], []
+    probe_collection_mode = False
 
-# Function to process input file and create probes
-def process(primer3_output_file):
     with open(primer3_output_file, 'r') as file1:
-        Lines = file1.readlines()
+        for line in file1: #parse the primer3 output file 
+            line = line.rstrip('\n')
+            if line == "=": #= indicates the end of a sequence query in primer3 output
+                yield sequence_id, template, starts, lhs, lhs_gc
+                sequence_id, template = "", ""
+                starts, lhs, lhs_gc = [], [], []
+                probe_collection_mode = False
+                continue
+            tag, _, value = line.partition('=')
+            tag = tag.translate(STRIP_DIGITS) #remove number from tags to allow iteration over all primers
+            if tag == "SEQUENCE_ID":
+                sequence_id = value #add template sequence ID 
+            elif tag == "SEQUENCE_TEMPLATE":
+                template = value #add template sequence 
+
+            # Start probe collection for the sequence 
+            elif tag == "PRIMER_RIGHT__SEQUENCE": 
+                if value[-1:] == 'T' and len(value) == 25: #only keep LHS probes ending at T, and which are 25 nucleotides long (this should be the case for all probes based on primer3 instruction)
+                    lhs.append(value)
+                    probe_collection_mode = True #only add probe to sequence if last nucleotide of the probe is a T 
+            elif tag == "PRIMER_RIGHT_" and probe_collection_mode is True:
+                starts.append(int(value.split(',')[0]))
+            elif tag == "PRIMER_RIGHT__GC_PERCENT" and probe_collection_mode is True:
+                lhs_gc.append(float(value))
+                probe_collection_mode = False
+
+
+# Read the whole primer3 output file into a probe table
+def read_table(primer3_output_file, params_key="", gc_range=GC_RANGE):
+    return ProbeTable.from_records(iter_records(primer3_output_file), params_key, gc_range)
+
+
+# Generator of Sequence views, built one record at a time
+def iter_sequences(primer3_output_file):
+    for record in iter_records(primer3_output_file):
+        yield from ProbeTable.from_records([record]).sequences()
 
-    sequences = []
-    new_sequence = Sequence()
-    new_probe = Probe()
-    probe_collection_mode = False
 
-    for line in Lines: #parse the primer3 output file 
-        if line == "=\n": #= indicates the end of a sequence query in primer3 output
-            i = 0 
-            for probe in new_sequence.PROBES: 
-                probe.HASH_ID = secrets.token_hex(nbytes=4)[0:7] #create random hash and take first seven characters of it 
-                probe.LHS_ID = str(new_sequence.ID+"_LHS_"+str(i)) #write probe ID for left hand side 
-                probe.RHS_ID = str(new_sequence.ID+"_RHS_"+str(i)) #write probe ID for right hand side 
-                i = i + 1 
-            sequences.append(new_sequence)
-            new_sequence = Sequence()
-        information = line.split('=')
-        information[0] = ''.join([i for i in information[0] if not i.isdigit()]) #remove number from left hand sides to allow iteration over all primers
-        information[1] = information[1].replace('\n', '')
-        if information[0] == "SEQUENCE_ID":
-            new_sequence.ID = information[1] #add template sequence ID 
-        if information[0] == "SEQUENCE_TEMPLATE":
-            new_sequence.TEMPLATE = information[1] #add template sequence 
-
-        # Start probe collection into sequence instance 
-        if information[0] == "PRIMER_RIGHT__SEQUENCE": 
-            if information[1][-1] == 'T': #only keep LHS probes ending at T
-                if len(information[1]) == 25: #only keep LHS probes which are 25 nucleotides long, but this should be the case for all probes based on primer3 instruction
-                    new_probe.LHS = "CCTTGGCACCCGAGAATTCCA" +information[1] #add probe handle 
-                    probe_collection_mode = True #only add probe to sequence object if last nucleotide of the probe is a T 
-        if information[0] == "PRIMER_RIGHT_" and probe_collection_mode is True:
-            new_probe.START = information[1].split(',')[0] 
-        if information[0] == "PRIMER_RIGHT__GC_PERCENT" and probe_collection_mode is True:
-            new_probe.LHS_GC = information[1]
-            new_probe.RHS, new_probe.RHS_GC, new_probe.END = create_rhs(new_sequence, new_probe) #call RHS function 
-            new_sequence.PROBES.append(new_probe)
-            new_probe = Probe()
-            probe_collection_mode = False
-        
-        # Filter out probes with low GC content or those with an END position beyond the template
-        new_sequence.PROBES = [probe for probe in new_sequence.PROBES 
-                              if 44 <= float(probe.RHS_GC) <= 72 and int(probe.END) <= len(new_sequence.TEMPLATE)]
-        # Sort probes based on index on template sequence 
-        new_sequence.PROBES.sort(key=lambda x: int(x.START))
-        
-    return sequences
+# Function to process input file and create probes
+def process(primer3_output_file):
+    return list(iter_sequences(primer3_output_file))
+
+
+# Read the candidates of either engine into a probe table: the primer3 output file, or the CDS fasta file for the native engine.
+# With a design cache, the candidates file only holds the sequences missing from the cache: the fresh candidates are stored
+# and the table of all sequences of the targets file is returned.
+# With the shared regions of collapsed isoforms (isoform_regions.read_regions), the candidates of the representatives are
+# restricted to the probe windows shared by the isoforms.
+def load_table(candidates_file, config, cache=None, targets_file=None, regions=None):
+    if config["engine"] == "native":
+        import native_candidates
+    if cache is None:
+        if config["engine"] == "native":
+            table = native_candidates.read_table(candidates_file, config, regions)
+        else:
+            table = read_table(candidates_file, params_key(config), gc_range(config))
+    else:
+        targets = list(iter_targets(targets_file))
+        if config["engine"] == "native":
+            fresh = native_candidates.table_from_targets(cache.missing_candidates(targets), config)
+        else:
+            fresh = read_table(candidates_file, params_key(config), gc_range(config))
+        cache.store_candidates(fresh)
+        table = cache.load_table(targets)
+    if regions:
+        from isoform_regions import shared_mask
+        table = table.select(shared_mask(table, regions))
+    return table
+
+
+# Write the LHS and RHS hybridising sequences of a probe table to a fasta file
+def write_hybparts_fasta(table, fasta_file):
+    with open(fasta_file, "w") as fasta:
+        for lhs_id, hyb_LHS, rhs_id, hyb_RHS in zip(table.lhs_ids(), table.hyb_lhs(), table.rhs_ids(), table.hyb_rhs()):
+            fasta.write(">"+lhs_id+"\n"+hyb_LHS+"\n")
+            fasta.write(">"+rhs_id+"\n"+hyb_RHS+"\n")
 
 
 if __name__ == "__main__":
-    sequences = process('primer3_output.txt')
+    parser = argparse.ArgumentParser(description="Generate LHS and RHS probe sequences from the primer3 output or, with --engine native, from the CDS fasta file.")
+    parser.add_argument("--engine", choices=["primer3", "native"], default="primer3", help="Candidate generation engine.")
+    parser.add_argument("--cache", help="Design cache file. Only probes of sequences without cached BLAST hits are written.")
+    parser.add_argument("--targets", default="CDS_gene_targets.fa", help="CDS fasta file, used with --cache.")
+    parser.add_argument("--reference", default="CDS_all.fa", help="BLAST reference fasta file, used with --cache.")
+    parser.add_argument("--shared-regions", help="Shared regions of the collapsed isoforms, e.g. isoform_regions.tsv")
+    parser.add_argument("candidates_file", nargs="?", default="primer3_output.txt", help="primer3 output file, or CDS fasta file for the native engine.")
+    parser.add_argument("fasta_file", nargs="?", default="probes_hybparts_snakemake.fasta", help="Output fasta file.")
+    args = parser.parse_args()
+    config = load_config()
+    config["engine"] = args.engine
+    regions = None
+    if args.shared_regions:
+        from isoform_regions import read_regions
+        regions = read_regions(args.shared_regions)
+
+    if args.cache:
+        cache = DesignCache(args.cache, params_key(config))
+        table = load_table(args.candidates_file, config, cache, args.targets, regions)
+        table = table.select(cache.missing_hits(table, reference_key(args.reference, config)))
+        cache.close()
+    else:
+        table = load_table(args.candidates_file, config, regions=regions)
     # Write one fasta file containing all the LHS and RHS hybridising sequences. 
     # Purpose: use as BLAST input to test for off target hybridisation  
-    with open("probes_hybparts_snakemake.fasta", "w") as fasta:
-        for sequence in sequences:
-            for probe in sequence.PROBES: 
-                hyb_LHS = probe.LHS[-25:] #only take the hybrdising part of the probe, i.e. the last 25 nucleotides    
-                hyb_RHS = probe.RHS[:25] #only take the hybridising part of the probe, i.e. the first 25 nucleotides. 
-                fasta.write(">"+probe.LHS_ID+"\n"+hyb_LHS+"\n")
-                fasta.write(">"+probe.RHS_ID+"\n"+hyb_RHS+"\n")
-  
-
-
+    write_hybparts_fasta(table, args.fasta_file)
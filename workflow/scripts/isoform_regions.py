@@ -0,0 +1,202 @@
+"""
+Snakemake pipeline.
+
+Isoform collapsing before candidate generation, enabled with collapse_isoforms in config.yaml. The transcripts of
+CDS_gene_targets.fa are grouped by the gene_ID field of their headers up to the first "." (as the gene_id of the trimmed
+off-target hits, so <gene>.1 and <gene>.2 are isoforms of one gene). For a gene with several isoforms, only its first
+transcript (the representative) is designed, and only on the regions it shares with the other isoforms, so primer3 and
+BLAST run once per gene instead of once per transcript, and every selected probe pair hybridises to all the isoforms.
+
+A probe window (the 50 nt covered by the RHS and the LHS) is shared when the same 50 nt occur in at least isoform_coverage
+of the isoforms of the gene (1.0: all of them). Consecutive shared windows found at the same offsets in the same isoforms
+form a segment, an exact common region of the representative and of these isoforms. A gene without any shared window keeps
+all its isoforms as separate targets, as without collapsing, and is reported in the log.
+
+Command in Snakefile rule:
+$ python3 isoform_regions.py CDS_gene_targets.fa CDS_collapsed_targets.fa isoform_regions.tsv
+
+Output:
+- CDS_collapsed_targets.fa: the representative of each gene with its original header, the genes with one isoform and the
+  genes without shared region
+- isoform_regions.tsv: one line per segment and isoform: the representative sequence ID, the segment start and end on the
+  representative (0-based, end excluded), the sequence ID of the isoform and the segment start on the isoform. The
+  representative is listed as its own isoform.
+
+The candidates of the representatives are restricted to the segments by primer3_input_design.py (primer3 excluded regions)
+or native_candidates.py, and exactly by generate_probe_pairs.load_table (shared_mask). After the selection, the probe pairs
+are mapped back to the positions of each isoform:
+$ python3 isoform_regions.py --map selected_probes.parquet isoform_probes.tsv isoform_regions.tsv
+
+"""
+
+import sys
+import math
+import argparse
+import numpy as np
+import pandas as pd
+from Bio import SeqIO
+
+from design_config import load_config
+from kmer_offtarget import encode, SEPARATOR
+from primer3_input_design import sequence_id
+from probe_table import HYB_SIZE
+
+PROBE_SIZE = 2 * HYB_SIZE #nucleotides of the template covered by a probe pair (RHS and LHS)
+MISSING = np.iinfo(np.int64).min #offset of a window absent from an isoform
+
+
+# Code of the HYB_SIZE nt k-mer starting at every position of a template, -1 for k-mers with unknown nucleotides
+def kmer_codes(template):
+    codes = encode(template)
+    n = max(len(codes) - HYB_SIZE + 1, 0)
+    kmers = np.zeros(n, dtype=np.int64)
+    valid = np.ones(n, dtype=bool)
+    for j in range(HYB_SIZE):
+        window = codes[j:j + n]
+        kmers = (kmers << 2) | (window & 3)
+        valid &= window != SEPARATOR
+    return np.where(valid, kmers, -1)
+
+# Probe windows of a template as a 2D array of the codes of their two halves, -1 for windows with unknown nucleotides
+def probe_windows(template):
+    kmers = kmer_codes(template)
+    n = max(len(template) - PROBE_SIZE + 1, 0)
+    windows = np.stack([kmers[:n], kmers[HYB_SIZE:HYB_SIZE + n]], axis=1)
+    windows[(windows < 0).any(axis=1)] = -1
+    return windows
+
+# Position of the first occurrence of each window of the representative in an isoform, -1 when absent
+def window_positions(representative, isoform):
+    valid = np.flatnonzero(isoform[:, 0] >= 0)
+    _, ids = np.unique(np.concatenate([isoform[valid], representative]), axis=0, return_inverse=True)
+    ids = ids.ravel()
+    first = np.full(ids.max() + 1 if len(ids) else 0, -1, dtype=np.int64)
+    first[ids[:len(valid)][::-1]] = valid[::-1] #the first occurrence is written last
+    positions = first[ids[len(valid):]]
+    positions[representative[:, 0] < 0] = -1
+    return positions
+
+# Segments of the representative (first template) shared by at least required templates, as (start, end, [(isoform,
+# start on the isoform)]) with start and end on the representative
+def shared_segments(templates, required):
+    windows = [probe_windows(template) for template in templates]
+    n = len(windows[0])
+    if n == 0:
+        return []
+    positions = np.array([window_positions(windows[0], isoform) for isoform in windows[1:]]).reshape(len(windows) - 1, n)
+    present = positions >= 0
+    offsets = np.where(present, positions - np.arange(n), MISSING) #shift of each window from the representative to the isoform
+    shared = (windows[0][:, 0] >= 0) & (present.sum(axis=0) + 1 >= required)
+
+    # A segment is a run of shared windows found at the same offsets in the same isoforms
+    change = np.ones(n, dtype=bool)
+    change[1:] = (shared[1:] != shared[:-1]) | (offsets[:, 1:] != offsets[:, :-1]).any(axis=0)
+    starts = np.flatnonzero(change)
+    segments = []
+    for start, end in zip(starts.tolist(), np.append(starts[1:], n).tolist()):
+        if shared[start]:
+            isoforms = [(0, start)] + [(isoform + 1, start + int(offsets[isoform, start])) for isoform in np.flatnonzero(present[:, start])]
+            segments.append((start, end - 1 + PROBE_SIZE, isoforms))
+    return segments
+
+# Write the collapsed targets and the shared regions, returning the IDs of the genes collapsed and of those kept uncollapsed
+def collapse(targets_file, collapsed_file, regions_file, coverage=1.0):
+    genes = {} #gene ID -> [(header, sequence ID, template)], in the order of the fasta file
+    for record in SeqIO.parse(targets_file, "fasta"):
+        gene_id = record.description.split(" ")[0].split(":")[1].split('.')[0]
+        genes.setdefault(gene_id, []).append((record.description, sequence_id(record.description), str(record.seq)))
+
+    collapsed, uncollapsed = [], []
+    with open(collapsed_file, "w") as fasta, open(regions_file, "w") as regions:
+        regions.write("sequence_id\tstart\tend\ttranscript_id\ttranscript_start\n")
+        for gene_id, isoforms in genes.items():
+            segments = []
+            if len(isoforms) > 1:
+                required = max(1, math.ceil(coverage * len(isoforms)))
+                segments = shared_segments([template.upper() for _, _, template in isoforms], required)
+                if not segments:
+                    uncollapsed.append(gene_id)
+                    for header, _, template in isoforms:
+                        fasta.write(f">{header}\n{template}\n")
+                    continue
+                collapsed.append(gene_id)
+            header, representative, template = isoforms[0]
+            fasta.write(f">{header}\n{template}\n")
+            for start, end, matches in segments:
+                for isoform, isoform_start in matches:
+                    regions.write(f"{representative}\t{start}\t{end}\t{isoforms[isoform][1]}\t{isoform_start}\n")
+    return collapsed, uncollapsed
+
+# Shared regions of the representatives: sequence ID -> (first and last + 1 start of the shared probe windows, per segment)
+def read_regions(regions_file):
+    regions = pd.read_csv(regions_file, sep="\t", dtype={"sequence_id": str, "transcript_id": str})
+    regions = regions[regions["sequence_id"] == regions["transcript_id"]].sort_values(["sequence_id", "start"])
+    return {sequence_id: (group["start"].to_numpy(), group["end"].to_numpy() - PROBE_SIZE + 1)
+            for sequence_id, group in regions.groupby("sequence_id", sort=False)}
+
+# Whether probe windows starting at the given template positions lie in a segment. The window ranges of the segments of a
+# sequence are disjoint and sorted.
+def window_mask(positions, segments):
+    first, last = segments
+    segment = np.searchsorted(first, positions, side="right") - 1
+    return (segment >= 0) & (positions < last[np.maximum(segment, 0)])
+
+# Template regions excluded from the primer3 right primers (the LHS) of a sequence, as (start, length): the LHS of a shared
+# window covers its last HYB_SIZE nucleotides. primer3 applies them to the LHS only, the exact check is shared_mask.
+def excluded_regions(length, segments):
+    regions, position = [], 0
+    for first, last in zip(*segments):
+        if first + HYB_SIZE > position:
+            regions.append((position, first + HYB_SIZE - position))
+        position = max(position, int(last) - 1 + PROBE_SIZE)
+    if position < length:
+        regions.append((position, length - position))
+    return regions
+
+# Boolean mask of the rows of a probe table within the shared regions of their sequence (all rows of sequences which were
+# not collapsed). A probe pair covers the template from its end (RHS) to its start (LHS) position.
+def shared_mask(table, regions):
+    keep = np.ones(len(table), dtype=bool)
+    offsets = table.gene_offsets()
+    for gene, sequence_id in enumerate(table.gene_ids):
+        if sequence_id in regions:
+            rows = slice(offsets[gene], offsets[gene + 1])
+            keep[rows] = window_mask(table.probes["end"][rows], regions[sequence_id])
+    return keep
+
+# Positions of the selected probe pairs of the representatives on every isoform sharing them
+def map_probes(selected_table, regions_file):
+    probes = pd.read_parquet(selected_table, columns=["sequence_id", "hash_id", "lhs_id", "rhs_id", "start", "end"])
+    regions = pd.read_csv(regions_file, sep="\t", dtype={"sequence_id": str, "transcript_id": str})
+    mapped = probes.merge(regions, on="sequence_id", suffixes=("", "_segment"))
+    # The segment holding each probe pair, the one whose window range contains the pair
+    mapped = mapped[(mapped["end"] >= mapped["start_segment"]) & (mapped["start"] < mapped["end_segment"])]
+    shift = mapped["transcript_start"] - mapped["start_segment"]
+    return pd.DataFrame({
+        "sequence_id": mapped["sequence_id"],
+        "hash_id": mapped["hash_id"],
+        "lhs_id": mapped["lhs_id"],
+        "rhs_id": mapped["rhs_id"],
+        "transcript_id": mapped["transcript_id"],
+        "start": mapped["start"] + shift,
+        "end": mapped["end"] + shift,
+    })
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Collapse the isoforms of the target genes to their shared regions, or map the selected probe pairs back to the isoforms.")
+    parser.add_argument("input_file", help="CDS fasta file, e.g. CDS_gene_targets.fa, or the selected probe table with --map, e.g. selected_probes.parquet")
+    parser.add_argument("output_file", help="Collapsed CDS fasta file, e.g. CDS_collapsed_targets.fa, or the isoform probe table with --map, e.g. isoform_probes.tsv")
+    parser.add_argument("regions_file", help="Shared regions, written, or read with --map, e.g. isoform_regions.tsv")
+    parser.add_argument("--coverage", type=float, help="Fraction of the isoforms of a gene sharing a probe window, default: isoform_coverage in config.yaml.")
+    parser.add_argument("--map", action="store_true", help="Map the selected probe pairs to the isoforms.")
+    args = parser.parse_args()
+
+    if args.map:
+        map_probes(args.input_file, args.regions_file).to_csv(args.output_file, sep="\t", index=False)
+    else:
+        coverage = args.coverage if args.coverage is not None else load_config()["isoform_coverage"]
+        collapsed, uncollapsed = collapse(args.input_file, args.output_file, args.regions_file, coverage)
+        print(f"Collapsed the isoforms of {len(collapsed)} genes", file=sys.stderr)
+        for gene_id in uncollapsed:
+            print(f"No region shared by the isoforms of gene {gene_id}, isoforms designed separately", file=sys.stderr)
@@ -0,0 +1,327 @@
+"""
+Snakemake pipeline.
+
+Native off-target search, used instead of BLAST + parse_blast_output.py when offtarget_engine is set to "kmer" in config.yaml.
+
+Input:
+- the fasta file with the LHS and RHS hybridising sequences (probes_hybparts_snakemake.fasta)
+- the reference fasta file (CDS_all.fa), or its 2-bit packed store (CDS_all.pack, sequence_store.py), which is memory-mapped
+  without parsing the fasta text
+
+Output:
+- the trimmed off-target table, with the same columns as trimmed_probes_hybparts_off_targets.txt written by parse_blast_output.py
+
+The acceptance criterion of the BLAST path is a hit with less than 6 mismatches after correcting for the unaligned part of the
+25 nt probe. A probe with at most 5 mismatches over its 25 nucleotides, cut in 2 disjoint 12 nt pieces, has at most 2
+mismatches in one of them (pigeonhole principle). The reference is therefore indexed once on its k-mers (k up to 12, with
+32-bit positions), and the seeds of every probe and of its reverse complement are looked up with all their variants within 2
+substitutions. The candidate positions of a batch of probes are then verified together with a vectorized mismatch count over
+the full 25 nt. Long seeds keep the candidates few, so the cost grows with the number of probes, and only slowly with the
+size of the reference. The search is exhaustive for the mismatch budget on ungapped alignments, on both strands. Probes hanging over
+the end of a reference sequence count the overhanging nucleotides as mismatches, as the corrected mismatches of the BLAST path do.
+Unlike BLAST, alignments with gaps are not reported.
+
+The search reads the reference from the packed store only: the index is built from chunks decoded one at a time, and each
+candidate window is verified on one 64-bit word of the memory map (XOR with the encoded probe, then a count of the different
+nucleotides). A fasta reference is packed in memory first. Besides the page-cached store, shared by the processes mapping it
+(a quarter of a byte per nucleotide), every process holds its own sorted k-mer positions (4 bytes per indexed nucleotide) and
+the offsets of the 4^k k-mer codes (up to 64 MB).
+
+Command in Snakefile rule:
+$ python3 kmer_offtarget.py probes_hybparts_snakemake.fasta CDS_all.pack kmer_probes_hybparts_off_targets.txt
+
+The hits can be compared with the BLAST path (hits found by both / by one engine only) with:
+$ python3 kmer_offtarget.py probes_hybparts_snakemake.fasta CDS_all.fa kmer_hits.txt --compare trimmed_probes_hybparts_off_targets.txt
+
+"""
+
+import sys
+import math
+import time
+import itertools
+import argparse
+import numpy as np
+import pandas as pd
+from Bio import SeqIO
+from sequence_store import SequenceStore, is_store, CODES, UNKNOWN
+
+PROBE_SIZE = 25 #length of the hybridising probe sides
+MAX_SEED = 12 #longest seed: the offsets of the 4^12 k-mer codes take 64 MB
+INDEX_CHUNK = 1 << 20 #reference positions sorted at a time when building the index (at most 22 bits of the sort keys)
+QUERY_CHUNK = 1024 #probe sequences searched at a time
+WORD_SIZE = 32 #nucleotides of a 64-bit word of the store
+WORD_MASK = np.uint64((1 << 2 * PROBE_SIZE) - 1) #the PROBE_SIZE nucleotides at the low end of a word
+LOW_BITS = np.uint64(int("01" * PROBE_SIZE, 2)) #low bit of the pair of each of these nucleotides
+PAIR_SHIFTS = (2 * np.arange(PROBE_SIZE - 1, -1, -1)).astype(np.uint64) #bit offset of each probe nucleotide in a word
+
+COLUMNS = ["probe_id", "transcript_id", "qstart", "qend", "sstart", "send", "percentage_ident", "n_mismatches",
+           "n_corrected_mismatches", "gene_id", "alignment_length"]
+
+
+# Encode a nucleotide string as codes 0-3 (unknown nucleotides: UNKNOWN)
+def encode(sequence):
+    return CODES[np.frombuffer(sequence.encode("ascii"), dtype=np.uint8)]
+
+# Generator of the (ID, sequence) records of a fasta file
+def iter_fasta(fasta_file):
+    for record in SeqIO.parse(fasta_file, "fasta"):
+        yield record.id, str(record.seq)
+
+# Words (2 bits per nucleotide, the first in the high bits, unknown nucleotides as A) of a 2D array of encoded probes, and
+# masks of their unknown nucleotides (low bit of the pair of each unknown nucleotide)
+def query_words(queries):
+    words = ((queries & 3).astype(np.uint64) << PAIR_SHIFTS).sum(axis=1, dtype=np.uint64)
+    return words, unknown_mask(queries == UNKNOWN)
+
+# Mask of the positions set in a 2D boolean array of PROBE_SIZE columns, as the low bits of nucleotide pairs
+def unknown_mask(unknown):
+    return (unknown.astype(np.uint64) << PAIR_SHIFTS).sum(axis=1, dtype=np.uint64)
+
+# Number of bits set in each 64-bit integer, counted in parallel in its 2, 4 and 8 bit fields
+def popcount(values):
+    values = values - ((values >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    values = (values & np.uint64(0x3333333333333333)) + ((values >> np.uint64(2)) & np.uint64(0x3333333333333333))
+    values = (values + (values >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return ((values * np.uint64(0x0101010101010101)) >> np.uint64(56)).astype(np.int64)
+
+# Seed scheme of an exhaustive search within max_mismatches on a reference of n_codes nucleotides: (pieces, errors, k). The
+# probe is cut in pieces disjoint pieces with pieces * (errors + 1) > max_mismatches, so at least one of them has at most
+# errors mismatches (pigeonhole principle). The seed of each piece is its first k nucleotides, looked up with all its
+# variants within errors substitutions. k grows with the reference, 16 to 64 k-mer codes per position, up to MAX_SEED.
+def seed_scheme(max_mismatches, n_codes):
+    if not 0 <= max_mismatches < PROBE_SIZE:
+        raise ValueError("--max-mismatches must be between 0 and the probe length")
+    pieces = max_mismatches // 3 + 1
+    errors = max_mismatches // pieces
+    k = min(PROBE_SIZE // pieces, MAX_SEED, max(1, math.ceil(math.log(max(n_codes, 1), 4)) + 2))
+    return pieces, errors, k
+
+# XOR masks turning a k-mer code into each k-mer within errors substitutions (XOR with 1, 2 or 3 changes a nucleotide)
+def neighbourhood(k, errors):
+    masks = [0]
+    for n in range(1, errors + 1):
+        for positions in itertools.combinations(range(k), n):
+            for values in itertools.product((1, 2, 3), repeat=n):
+                masks.append(sum(value << 2 * (k - 1 - position) for position, value in zip(positions, values)))
+    return np.array(masks, dtype=np.int64)
+
+# Distinct codes of a sorted code array, with the index of their first occurrence and their count
+def code_runs(codes):
+    first = np.flatnonzero(np.concatenate(([True], codes[1:] != codes[:-1]))) if len(codes) else np.zeros(0, dtype=np.int64)
+    return codes[first], first, np.diff(np.append(first, len(codes)))
+
+
+class KmerIndex:
+    """k-mer index of the sequences of a packed store (sequence_store.py), searched on the packed bytes themselves."""
+
+    def __init__(self, store, max_mismatches):
+        self.store = store
+        self.max_mismatches = max_mismatches
+        self.names = store.names
+        self.starts = store.offsets * 4 #position of the first nucleotide of each sequence in the store
+        self.lengths = store.lengths
+        self.next_starts = np.append(self.starts[1:], np.iinfo(np.int64).max) #start of the next sequence
+        self.size = 4 * len(store.data) #positions of the store, including the A filling the last byte of each sequence
+        self.pieces, self.errors, self.k = seed_scheme(max_mismatches, self.size)
+        self.masks = neighbourhood(self.k, self.errors)
+        self.piece_starts = np.arange(self.pieces) * (PROBE_SIZE // self.pieces)
+
+        # Counting sort of the indexed k-mer positions on their k-mer code, chunk by chunk, into 32-bit positions (64-bit
+        # for references of 2^31 nucleotides or more), with the offset of each code in the sorted positions
+        dtype = np.int32 if self.size + PROBE_SIZE < 2 ** 31 else np.int64
+        counts = np.zeros(4 ** self.k, dtype=dtype)
+        for _, kmers in self.sorted_chunks():
+            codes, _, n = code_runs(kmers)
+            counts[codes] += n.astype(dtype)
+        self.offsets = np.zeros(4 ** self.k + 1, dtype=dtype)
+        np.cumsum(counts, out=self.offsets[1:])
+        self.positions = np.empty(int(self.offsets[-1]), dtype=dtype)
+        fill = self.offsets[:-1].copy() #next free slot of each code
+        for positions, kmers in self.sorted_chunks():
+            codes, first, n = code_runs(kmers)
+            self.positions[fill[kmers] + np.arange(len(kmers)) - np.repeat(first, n)] = positions
+            fill[codes] += n.astype(dtype)
+
+    @classmethod
+    def from_fasta(cls, reference_fasta, max_mismatches):
+        return cls.from_records(iter_fasta(reference_fasta), max_mismatches)
+
+    # Index of a reference fasta file, or of a packed store (.pack), which is memory-mapped
+    @classmethod
+    def from_path(cls, reference, max_mismatches):
+        return cls(SequenceStore(reference), max_mismatches) if is_store(reference) else cls.from_fasta(reference, max_mismatches)
+
+    # Index of (name, sequence) records, packed in memory
+    @classmethod
+    def from_records(cls, records, max_mismatches):
+        return cls(SequenceStore.from_records(records), max_mismatches)
+
+    # Generator of the indexed reference positions of each chunk of INDEX_CHUNK positions, sorted on their k-mer code, with
+    # the codes, decoded from the store one chunk at a time. A k-mer is indexed unless it holds more than errors unknown
+    # nucleotides or positions outside the store (which never match). k-mers overlapping the end of a sequence are indexed
+    # with the nucleotides next to it, so probes overhanging the end of a sequence are found as well. Unknown nucleotides are
+    # coded as A in the k-mer code.
+    def sorted_chunks(self):
+        low, high = -self.errors, self.size - self.k + self.errors + 1 #k-mer start positions
+        for start in range(low, max(high, low), INDEX_CHUNK):
+            size = min(INDEX_CHUNK, high - start)
+            chunk = self.store.span(start, start + size + self.k - 1)
+            kmers = np.zeros(size, dtype=np.uint32)
+            unknown = np.zeros(size, dtype=np.uint8)
+            for j in range(self.k):
+                window = chunk[j:j + size]
+                kmers = (kmers << 2) | (window & 3)
+                unknown += window == UNKNOWN
+            # Sort the positions on their code as one key, code << 22 | position in the chunk
+            keys = np.sort((kmers.astype(np.uint64) << 22 | np.arange(size, dtype=np.uint64))[unknown <= self.errors])
+            yield (keys & (INDEX_CHUNK - 1)).astype(np.int64) + start, (keys >> 22).astype(np.int64)
+
+    # (query row, reference window) pairs of the queries (2D array of encoded probes) sharing a seed variant with the
+    # reference. A window shares at most one variant per piece with a query, so only the windows close to the query on several
+    # pieces are listed more than once.
+    def candidates(self, queries):
+        seeds = np.zeros((len(queries), self.pieces), dtype=np.int64)
+        for j in range(self.k):
+            seeds = (seeds << 2) | (queries[:, self.piece_starts + j] & 3)
+        variants = (seeds[:, :, None] ^ self.masks).ravel()
+        low = self.offsets[variants]
+        counts = self.offsets[variants + 1] - low
+        found = np.flatnonzero(counts) #most variants are absent from the reference
+        low, counts = low[found].astype(np.int64), counts[found].astype(np.int64)
+        ends = np.cumsum(counts)
+        lookups = np.repeat(np.arange(len(found)), counts)
+        windows = self.positions[np.arange(len(lookups)) + (low - ends + counts)[lookups]] \
+            - self.piece_starts[found[lookups] // len(self.masks) % self.pieces]
+        rows = found[lookups] // (self.pieces * len(self.masks))
+        keep = (windows > -PROBE_SIZE) & (windows < self.size) #windows overlapping the store
+        return rows[keep], windows[keep]
+
+    # (candidate, sequence) pairs of the sequences overlapping each window, as (candidate index, sequence number) arrays
+    def overlapping(self, windows):
+        first = np.maximum(np.searchsorted(self.starts, windows, side="right") - 1, 0)
+        n = np.ones(len(windows), dtype=np.int64)
+        # Only the windows reaching the start of the next sequence overlap several
+        across = np.flatnonzero(windows + PROBE_SIZE > self.next_starts[first])
+        n[across] = np.searchsorted(self.starts, windows[across] + PROBE_SIZE - 1, side="right") - first[across]
+        candidates = np.repeat(np.arange(len(windows)), n)
+        return candidates, first[candidates] + np.arange(len(candidates)) - np.repeat(np.cumsum(n) - n, n)
+
+    # Masks (low bit of each nucleotide pair) of the nucleotides of queries (words and unknown nucleotide masks of query_words)
+    # differing from reference windows, or unknown in the query. The PROBE_SIZE nucleotides of each window are read as one
+    # word of the memory map and compared with an XOR.
+    def differences(self, words, unknown, windows):
+        reference = (self.store.words(windows) >> (2 * (WORD_SIZE - PROBE_SIZE - (windows & 3))).astype(np.uint64)) & WORD_MASK
+        diff = reference ^ words
+        return ((diff | diff >> np.uint64(1)) & LOW_BITS) | unknown
+
+    # Mismatch counts over the full probe length of the differences of windows of the given sequences, adding the unknown
+    # nucleotides of the reference and the positions outside the sequence, which never match
+    def mismatches(self, different, windows, sequences):
+        low = np.clip(self.starts[sequences] - windows, 0, PROBE_SIZE) #nucleotides of the window within the sequence
+        high = np.clip(self.starts[sequences] + self.lengths[sequences] - windows, 0, PROBE_SIZE)
+        outside = LOW_BITS & ~((LOW_BITS >> (2 * low).astype(np.uint64)) & ~(LOW_BITS >> (2 * high).astype(np.uint64)))
+        different = different | outside
+        # Few windows hold unknown nucleotides of the reference, those are looked up per nucleotide
+        rare = np.flatnonzero(self.store.has_unknown(windows, windows + PROBE_SIZE))
+        if len(rare):
+            different[rare] |= unknown_mask(self.store.unknown(windows[rare, None] + np.arange(PROBE_SIZE)))
+        return popcount(different)
+
+    # Reference windows within max_mismatches of the queries (2D array of encoded probes), as (query row, window, sequence,
+    # mismatch count) arrays sorted on query row, window and sequence. The queries are searched QUERY_CHUNK at a time.
+    def search(self, queries):
+        words, unknown = query_words(queries)
+        found = []
+        for first in range(0, len(queries), QUERY_CHUNK):
+            rows, windows = self.candidates(queries[first:first + QUERY_CHUNK])
+            rows += first
+            different = self.differences(words[rows], unknown[rows], windows)
+            # The differences are a lower bound of the mismatches, which rules out most candidates before the sequences
+            close = np.flatnonzero(popcount(different) <= self.max_mismatches)
+            candidates, sequences = self.overlapping(windows[close])
+            rows, windows, different = rows[close][candidates], windows[close][candidates], different[close][candidates]
+            mismatches = self.mismatches(different, windows, sequences)
+            keep = mismatches <= self.max_mismatches
+            rows, windows, sequences, mismatches = rows[keep], windows[keep], sequences[keep], mismatches[keep]
+            # Hits found through several pieces are kept once
+            order = np.lexsort((sequences, windows, rows))
+            rows, windows, sequences, mismatches = rows[order], windows[order], sequences[order], mismatches[order]
+            unique = np.ones(len(rows), dtype=bool)
+            unique[1:] = (np.diff(rows) != 0) | (np.diff(windows) != 0) | (np.diff(sequences) != 0)
+            found.append((rows[unique], windows[unique], sequences[unique], mismatches[unique]))
+        if not found:
+            return tuple(np.empty(0, dtype=np.int64) for _ in range(4))
+        return tuple(np.concatenate(arrays) for arrays in zip(*found))
+
+
+# Search (probe ID, sequence) records on both strands, returning the hits as a DataFrame with the trimmed BLAST output columns
+def search_probes(probes, index):
+    probe_ids, forward = [], []
+    for probe_id, sequence in probes:
+        probe = encode(sequence)
+        if len(probe) == PROBE_SIZE:
+            probe_ids.append(probe_id)
+            forward.append(probe)
+    forward = np.array(forward, dtype=np.uint8).reshape(-1, PROBE_SIZE)
+    reverse = np.where(forward == UNKNOWN, UNKNOWN, 3 - forward)[:, ::-1] #reverse complement
+    # Query 2i is probe i, query 2i + 1 its reverse complement, which aligns to the minus strand of the reference
+    rows, windows, sequence, n_corrected = index.search(np.stack([forward, reverse], axis=1).reshape(-1, PROBE_SIZE))
+
+    # Aligned part of the probe: the window nucleotides within the sequence
+    first = np.maximum(windows, index.starts[sequence])
+    last = np.minimum(windows + PROBE_SIZE, index.starts[sequence] + index.lengths[sequence]) - 1
+    alignment_length = last - first + 1
+    n_mismatches = n_corrected - (PROBE_SIZE - alignment_length)
+    qstart, qend = first - windows + 1, last - windows + 1
+    sstart, send = first - index.starts[sequence] + 1, last - index.starts[sequence] + 1
+    minus = rows % 2 == 1
+    qstart, qend = np.where(minus, PROBE_SIZE - qend + 1, qstart), np.where(minus, PROBE_SIZE - qstart + 1, qend)
+    sstart, send = np.where(minus, send, sstart), np.where(minus, sstart, send)
+
+    hits = pd.DataFrame({
+        "probe_id": np.array(probe_ids, dtype=object)[rows // 2],
+        "transcript_id": np.array(index.names, dtype=object)[sequence],
+        "qstart": qstart,
+        "qend": qend,
+        "sstart": sstart,
+        "send": send,
+        "percentage_ident": [round(100.0 * (length - mismatches) / length, 3) for length, mismatches in zip(alignment_length.tolist(), n_mismatches.tolist())],
+        "n_mismatches": n_mismatches,
+        "n_corrected_mismatches": n_corrected,
+        "alignment_length": alignment_length,
+    })
+    hits['gene_id'] = hits['transcript_id'].astype(str).str.split('.').str[0]
+    # Keep the best hit of a probe per gene, as parse_blast_output.py does
+    hits = hits.sort_values(["probe_id", "gene_id", "n_corrected_mismatches"], kind="stable")
+    hits = hits.drop_duplicates(subset=['probe_id', 'gene_id'], keep='first')
+    hits = hits.sort_values(["probe_id", "n_corrected_mismatches"], kind="stable")
+    return hits[COLUMNS]
+
+# Compare two trimmed off-target tables on their (probe, gene) pairs
+def compare(kmer_hits, blast_hits_file):
+    blast_hits = pd.read_csv(blast_hits_file, sep=' ')
+    kmer_pairs = set(zip(kmer_hits['probe_id'], kmer_hits['gene_id'].astype(str)))
+    blast_pairs = set(zip(blast_hits['probe_id'], blast_hits['gene_id'].astype(str)))
+    print(f"(probe, gene) hits found by both engines: {len(kmer_pairs & blast_pairs)}")
+    print(f"(probe, gene) hits found by BLAST only: {len(blast_pairs - kmer_pairs)}")
+    print(f"(probe, gene) hits found by the k-mer index only: {len(kmer_pairs - blast_pairs)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Off-target search of the probe hybridising parts with a k-mer seed index.")
+    parser.add_argument("probes_fasta", help="Fasta file of the LHS and RHS hybridising sequences.")
+    parser.add_argument("reference_fasta", help="Reference fasta file, e.g. CDS_all.fa, or its packed store, e.g. CDS_all.pack")
+    parser.add_argument("output_file", help="Trimmed off-target table.")
+    parser.add_argument("--max-mismatches", type=int, default=5, help="Maximum number of mismatches of a reported hit.")
+    parser.add_argument("--compare", help="Trimmed BLAST off-target table to compare the hits with.")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    index = KmerIndex.from_path(args.reference_fasta, args.max_mismatches)
+    indexed = time.perf_counter()
+    hits = search_probes(iter_fasta(args.probes_fasta), index)
+    hits.to_csv(args.output_file, sep=" ", index=False, header=True)
+    print(f"Indexed {len(index.names)} reference sequences in {indexed - started:.1f} s, "
+          f"found {len(hits)} hits in {time.perf_counter() - indexed:.1f} s", file=sys.stderr)
+    if args.compare:
+        compare(hits, args.compare)
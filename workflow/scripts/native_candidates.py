@@ -0,0 +1,158 @@
+"""
+Snakemake pipeline.
+
+In-process candidate generator, used instead of primer3 when engine is set to "native" in config.yaml.
+
+Input:
+- the CDS fasta file CDS_gene_targets.fa, with headers formatted as for primer3_input_design.py
+
+Output:
+- the same probe table as generate_probe_pairs.read_table() builds from the primer3 output, without writing
+  primer3_input_snakemake.txt or parsing primer3_output.txt
+
+Each CDS is encoded as a NumPy byte array and every 25 nt window is evaluated at once:
+- GC content of the LHS and of the RHS window (cumulative sums)
+- number of unknown nucleotides (cumulative sums)
+- mononucleotide repeats longer than max_poly_x (run detection on equal neighbouring bases)
+- melting temperature of the LHS, computed as primer3 does (nearest-neighbour parameters of SantaLucia 1998 with its salt
+  correction, primer3's default concentrations), within primer3's default range of 57-63 C
+
+The windows are then ranked as primer3 ranks its right primers with the settings of primer3_input_design.py: on the
+distance of their Tm to primer3's default optimum of 60 C, then on their position. The best num_return windows are kept,
+and only then those whose LHS ends at a T (the template base at the start of the window is an A), with the RHS on the
+template and within the GC range, as generate_probe_pairs.py keeps them from the primer3 output. The candidates of both
+engines are therefore mostly the same. They differ for windows that primer3 rejects for self-complementarity or hairpins
+(thermodynamic alignments, not computed here). They also differ for windows with unknown nucleotides: primer3 gives those
+a Tm of its own, while here they are left out. The candidates of both engines can be compared with:
+
+$ python3 native_candidates.py CDS_gene_targets.fa primer3_output.txt
+
+"""
+
+import sys
+import math
+import numpy as np
+
+import generate_probe_pairs
+from design_config import load_config, params_key, gc_range
+from probe_table import ProbeTable, COMPLEMENT
+from primer3_input_design import iter_targets
+
+PROBE_SIZE = 25 #length of each hybridising probe side
+ACGT = np.frombuffer(b"ACGT", dtype=np.uint8)
+CODES = np.full(256, 4, dtype=np.uint8) #codes 0-3 of ACGT, 4 for unknown nucleotides
+CODES[ACGT] = np.arange(4)
+
+# primer3 defaults of the settings primer3_input_design.py leaves unset: Tm range and optimum of the right primers (the
+# LHS), salt and oligo concentrations of the Tm
+PRIMER3_MIN_TM, PRIMER3_OPT_TM, PRIMER3_MAX_TM = 57.0, 60.0, 63.0
+PRIMER3_SALT = 50.0 + 120.0 * math.sqrt(1.5 - 0.6) #mM: 50 mM monovalent, and 1.5 mM divalent less 0.6 mM dNTP as monovalent
+PRIMER3_DNA_CONC = 50.0 #nM
+# SantaLucia 1998 nearest-neighbour enthalpies (100 cal/mol) and entropies (0.1 cal/K/mol) of the step from the first base
+# (row, ACGT) to the second (column), in integers as in primer3 so that the window sums are exact
+NN_DH = np.array([[-79, -84, -78, -72], [-85, -80, -106, -78], [-82, -98, -80, -84], [-72, -82, -85, -79]], dtype=np.int64)
+NN_DS = np.array([[-222, -224, -210, -204], [-227, -199, -272, -210], [-222, -244, -199, -224], [-213, -222, -227, -222]], dtype=np.int64)
+
+# Sum of each window of length w over a 1D array
+def window_sum(values, w):
+    cumsum = np.concatenate(([0], np.cumsum(values, dtype=np.int64)))
+    return cumsum[w:] - cumsum[:-w]
+
+# Melting temperature (C) of every window of PROBE_SIZE nucleotides of an encoded template (CODES), as primer3 computes it;
+# NaN for windows with unknown nucleotides
+def window_tm(codes, n_windows):
+    known = codes < 4
+    steps = np.where(known[:-1] & known[1:], codes[:-1].astype(np.int64) * 4 + codes[1:], 0)
+    dh = window_sum(NN_DH.ravel()[steps], PROBE_SIZE - 1)[:n_windows]
+    ds = window_sum(NN_DS.ravel()[steps], PROBE_SIZE - 1)[:n_windows]
+    # Initiation with a terminal A/T (23, 41) or G/C (1, -28) base pair, at both ends
+    for end in (codes[:n_windows], codes[PROBE_SIZE - 1:PROBE_SIZE - 1 + n_windows]):
+        at = (end == 0) | (end == 3)
+        dh = dh + np.where(at, 23, 1)
+        ds = ds + np.where(at, 41, -28)
+    entropy = ds * 0.1 + 0.368 * (PROBE_SIZE - 1) * math.log(PRIMER3_SALT / 1000.0)
+    tm = dh * 100.0 / (entropy + 1.987 * math.log(PRIMER3_DNA_CONC / 4e9)) - 273.15
+    return np.where(window_sum(~known, PROBE_SIZE)[:n_windows] == 0, tm, np.nan)
+
+# Return the template start indices and GC percentages of the LHS windows passing the design constraints, within the
+# shared segments of a collapsed isoform representative when given (isoform_regions.py)
+def scan_template(template, config, segments=None):
+    seq = np.frombuffer(template.encode("ascii"), dtype=np.uint8)
+    n_windows = len(seq) - PROBE_SIZE + 1
+    if n_windows <= PROBE_SIZE: #the template has to fit both probe sides
+        return np.empty(0, dtype=np.int64), np.empty(0)
+
+    gc = window_sum((seq == ord("G")) | (seq == ord("C")), PROBE_SIZE) * 100.0 / PROBE_SIZE
+    ns = window_sum(~np.isin(seq, ACGT), PROBE_SIZE)
+
+    # A repeat longer than max_poly_x starts at i if seq[i..i+max_poly_x] are all identical
+    max_poly_x = config["max_poly_x"]
+    if max_poly_x < PROBE_SIZE:
+        repeat_start = window_sum(seq[1:] == seq[:-1], max_poly_x) == max_poly_x
+        poly_x = window_sum(repeat_start, PROBE_SIZE - max_poly_x) > 0
+    else:
+        poly_x = np.zeros(n_windows, dtype=bool)
+
+    starts = np.arange(n_windows)
+    rhs_gc = np.zeros(n_windows)
+    rhs_gc[PROBE_SIZE:] = gc[:-PROBE_SIZE] #the RHS covers the 25 nt before the LHS window
+    tm = window_tm(CODES[seq], n_windows)
+
+    # Right primers primer3 may return
+    mask = (
+        (ns <= config["max_ns_accepted"])
+        & ~poly_x
+        & (gc >= config["min_gc"]) & (gc <= config["max_gc"])
+        & (tm >= PRIMER3_MIN_TM) & (tm <= PRIMER3_MAX_TM) #NaN fails
+    )
+    if segments is not None:
+        from isoform_regions import window_mask
+        mask &= window_mask(starts - PROBE_SIZE, segments) #the probe pair starts with the RHS, PROBE_SIZE nt before the LHS
+    starts = starts[mask]
+
+    # The num_return best, as primer3 returns them: smallest Tm deviation, then 5' end of the right primer
+    if len(starts) > config["num_return"]:
+        keep = np.lexsort((starts, np.abs(tm[starts] - PRIMER3_OPT_TM)))[:config["num_return"]]
+        starts = np.sort(starts[keep])
+
+    # Constraints of the probe pair, as generate_probe_pairs.py applies them to the primer3 output
+    starts = starts[
+        (starts >= PROBE_SIZE) #RHS must not fall off the template
+        & (seq[starts] == ord("A")) #LHS ends at a T
+        & (rhs_gc[starts] >= config["min_gc"]) & (rhs_gc[starts] <= config["max_gc"])
+    ]
+    return starts, gc[starts]
+
+# Generator yielding one (sequence ID, template, LHS start sites, LHS hybridising sequences, LHS GC percentages) record per
+# (sequence ID, template) target, as generate_probe_pairs.iter_records does for the primer3 output. regions: shared regions
+# of the collapsed isoforms (isoform_regions.read_regions)
+def iter_records(targets, config, regions=None):
+    for target_id, template in targets:
+        starts, gc = scan_template(template, config, (regions or {}).get(target_id))
+        template_bytes = np.frombuffer(template.encode("ascii"), dtype=np.uint8)
+        windows = template_bytes[starts[:, None] + np.arange(PROBE_SIZE)]
+        lhs = np.ascontiguousarray(COMPLEMENT[windows][:, ::-1]).view(f"S{PROBE_SIZE}").ravel() #reverse complement of the windows
+        yield target_id, template, starts + PROBE_SIZE - 1, lhs, gc #primer3 reports the 5' end of a right primer
+
+# Build the probe table of (sequence ID, template) targets
+def table_from_targets(targets, config, regions=None):
+    return ProbeTable.from_records(iter_records(targets, config, regions), params_key(config), gc_range(config))
+
+# Read the CDS fasta file into a probe table
+def read_table(genes_of_interest, config=None, regions=None):
+    return table_from_targets(iter_targets(genes_of_interest), config or load_config(), regions)
+
+# Compare the native candidates with the candidates parsed from a primer3 output file
+def compare(genes_of_interest, primer3_output_file, config=None):
+    native = {sequence.ID: {probe.START for probe in sequence.PROBES} for sequence in read_table(genes_of_interest, config).sequences()}
+    print("sequence_id\tshared\tprimer3_only\tnative_only")
+    for sequence in generate_probe_pairs.iter_sequences(primer3_output_file):
+        primer3_starts = {probe.START for probe in sequence.PROBES}
+        native_starts = native.get(sequence.ID, set())
+        print(f"{sequence.ID}\t{len(primer3_starts & native_starts)}\t{len(primer3_starts - native_starts)}\t{len(native_starts - primer3_starts)}")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        raise ValueError("Usage: python3 native_candidates.py CDS_gene_targets.fa primer3_output.txt")
+    compare(sys.argv[1], sys.argv[2])
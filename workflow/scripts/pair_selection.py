@@ -0,0 +1,131 @@
+"""
+Snakemake pipeline.
+
+Optimal selection of the final probe pairs of every sequence, used by select_probe_pairs.py after the specificity and
+homopolymer filters.
+
+Two probe pairs of a sequence overlap when the first one (in start order) starts less than min_spacing nucleotides before
+the end of the next one (START + min_spacing > next END). Per sequence, the selection keeps:
+    - as many non-overlapping probe pairs as possible, up to max_pairs
+    - among those, the set with the highest total score
+
+This is weighted interval scheduling with a cardinality limit. The probe pairs are sorted on their start, the last compatible
+pair before each one is found by binary search, and a dynamic programme over (number of pairs, prefix of probes) finds the
+optimum in O(n log n + max_pairs * n) per sequence. The sequences are independent and are solved in a process pool.
+
+The score of a probe pair is the sum of the scores listed in selection_score (config.yaml), each between 0 and 1:
+    - upstream: closeness of the probe to the 5' end of the template, the order in which probes were kept before
+    - gc: closeness of the LHS and RHS GC content to the middle of the GC range
+    - specificity: corrected mismatches of the closest off-target hit of each probe side (6 or more: no off-target hit)
+Scores are registered in SCORES, new ones take the probe table, the trimmed hits and the configuration.
+
+"""
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+MAX_MISMATCHES = 5 #hits with more corrected mismatches are not reported by the off-target search
+
+
+# Score the probe pairs on their distance to the 5' end of the template
+def upstream_score(table, hits, config):
+    lengths = np.array([len(template) for template in table.templates], dtype=np.float64)
+    return 1.0 - table.probes["start"] / np.maximum(lengths[table.probes["gene"]], 1.0)
+
+# Score the probe pairs on the distance of their GC content to the middle of the GC range
+def gc_score(table, hits, config):
+    optimum = (config["min_gc"] + config["max_gc"]) / 2
+    half_range = max((config["max_gc"] - config["min_gc"]) / 2, 1.0)
+    distance = (np.abs(table.probes["lhs_gc"] - optimum) + np.abs(table.probes["rhs_gc"] - optimum)) / 2
+    return np.clip(1.0 - distance / half_range, 0.0, 1.0)
+
+# Score the probe pairs on the mismatches of the closest off-target hit of each side. The best hit of a probe side is its
+# target, the next one its closest off-target hit.
+def specificity_score(table, hits, config):
+    ranked = hits.sort_values(["probe_id", "n_corrected_mismatches"], kind="stable")
+    second = ranked[ranked['probe_id'].duplicated(keep='first')].drop_duplicates(subset=['probe_id'], keep='first')
+    margins = []
+    for side in ("LHS", "RHS"):
+        margin = np.full(len(table), MAX_MISMATCHES + 1, dtype=np.float64)
+        for mismatches in sorted(second['n_corrected_mismatches'].unique(), reverse=True):
+            margin[table.id_mask(second.loc[second['n_corrected_mismatches'] == mismatches, 'probe_id'], side)] = mismatches
+        margins.append(margin)
+    return (margins[0] + margins[1]) / (2 * (MAX_MISMATCHES + 1))
+
+SCORES = {
+    "upstream": upstream_score,
+    "gc": gc_score,
+    "specificity": specificity_score,
+}
+
+
+# Total score of every probe pair of the table
+def score(table, hits, config):
+    names = config["selection_score"]
+    if isinstance(names, str):
+        names = [names]
+    unknown = [name for name in names if name not in SCORES]
+    if unknown:
+        raise ValueError(f"Unknown selection_score {unknown}, choose from {sorted(SCORES)}")
+    weights = np.zeros(len(table), dtype=np.float64)
+    for name in names:
+        weights += SCORES[name](table, hits, config)
+    return weights
+
+# Positions (in start order) of the best set of at most max_pairs non-overlapping probe pairs of one sequence
+def select_sequence(starts, ends, weights, max_pairs, min_spacing):
+    n = len(starts)
+    if n == 0 or max_pairs <= 0:
+        return np.empty(0, dtype=np.int64)
+    order = np.argsort(starts, kind="stable")
+    starts, ends, weights = starts[order], ends[order], weights[order]
+    # Number of probe pairs, in start order, compatible with (i.e. before and far enough from) each probe pair
+    compatible = np.minimum(np.searchsorted(starts, ends - min_spacing, side="right"), np.arange(n))
+
+    # best[j][m]: highest total score of exactly j pairs among the first m; choice[j][m-1]: last pair of that set
+    best = [np.zeros(n + 1)]
+    choices = [None]
+    for j in range(1, max_pairs + 1):
+        candidate = best[j - 1][compatible] + weights
+        running = np.maximum.accumulate(candidate)
+        improved = np.concatenate(([True], candidate[1:] > running[:-1]))
+        choices.append(np.maximum.accumulate(np.where(improved, np.arange(n), 0)))
+        best.append(np.concatenate(([-np.inf], running)))
+        if not np.isfinite(running[-1]):
+            break
+
+    # Largest feasible number of pairs, then backtrack through the choices
+    pairs = max(j for j in range(len(best)) if np.isfinite(best[j][n]))
+    selected = []
+    prefix = n
+    for j in range(pairs, 0, -1):
+        last = choices[j][prefix - 1]
+        selected.append(last)
+        prefix = compatible[last]
+    return np.sort(order[np.array(selected, dtype=np.int64)])
+
+def select_chunk(blocks, max_pairs, min_spacing):
+    return [select_sequence(starts, ends, weights, max_pairs, min_spacing) for starts, ends, weights in blocks]
+
+# Boolean mask of the selected probe pairs of the table
+def select_pairs(table, hits, config, processes=1):
+    weights = score(table, hits, config)
+    starts = table.probes["start"].astype(np.int64)
+    ends = table.probes["end"].astype(np.int64)
+    offsets = table.gene_offsets()
+    blocks = [(starts[a:b], ends[a:b], weights[a:b]) for a, b in zip(offsets[:-1], offsets[1:])]
+    max_pairs, min_spacing = int(config["max_pairs"]), int(config["min_spacing"])
+
+    if processes > 1 and len(blocks) > 1:
+        # Send the sequences to the workers in contiguous chunks, a few per worker to balance the load
+        size = -(-len(blocks) // (4 * processes))
+        chunks = [blocks[i:i + size] for i in range(0, len(blocks), size)]
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            results = [rows for chunk in executor.map(select_chunk, chunks, [max_pairs] * len(chunks), [min_spacing] * len(chunks)) for rows in chunk]
+    else:
+        results = select_chunk(blocks, max_pairs, min_spacing)
+
+    keep = np.zeros(len(table), dtype=bool)
+    for offset, rows in zip(offsets[:-1], results):
+        keep[offset + rows] = True
+    return keep
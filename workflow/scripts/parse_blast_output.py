@@ -2,60 +2,107 @@
 Snakemake pipeline. Author: Sofia Rouot.
 
 Since BLAST performs local alignment, the output includes matches which are not the full query length
-    - The matches which are less than 20 nucleotides long are deleted. 
-    - For the matches which are between 20 and 24 nucleotides, we correct the number of mismatches to represent full query alignment. 
-    - The new column "n_corrected_mismatches" represents the amount of mismatches for full query alignment. 
+    - The matches which are less than 20 nucleotides long are deleted.
+    - For the matches which are between 20 and 24 nucleotides, we correct the number of mismatches to represent full query alignment.
+    - The new column "n_corrected_mismatches" represents the amount of mismatches for full query alignment.
 
-The script also removes duplicate hits of a probe against multiple transcript variants of the same gene. This would occur when using a transcriptome database, for instance. The hit with the highest percentage identity score to the probe is kept.
+The script also removes duplicate hits of a probe against multiple transcript variants of the same gene. This would occur when using a transcriptome database, for instance. The hit with the lowest number of corrected mismatches to the probe is kept.
 
 Hits with over 6 mistmatches are removed, as these do not represent potential off-target hybridisation events. Over 6 mismatches is considered as enough to prevent off-target hybridisation.
 
-"""
-
-import pandas as pd
-
-# Read blast output as pandas dataframe 
-df = pd.read_csv("probes_hybparts_off_targets.txt", 
-                 sep = "\t",
-                 names = ["probe_id", "transcript_id", "qstart", "qend", "sstart", "send", "percentage_ident", "n_mismatches"]) 
-
-# Add a column for the corrected mismatches, 20 is an arbitrary number
-df['n_corrected_mismatches'] = "20"
-
-# Convert transcript_id column to string and split to extract gene_id
-df['gene_id'] = df['transcript_id'].astype(str).str.split('.').str[0]
-
-# Remove duplicate combinations of probe_id and gene_id.
-df = df.sort_values(["probe_id", "gene_id", "n_mismatches"]) #sort first on probe_id, then gene_id and then percentage identity
-# Drop duplicates based on probe_id and gene_id, keeping the first occurrence
-df = df.drop_duplicates(subset=['probe_id', 'gene_id'], keep='first').reset_index(drop=True)
-
+The BLAST output (outfmt "6 qseqid sseqid qstart qend sstart send pident mismatch") is read as a stream of chunks, from a file or
+from stdin ("-"), so blastn can be piped straight into the script. The length and mismatch filters are applied to every chunk
+before grouping, and only the best hit per (probe, gene) is kept in memory.
 
-# Trim blast output to only contain full length alignments
-# Calculate the alignment length column
-df['alignment_length'] = df['qend'] - df['qstart'] + 1
+Commands in Snakefile rules:
+$ blastn ... -outfmt "6 ..." | python3 parse_blast_output.py - blast_shards/trimmed_0.txt
+$ python3 parse_blast_output.py --merge blast_shards/trimmed_0.txt ... blast_shards/trimmed_N.txt trimmed_probes_hybparts_off_targets.txt
 
-# Filter out rows where the alignment length is less than 20 nucleotides
-df = df[df['alignment_length'] >= 20]
+or on a complete BLAST output:
+$ python3 parse_blast_output.py probes_hybparts_off_targets.txt trimmed_probes_hybparts_off_targets.txt
 
-# Calculate the corrected mismatches for alignments between 20 and 24 nucleotides
-mask_20_24 = (df['alignment_length'] >= 20) & (df['alignment_length'] <= 24)
-df.loc[mask_20_24, 'n_corrected_mismatches'] = df['n_mismatches'] + (25 - df['alignment_length'])
-
-# For alignments of exactly 25 nucleotides, the corrected mismatches are the same as 'n_mismatches'
-df.loc[df['alignment_length'] == 25, 'n_corrected_mismatches'] = df['n_mismatches']
-
-# Check for alignments longer than 25 nucleotides and raise an error or handle it
-if (df['alignment_length'] > 25).any():
-    print("Error: Probe is longer than 25 nucleotides")
-
-
-# With the corrected mismatch score, delete hits which have more than 5 mismatches. 
-df = df[df['n_corrected_mismatches'] < 6]
-
-# Sort dataframe
-df = df.sort_values(["probe_id", "n_corrected_mismatches"]) #sort form high to low corrected percentage identity 
+"""
 
-# Export datafarme to csv 
-df.to_csv("trimmed_probes_hybparts_off_targets.txt", sep=" ", index=False, header=True)
+import sys
+import argparse
+import pandas as pd
 
+PROBE_SIZE = 25 #length of the hybridising probe sides
+MIN_ALIGNMENT_LENGTH = 20 #shorter alignments are deleted
+MAX_CORRECTED_MISMATCHES = 5 #hits with more mismatches do not hybridise
+CHUNK_SIZE = 1_000_000 #BLAST output lines read at once
+
+BLAST_COLUMNS = ["probe_id", "transcript_id", "qstart", "qend", "sstart", "send", "percentage_ident", "n_mismatches"]
+BLAST_DTYPES = {"probe_id": str, "transcript_id": str, "qstart": "int16", "qend": "int16", "sstart": "int32", "send": "int32",
+                "percentage_ident": "float32", "n_mismatches": "int16"}
+COLUMNS = BLAST_COLUMNS + ["n_corrected_mismatches", "gene_id", "alignment_length"]
+
+
+# Generator yielding the BLAST output in chunks of DataFrames with compact dtypes, nothing for an empty input
+def read_chunks(blast_output, chunk_size=CHUNK_SIZE):
+    try:
+        yield from pd.read_csv(blast_output, sep="\t", names=BLAST_COLUMNS, dtype=BLAST_DTYPES, chunksize=chunk_size)
+    except pd.errors.EmptyDataError: #e.g. an empty query shard
+        return
+
+# Filter one chunk of hits on the alignment length and the corrected mismatches
+def trim_chunk(df):
+    # Trim blast output to only contain full length alignments
+    alignment_length = (df['qend'] - df['qstart'] + 1).astype("int16")
+    if (alignment_length > PROBE_SIZE).any():
+        print("Error: Probe is longer than 25 nucleotides", file=sys.stderr)
+    keep = (alignment_length >= MIN_ALIGNMENT_LENGTH) & (alignment_length <= PROBE_SIZE)
+    df = df[keep].assign(alignment_length=alignment_length[keep])
+
+    # Correct the mismatches of alignments shorter than 25 nucleotides to represent full query alignment
+    corrected = df['n_mismatches'] + (PROBE_SIZE - df['alignment_length'])
+    df = df.assign(n_corrected_mismatches=corrected.astype("int16"))
+    df = df[df['n_corrected_mismatches'] <= MAX_CORRECTED_MISMATCHES]
+
+    # Split transcript_id to extract gene_id
+    return df.assign(gene_id=df['transcript_id'].str.split('.').str[0])
+
+# Keep the hit with the fewest corrected mismatches per (probe_id, gene_id), the first one in input order on ties
+def best_hits(df):
+    df = df.sort_values(["probe_id", "gene_id", "n_corrected_mismatches"], kind="stable")
+    return df.drop_duplicates(subset=['probe_id', 'gene_id'], keep='first')
+
+# Stream the BLAST output, keeping only the best surviving hit per (probe_id, gene_id)
+def trim(blast_output, chunk_size=CHUNK_SIZE):
+    best = pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in BLAST_DTYPES.items()})
+    best = trim_chunk(best)
+    for chunk in read_chunks(blast_output, chunk_size):
+        chunk = trim_chunk(chunk)
+        if len(chunk):
+            best = best_hits(pd.concat([best, best_hits(chunk)], ignore_index=True))
+    return best[COLUMNS]
+
+# Sort the hits from low to high corrected mismatches per probe
+def sort_hits(df):
+    return df.sort_values(["probe_id", "n_corrected_mismatches", "gene_id"], kind="stable")
+
+# Sort the hits and export them
+def write_hits(df, output_file):
+    sort_hits(df).to_csv(output_file, sep=" ", index=False, header=True)
+
+# Merge trimmed hit tables of disjoint probe sets, e.g. of the BLAST query shards
+def merge(trimmed_files, output_file):
+    tables = [pd.read_csv(trimmed_file, sep=" ", dtype={"probe_id": str, "transcript_id": str, "gene_id": str})
+              for trimmed_file in trimmed_files]
+    write_hits(pd.concat(tables, ignore_index=True)[COLUMNS], output_file)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Trim the BLAST hits of the probe hybridising parts to potential off-target hybridisation events.")
+    parser.add_argument("inputs", nargs="+", help="BLAST outfmt 6 output (- for stdin), or trimmed tables with --merge.")
+    parser.add_argument("output_file", help="Trimmed off-target table.")
+    parser.add_argument("--merge", action="store_true", help="Merge trimmed tables of disjoint probe sets instead of trimming.")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="Number of BLAST output lines read at once.")
+    args = parser.parse_args()
+
+    if args.merge:
+        merge(args.inputs, args.output_file)
+    elif len(args.inputs) == 1:
+        write_hits(trim(sys.stdin if args.inputs[0] == "-" else args.inputs[0], args.chunk_size), args.output_file)
+    else:
+        parser.error("a single BLAST output is trimmed at once, use --merge to combine trimmed tables")
@@ -17,58 +17,95 @@ Note: The headers can contain additional information for the user's own use.
 
 
 Command in Snakefile rule:
-$ python3 primer3_input_design.py CDS_gene_targets.fa 
+$ python3 primer3_input_design.py CDS_gene_targets.fa primer3_input_snakemake.txt [--cache design_cache.sqlite] [--shared-regions isoform_regions.tsv]
 
 Output:
 - primer3_input_snakemake.txt. A txt file containing primer3 instructions.
 The sequence ID in the primer3 input file is a "_" separated ID of gene ID, gene name and transcript ID.
+The records are written in the order of the fasta file, straight from the fasta parser. The primer3 settings (GC bounds, 
+poly-X, number of probes to return, from config.yaml) are global tags: they are written once, in the first record, and 
+primer3 keeps them for all following records.
 
 """
 
 # Load packages  
 import sys
-import pandas as pd
+import argparse
 from Bio import SeqIO 
+from design_config import load_config, params_key
+from probe_table import HYB_SIZE
 
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        raise ValueError("Usage: python primer3_input_design.py CDS_gene_targets.fa")
+# Build the "_" separated sequence ID (gene ID, gene name, transcript ID) from a formatted FASTA header
+def sequence_id(description):
+    fields = description.split(" ")
+    gene_id = fields[0].split(":")[1]
+    gene_name = fields[1].split(":")[1]
+    transcript_id = fields[2].split(":")[1]
+    return gene_id + "_" + gene_name + "_" + transcript_id
 
-    genes_of_interest = sys.argv[1]
+# Generator of (sequence ID, template) pairs of the target fasta file
+def iter_targets(genes_of_interest):
+    for record in SeqIO.parse(genes_of_interest, "fasta"):
+        yield sequence_id(record.description), str(record.seq).upper()
 
+# primer3 global settings, as tags and values (also passed to the primer3 Python bindings by probest.py)
+def global_args(config):
+    return {
+        'PRIMER_PICK_LEFT_PRIMER': 0, #indicate creation of left side probes (identical to CDS)
+        'PRIMER_PICK_INTERNAL_OLIGO': 0, #indicate creation of interal hybridising probes 
+        'PRIMER_PICK_RIGHT_PRIMER': 1, #indicate creation of right side probes (reverse complement to CDS) 
+        'PRIMER_MIN_SIZE': HYB_SIZE, #probe size, fixed by the probe chemistry
+        'PRIMER_OPT_SIZE': HYB_SIZE, #probe size
+        'PRIMER_MAX_SIZE': HYB_SIZE, #probe size
+        'PRIMER_MAX_NS_ACCEPTED': config["max_ns_accepted"], #max number of unknown nucleotides 
+        'PRIMER_MIN_GC': config["min_gc"], #minimum GC percentage
+        'PRIMER_MAX_GC': config["max_gc"], #maximum GC percentage
+        'PRIMER_MAX_POLY_X': config["max_poly_x"], #maximum length of mononucleotide repeats
+        'PRIMER_NUM_RETURN': config["num_return"], #number of primers to return
+        'PRIMER_EXPLAIN_FLAG': 1, #get statistics of primer
+    }
 
-    try:
-        #Extract header and sequence information
-        seq_df = pd.DataFrame(columns = ["Sequence", "gene_id", "gene_name", "transcript_id"])
-        for record in SeqIO.parse(genes_of_interest, "fasta"):
-            Sequence = str(record.seq)
-            gene_id = record.description.split(" ")[0]
-            gene_id = gene_id.split(":")[1]
-            gene_name = record.description.split(" ")[1]
-            gene_name = gene_name.split(":")[1]
-            transcript_id = record.description.split(" ")[2]
-            transcript_id = transcript_id.split(":")[1]
-            df_temp = pd.DataFrame({"Sequence": Sequence, "gene_id": gene_id, "gene_name": gene_name, "transcript_id": transcript_id}, index = [0])
-            seq_df = pd.concat([df_temp, seq_df.loc[:]]).reset_index(drop=True)
+# primer3 global settings, written once in the first record
+def global_settings(config):
+    return "".join(f"{tag}={value}\n" for tag, value in global_args(config).items())
 
-        # Write primer3 input file
-        output_file = "primer3_input_snakemake.txt"
-        with open(output_file, 'w') as f:
-            for index, row in seq_df.iterrows():
-                f.write('SEQUENCE_ID=' + row['gene_id'] + "_" + row['gene_name'] + "_" + row['transcript_id'] + '\n' + 'SEQUENCE_TEMPLATE=' + row['Sequence'] + '\n')
-                f.write('PRIMER_PICK_LEFT_PRIMER=0' + '\n') #indicate creation of left side probes (identical to CDS)
-                f.write('PRIMER_PICK_INTERNAL_OLIGO=0' + '\n') #indicate creation of interal hybridising probes 
-                f.write('PRIMER_PICK_RIGHT_PRIMER=1' + '\n') #indicate creation of right side probes (reverse complement to CDS) 
-                f.write('PRIMER_MIN_SIZE=25' + '\n') #probe size
-                f.write('PRIMER_OPT_SIZE=25' + '\n') #probe size
-                f.write('PRIMER_MAX_SIZE=25' + '\n') #probe size
-                f.write('PRIMER_MAX_NS_ACCEPTED=1' + '\n') #max number of unknown nucleotides 
-                f.write('PRIMER_RIGHT_MIN_GC=44' + '\n') #minimum GC percentage
-                f.write('PRIMER_RIGHT_MAX_GC=72' + '\n') #maximum GC percentage
-                f.write('PRIMER_RIGHT_MAX_POLY_X=5' + '\n') #maximum length of mononucleotide repeats
-                f.write('PRIMER_NUM_RETURN=100' + '\n') #number of primers to return
-                f.write('PRIMER_EXPLAIN_FLAG=1' + '\n') #get statistics of primer
-                f.write('=' + '\n') #indicate end of parameters
+# Write the primer3 input file, one record per (sequence ID, template) target. With the shared regions of collapsed isoforms
+# (isoform_regions.py), the LHS of their representatives is kept out of the regions not shared by the isoforms.
+def write_primer3_input(targets, output_file, config, regions=None):
+    if regions:
+        from isoform_regions import excluded_regions
+    with open(output_file, 'w') as f:
+        settings = global_settings(config)
+        for target_id, template in targets:
+            f.write('SEQUENCE_ID=' + target_id + '\n' + 'SEQUENCE_TEMPLATE=' + template + '\n')
+            if regions and target_id in regions:
+                excluded = excluded_regions(len(template), regions[target_id])
+                f.write('SEQUENCE_EXCLUDED_REGION=' + ' '.join(f"{start},{length}" for start, length in excluded) + '\n')
+            f.write(settings) #only in the first record
+            settings = ''
+            f.write('=' + '\n') #indicate end of parameters
 
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write the primer3 input file for the CDS sequences of interest.")
+    parser.add_argument("genes_of_interest", help="CDS fasta file, e.g. CDS_gene_targets.fa")
+    parser.add_argument("output_file", help="primer3 input file, e.g. primer3_input_snakemake.txt")
+    parser.add_argument("--cache", help="Design cache file. Sequences with cached candidates are left out.")
+    parser.add_argument("--shared-regions", help="Shared regions of the collapsed isoforms, e.g. isoform_regions.tsv")
+    args = parser.parse_args()
+
+    try:
+        config = load_config()
+        targets = iter_targets(args.genes_of_interest)
+        if args.cache:
+            from design_cache import DesignCache
+            cache = DesignCache(args.cache, params_key(config))
+            targets = cache.missing_candidates(targets)
+            cache.close()
+        regions = None
+        if args.shared_regions:
+            from isoform_regions import read_regions
+            regions = read_regions(args.shared_regions)
+        write_primer3_input(targets, args.output_file, config, regions)
     except Exception as e:
         print("An error occurred:", str(e))
+        sys.exit(1)
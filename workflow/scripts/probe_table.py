@@ -0,0 +1,253 @@
+"""
+Snakemake pipeline.
+
+Columnar store for the probe pair candidates of all sequences, used by generate_probe_pairs.py, select_probe_pairs.py
+and the output writers instead of one Python object per candidate.
+
+The candidates are kept in one structured NumPy array (PROBE_DTYPE), sorted on sequence and start site:
+    - gene: index of the sequence in ProbeTable.gene_ids and ProbeTable.templates
+    - index: probe index within the sequence, used for the LHS and RHS IDs (<sequence ID>_LHS_<index>)
+    - start: index of first nucleotide of LHS probe on sequence template
+    - end: index of last nucleotide of RHS probe on sequence template
+    - lhs_gc, rhs_gc: GC percentage of the hybridising parts
+    - lhs, rhs: hybridising parts (25 nt each), without probe handles
+    - hash_id: probe pair hash ID, derived from the probe sequence, its position and the design settings, so the same 
+      probe keeps the same ID from one run to the next
+
+Probe and Sequence objects with string fields are only built on request, as views (ProbeTable.sequences()), and a DataFrame
+with one row per probe pair with ProbeTable.to_frame().
+
+"""
+
+import hashlib
+import numpy as np
+import pandas as pd
+
+LHS_HANDLE = "CCTTGGCACCCGAGAATTCCA" #5' handle of the LHS probe
+RHS_HANDLE = "AAAAAAAAAAAAAAAAAAAAAAAAAAAAAA" #3' handle of the RHS probe
+HYB_SIZE = 25 #length of the hybridising part of each probe side
+GC_RANGE = (44, 72) #default minimum and maximum GC percentage of the hybridising parts (design_config.DEFAULTS)
+
+PROBE_DTYPE = np.dtype([
+    ("gene", np.int32),
+    ("index", np.int32),
+    ("start", np.int32),
+    ("end", np.int32),
+    ("lhs_gc", np.float32),
+    ("rhs_gc", np.float32),
+    ("lhs", f"S{HYB_SIZE}"),
+    ("rhs", f"S{HYB_SIZE}"),
+    ("hash_id", "S7"),
+])
+
+# Lookup table for the complement of ASCII encoded nucleotides
+COMPLEMENT = np.arange(256, dtype=np.uint8)
+for base, complement in zip(b"ACGTNacgtn", b"TGCANtgcan"):
+    COMPLEMENT[base] = complement
+
+GC_BASES = np.frombuffer(b"GCSgcs", dtype=np.uint8)
+UNAMBIGUOUS_BASES = np.frombuffer(b"ACGTSWacgtsw", dtype=np.uint8)
+
+
+# Define the class Probe, a view on one row of the table
+class Probe:
+    def __init__(self):
+        self.HASH_ID = ""
+        self.RHS_ID = "" #ID of RHS probe
+        self.LHS_ID = "" #ID of LHS probe
+        self.START = 0 #index of first nucleotide of LHS probe on sequence template
+        self.END = 0 #index of last nucleotide of RHS probe on sequence template
+        self.LHS = "" #left hand side sequence
+        self.LHS_GC = 0 #left hand side GC percentage
+        self.RHS = "" #right hand side sequence
+        self.RHS_GC = 0 #right hand side GC content
+
+# Define the class Sequence, a view on the rows of one sequence
+class Sequence:
+    def __init__(self):
+        self.ID = "" #sequence ID
+        self.TEMPLATE = "" #sequence template
+        self.PROBES = [] #probes belonging to that sequence
+
+
+# GC percentage of each row of a 2D uint8 array of nucleotides, ambiguous nucleotides removed as in Bio.SeqUtils.gc_fraction
+def gc_percent(bases):
+    gc = np.isin(bases, GC_BASES).sum(axis=1)
+    total = np.isin(bases, UNAMBIGUOUS_BASES).sum(axis=1)
+    return np.divide(gc * 100.0, total, out=np.zeros(len(bases)), where=total > 0)
+
+# Length of the longest mononucleotide repeat of each row of a 2D uint8 array of nucleotides
+def longest_repeat(bases):
+    if bases.shape[1] < 2:
+        return np.full(len(bases), bases.shape[1], dtype=np.int64)
+    positions = np.arange(1, bases.shape[1])
+    # Position at which the repeat covering each nucleotide started: the last position differing from its left neighbour
+    repeat_start = np.maximum.accumulate(np.where(bases[:, 1:] != bases[:, :-1], positions, 0), axis=1)
+    return np.maximum((positions - repeat_start).max(axis=1) + 1, 1)
+
+
+# Deterministic 7 character probe pair hash ID
+def probe_hash(lhs, rhs, start, params_key):
+    return hashlib.sha1(b"%s%s:%d:%s" % (lhs, rhs, start, params_key.encode())).hexdigest()[0:7]
+
+
+# Build the table rows of one sequence from its LHS candidates (start sites, LHS hybridising sequences and GC percentages),
+# keeping the probe pairs whose RHS GC percentage lies within gc_range (min_gc, max_gc of the configuration)
+def sequence_block(gene, template, starts, lhs, lhs_gc, params_key="", gc_range=GC_RANGE):
+    starts = np.asarray(starts, dtype=np.int32)
+    rhs_start = starts - (HYB_SIZE - 1)
+    rhs_end = rhs_start - HYB_SIZE
+    on_template = rhs_end >= 0
+
+    # The RHS probe extends the 25 nucleotides before the LHS window, as reverse complement of the template
+    template_bytes = np.frombuffer(template.encode("ascii"), dtype=np.uint8)
+    positions = np.where(on_template, rhs_end, 0)[:, None] + np.arange(HYB_SIZE)
+    rhs = COMPLEMENT[template_bytes[positions]][:, ::-1]
+    rhs_gc = np.where(on_template, gc_percent(rhs), 0.0)
+
+    block = np.zeros(len(starts), dtype=PROBE_DTYPE)
+    block["gene"] = gene
+    block["start"] = starts
+    block["end"] = rhs_end
+    block["lhs_gc"] = lhs_gc
+    block["rhs_gc"] = rhs_gc
+    block["lhs"] = lhs
+    block["rhs"] = np.ascontiguousarray(rhs).view(f"S{HYB_SIZE}").ravel()
+
+    # Filter out probes with low GC content or those with an END position beyond the template, then sort on start site
+    min_gc, max_gc = gc_range
+    block = block[on_template & (rhs_gc >= min_gc) & (rhs_gc <= max_gc) & (rhs_end <= len(template))]
+    block = block[np.argsort(block["start"], kind="stable")]
+    block["index"] = np.arange(len(block))
+    block["hash_id"] = [probe_hash(row["lhs"], row["rhs"], row["start"], params_key) for row in block]
+    return block
+
+
+class ProbeTable:
+    def __init__(self, gene_ids, templates, probes):
+        self.gene_ids = gene_ids #sequence IDs
+        self.templates = templates #sequence templates
+        self.probes = probes #structured array of PROBE_DTYPE
+
+    # Build a table from (sequence ID, template, LHS start sites, LHS hybridising sequences, LHS GC percentages) records
+    @classmethod
+    def from_records(cls, records, params_key="", gc_range=GC_RANGE):
+        gene_ids, templates, blocks = [], [], []
+        for sequence_id, template, starts, lhs, lhs_gc in records:
+            blocks.append(sequence_block(len(gene_ids), template, starts, lhs, lhs_gc, params_key, gc_range))
+            gene_ids.append(sequence_id)
+            templates.append(template)
+        return cls.from_blocks(gene_ids, templates, blocks)
+
+    # Build a table from the rows of each sequence, numbering the sequences in the given order
+    @classmethod
+    def from_blocks(cls, gene_ids, templates, blocks):
+        for gene, block in enumerate(blocks):
+            block["gene"] = gene
+        probes = np.concatenate(blocks) if blocks else np.zeros(0, dtype=PROBE_DTYPE)
+        return cls(gene_ids, templates, probes)
+
+    # Join tables of different sequences, renumbering the sequences of each table after those of the previous ones
+    @classmethod
+    def concat(cls, tables):
+        gene_ids, templates, blocks = [], [], []
+        for table in tables:
+            probes = table.probes.copy()
+            probes["gene"] += len(gene_ids)
+            blocks.append(probes)
+            gene_ids += table.gene_ids
+            templates += table.templates
+        probes = np.concatenate(blocks) if blocks else np.zeros(0, dtype=PROBE_DTYPE)
+        return cls(gene_ids, templates, probes)
+
+    # Rows of one sequence
+    def block(self, gene):
+        offsets = self.gene_offsets()
+        return self.probes[offsets[gene]:offsets[gene + 1]]
+
+    def __len__(self):
+        return len(self.probes)
+
+    # Table restricted to the rows of a boolean mask or index array. Sequences without probes are kept.
+    def select(self, rows):
+        return ProbeTable(self.gene_ids, self.templates, self.probes[rows])
+
+    # Row offsets of each sequence: the probes of sequence i are rows offsets[i]:offsets[i+1]
+    def gene_offsets(self):
+        return np.searchsorted(self.probes["gene"], np.arange(len(self.gene_ids) + 1))
+
+    # Number of probes of each sequence
+    def gene_counts(self):
+        return np.bincount(self.probes["gene"], minlength=len(self.gene_ids))
+
+    # Boolean mask of the rows whose LHS or RHS probe ID (<sequence ID>_<side>_<index>) is in probe_ids
+    def id_mask(self, probe_ids, side="LHS"):
+        gene_numbers = {sequence_id: gene for gene, sequence_id in enumerate(self.gene_ids)}
+        keys = set()
+        for probe_id in probe_ids:
+            sequence_id, probe_side, index = probe_id.rsplit('_', 2)
+            if probe_side == side and sequence_id in gene_numbers:
+                keys.add((gene_numbers[sequence_id] << 32) | int(index))
+        row_keys = (self.probes["gene"].astype(np.int64) << 32) | self.probes["index"].astype(np.int64)
+        return np.isin(row_keys, np.fromiter(keys, dtype=np.int64, count=len(keys)))
+
+    # Hybridising RHS parts as a 2D uint8 array, one row of HYB_SIZE nucleotides per probe
+    def rhs_bases(self):
+        return np.frombuffer(self.probes["rhs"].tobytes(), dtype=np.uint8).reshape(len(self.probes), HYB_SIZE)
+
+    def lhs_ids(self):
+        return [f"{self.gene_ids[gene]}_LHS_{index}" for gene, index in zip(self.probes["gene"].tolist(), self.probes["index"].tolist())]
+
+    def rhs_ids(self):
+        return [f"{self.gene_ids[gene]}_RHS_{index}" for gene, index in zip(self.probes["gene"].tolist(), self.probes["index"].tolist())]
+
+    # Hybridising parts as str lists
+    def hyb_lhs(self):
+        return np.char.decode(self.probes["lhs"], "ascii").tolist()
+
+    def hyb_rhs(self):
+        return np.char.decode(self.probes["rhs"], "ascii").tolist()
+
+    # Generator of Sequence views, one per sequence (also those without probes)
+    def sequences(self):
+        offsets = self.gene_offsets()
+        for gene, sequence_id in enumerate(self.gene_ids):
+            sequence = Sequence()
+            sequence.ID = sequence_id
+            sequence.TEMPLATE = self.templates[gene]
+            for row in self.probes[offsets[gene]:offsets[gene + 1]]:
+                probe = Probe()
+                probe.HASH_ID = row["hash_id"].decode()
+                probe.LHS_ID = f"{sequence_id}_LHS_{row['index']}"
+                probe.RHS_ID = f"{sequence_id}_RHS_{row['index']}"
+                probe.START = str(row["start"])
+                probe.END = str(row["end"])
+                probe.LHS = LHS_HANDLE + row["lhs"].decode()
+                probe.LHS_GC = format(row["lhs_gc"], '.3f')
+                probe.RHS = row["rhs"].decode() + RHS_HANDLE
+                probe.RHS_GC = format(row["rhs_gc"], '.3f')
+                sequence.PROBES.append(probe)
+            yield sequence
+
+    # One DataFrame row per probe pair, with string columns, as written to the selected probe table (selected_probes.parquet)
+    def to_frame(self):
+        genes = self.probes["gene"]
+        gene_ids = np.array(self.gene_ids, dtype=object)[genes]
+        index = self.probes["index"].astype(str).astype(object)
+        hyb_lhs = np.char.decode(self.probes["lhs"], "ascii").astype(object)
+        hyb_rhs = np.char.decode(self.probes["rhs"], "ascii").astype(object)
+        return pd.DataFrame({
+            "sequence_id": gene_ids,
+            "index": self.probes["index"],
+            "hash_id": np.char.decode(self.probes["hash_id"], "ascii").astype(object),
+            "lhs_id": gene_ids + "_LHS_" + index,
+            "rhs_id": gene_ids + "_RHS_" + index,
+            "start": self.probes["start"],
+            "end": self.probes["end"],
+            "hyb_lhs": hyb_lhs,
+            "hyb_rhs": hyb_rhs,
+            "lhs": LHS_HANDLE + hyb_lhs,
+            "rhs": hyb_rhs + RHS_HANDLE,
+            "lhs_gc": self.probes["lhs_gc"],
+            "rhs_gc": self.probes["rhs_gc"],
+        })
@@ -0,0 +1,403 @@
+"""
+Snakemake pipeline.
+
+Single-process ProbeST design, importable as a library and used by the Snakefile instead of the chain of rules when
+in_memory is enabled in config.yaml.
+
+    import probest
+    probe_set = probest.design("CDS_gene_targets.fa", "CDS_all.fa", {"engine": "native", "offtarget_engine": "kmer"})
+    probe_set.write()
+
+The targets and the reference are fasta files, packed stores (sequence_store.py) or (ID, sequence) records, the config a
+dict completing (or replacing) the settings of config.yaml. The stages of the Snakefile run in one interpreter and pass the
+probe table and the hits in memory, instead of writing and parsing primer3_input_snakemake.txt, primer3_output.txt,
+probes_hybparts_snakemake.fasta and the BLAST output:
+    - candidates: primer3 through its Python bindings (primer3-py, the same library and settings as primer3_core), or the
+      native engine (native_candidates.py)
+    - off-target hits: blastn, with the same settings as the blast_against_ref rule, its output streamed into
+      parse_blast_output.trim (only the BLAST database and the queries are temporary files), or the k-mer seed index
+      (kmer_offtarget.py)
+    - selection: select_probe_pairs.select_probes (specificity and homopolymer filters, optional thermodynamic filter,
+      pair selection, optional dimer screen)
+The modules of a stage are imported when the stage runs, so a run only loads what its configuration needs. The design
+cache is not used in this mode.
+
+With pipeline_batch set in config.yaml (or --batch-size), the targets are designed in batches and the three stages run
+concurrently on successive batches (design_pipelined), so BLAST starts on the first batch while primer3 designs the next
+ones, and the selection of the first genes is available long before the whole panel is designed:
+
+    probest.design("CDS_gene_targets.fa", "CDS_all.fa", batch_size=256, on_batch=lambda batch: print(batch.to_frame()))
+
+Command in Snakefile rule:
+$ python3 probest.py CDS_gene_targets.fa CDS_all.fa --processes 8
+
+Output: the files of the select_probes_pairs rule (selected_probes.txt, selected_probes.parquet, probe_set.csv,
+probe_quantifications.txt, process_log.txt)
+
+"""
+
+import io
+import os
+import sys
+import argparse
+from collections import deque
+from queue import Queue, Empty, Full
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+from design_config import load_config
+from probe_table import HYB_SIZE
+
+PRIMER3_BATCH_SIZE = 256 #sequences designed per worker task
+PIPELINE_QUEUE_SIZE = 2 #batches waiting between two stages of the pipelined design
+
+# blastn settings of the blast_against_ref rule
+BLAST_ARGS = ["-outfmt", "6 qseqid sseqid qstart qend sstart send pident mismatch", "-evalue", "30000", "-word_size", "7",
+              "-gapopen", "3", "-penalty", "-1", "-task", "blastn-short"]
+MAX_MISMATCHES = 5 #k-mer off-target search, as the kmer_offtarget_search rule
+
+
+class ProbeSet:
+    """Selected probe pairs of a design, with the off-target hits and the process log of the selection."""
+
+    def __init__(self, table, hits, config, log):
+        self.table = table #ProbeTable of the selected probe pairs
+        self.hits = hits #trimmed off-target hits of all candidates
+        self.config = config
+        self.log = log #content of process_log.txt
+
+    def __len__(self):
+        return len(self.table)
+
+    # One DataFrame row per probe pair, as in selected_probes.parquet
+    def to_frame(self):
+        return self.table.to_frame()
+
+    # Write the output files of the select_probes_pairs rule
+    def write(self, output_dir=".", probes_csv="probe_set.csv", selected_probes="selected_probes.txt",
+              probe_quantifications="probe_quantifications.txt", selected_table="selected_probes.parquet", log_process="process_log.txt"):
+        import select_probe_pairs
+        path = lambda name: os.path.join(output_dir, name)
+        select_probe_pairs.write_probe_set(self.table, path(probes_csv))
+        select_probe_pairs.write_selected_probes(self.table, path(selected_probes))
+        select_probe_pairs.write_quantifications(self.table, path(probe_quantifications), self.config["max_pairs"])
+        select_probe_pairs.write_selected_table(self.table, path(selected_table))
+        with open(path(log_process), "w") as file:
+            file.write(self.log)
+
+
+# (ID, sequence) records of a fasta file or of an iterable of records. The targets use the "_" separated sequence ID of the
+# formatted headers (primer3_input_design.py).
+def iter_sequences(sequences, targets=False):
+    if isinstance(sequences, (str, os.PathLike)):
+        from sequence_store import SequenceStore, is_store
+        if is_store(sequences):
+            yield from SequenceStore(sequences).records()
+        elif targets:
+            from primer3_input_design import iter_targets
+            yield from iter_targets(sequences)
+        else:
+            from kmer_offtarget import iter_fasta
+            for name, sequence in iter_fasta(sequences):
+                yield name, sequence.upper()
+    else:
+        for name, sequence in sequences:
+            yield name, sequence.upper()
+
+# Candidate records of a batch of targets designed with the primer3 bindings, as generate_probe_pairs.iter_records reads
+# them from the primer3 output: right primers of 25 nt ending at a T, with their 5' position and GC percentage. The LHS of
+# collapsed isoform representatives are kept out of the regions not shared by the isoforms, as in primer3_input_design.py.
+def primer3_batch(targets, config, regions=None):
+    import primer3
+    from primer3_input_design import global_args
+    settings = global_args(config)
+    records = []
+    for target_id, template in targets:
+        sequence_args = {"SEQUENCE_ID": target_id, "SEQUENCE_TEMPLATE": template}
+        if regions and target_id in regions:
+            from isoform_regions import excluded_regions
+            sequence_args["SEQUENCE_EXCLUDED_REGION"] = [list(region) for region in excluded_regions(len(template), regions[target_id])]
+        result = primer3.bindings.design_primers(sequence_args, settings)
+        starts, lhs, lhs_gc = [], [], []
+        for i in range(result.get("PRIMER_RIGHT_NUM_RETURNED", 0)):
+            sequence = result[f"PRIMER_RIGHT_{i}_SEQUENCE"]
+            if sequence[-1:] == 'T' and len(sequence) == HYB_SIZE:
+                starts.append(result[f"PRIMER_RIGHT_{i}"][0])
+                lhs.append(sequence)
+                lhs_gc.append(result[f"PRIMER_RIGHT_{i}_GC_PERCENT"])
+        records.append((target_id, template, starts, lhs, lhs_gc))
+    return records
+
+# Candidates of a probe table within the shared regions of the collapsed isoforms (isoform_regions.py), if any
+def restrict(table, regions):
+    if not regions:
+        return table
+    from isoform_regions import shared_mask
+    return table.select(shared_mask(table, regions))
+
+# Probe table of the candidates of all targets, with either engine
+def candidates(targets, config, processes=1, regions=None):
+    from design_config import params_key, gc_range
+    from probe_table import ProbeTable
+    targets = list(targets)
+    if config["engine"] == "native":
+        import native_candidates
+        return restrict(native_candidates.table_from_targets(targets, config, regions), regions)
+    batches = [targets[i:i + PRIMER3_BATCH_SIZE] for i in range(0, len(targets), PRIMER3_BATCH_SIZE)]
+    if processes > 1 and len(batches) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            records = [record for batch in executor.map(primer3_batch, batches, [config] * len(batches), [regions] * len(batches)) for record in batch]
+    else:
+        records = [record for batch in batches for record in primer3_batch(batch, config, regions)]
+    return restrict(ProbeTable.from_records(records, params_key(config), gc_range(config)), regions)
+
+# (probe ID, hybridising sequence) records of the LHS and RHS of every candidate, in the order of the probe fasta file
+def probe_records(table):
+    for lhs_id, lhs, rhs_id, rhs in zip(table.lhs_ids(), table.hyb_lhs(), table.rhs_ids(), table.hyb_rhs()):
+        yield lhs_id, lhs
+        yield rhs_id, rhs
+
+# Off-target search of the candidates of probe tables against the reference, in the format of the trimmed BLAST output. The
+# k-mer index, or the BLAST database in directory, is built once; the returned function searches the candidates of one table.
+def offtarget_search(reference, config, directory, processes=1):
+    from parse_blast_output import sort_hits
+    if config["offtarget_engine"] == "kmer":
+        from kmer_offtarget import KmerIndex, search_probes
+        if isinstance(reference, (str, os.PathLike)):
+            index = KmerIndex.from_path(reference, MAX_MISMATCHES)
+        else:
+            index = KmerIndex.from_records(iter_sequences(reference), MAX_MISMATCHES)
+        return lambda table: sort_hits(search_probes(probe_records(table), index)).reset_index(drop=True)
+
+    import subprocess
+    from parse_blast_output import trim
+    from sequence_store import is_store
+    reference_fasta = reference
+    if not isinstance(reference, (str, os.PathLike)) or is_store(reference):
+        reference_fasta = os.path.join(directory, "reference.fa")
+        with open(reference_fasta, "w") as file:
+            for name, sequence in iter_sequences(reference):
+                file.write(f">{name}\n{sequence}\n")
+    database = os.path.join(directory, "ref_genome-db")
+    subprocess.run(["makeblastdb", "-in", reference_fasta, "-dbtype", "nucl", "-parse_seqids", "-out", database],
+                   check=True, stdout=subprocess.DEVNULL)
+
+    def search(table):
+        query = os.path.join(directory, "probes.fasta") #one search at a time
+        with open(query, "w") as file:
+            for probe_id, sequence in probe_records(table):
+                file.write(f">{probe_id}\n{sequence}\n")
+        blastn = subprocess.Popen(["blastn", "-db", database, "-query", query, "-num_threads", str(processes)] + BLAST_ARGS,
+                                  stdout=subprocess.PIPE, text=True)
+        hits = trim(blastn.stdout)
+        if blastn.wait() != 0:
+            raise subprocess.CalledProcessError(blastn.returncode, "blastn")
+        return sort_hits(hits).reset_index(drop=True)
+    return search
+
+# Off-target hits of all candidates against the reference
+def offtarget_hits(table, reference, config, processes=1):
+    import tempfile
+    with tempfile.TemporaryDirectory() as directory:
+        return offtarget_search(reference, config, directory, processes)(table)
+
+# Candidate records of a batch of targets with either engine, run in the worker processes of the pipelined design
+def batch_records(targets, config, regions=None):
+    if config["engine"] == "native":
+        import native_candidates
+        return list(native_candidates.iter_records(targets, config, regions))
+    return primer3_batch(targets, config, regions)
+
+# Lists of up to size items of an iterable
+def batched(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+# Probe tables of the batches of targets, in order, with up to ahead batches designed in the process pool at a time (one at a
+# time in this process without a pool)
+def candidate_batches(batches, config, executor, ahead, regions=None):
+    from design_config import params_key, gc_range
+    from probe_table import ProbeTable
+    if executor is None:
+        for batch in batches:
+            yield restrict(ProbeTable.from_records(batch_records(batch, config, regions), params_key(config), gc_range(config)), regions)
+        return
+    pending = deque()
+    for batch in batches:
+        pending.append(executor.submit(batch_records, batch, config, regions))
+        if len(pending) > ahead:
+            yield restrict(ProbeTable.from_records(pending.popleft().result(), params_key(config), gc_range(config)), regions)
+    while pending:
+        yield restrict(ProbeTable.from_records(pending.popleft().result(), params_key(config), gc_range(config)), regions)
+
+# Put an item in a bounded queue, waiting for room unless the pipeline is stopped
+def put(queue, item, stopped):
+    while not stopped.is_set():
+        try:
+            queue.put(item, timeout=0.1)
+            return True
+        except Full:
+            pass
+    return False
+
+# Items of a queue up to the end marker (None), raising the error of the stage upstream. Stops early once the pipeline is
+# stopped (e.g. by an error downstream), when no end marker may come.
+def iter_queue(queue, stopped):
+    while True:
+        try:
+            item = queue.get(timeout=0.1)
+        except Empty:
+            if stopped.is_set():
+                return
+            continue
+        if item is None:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+# Thread of a pipeline stage: puts the items of a generator in the queue of the next stage, then the end marker, or the
+# error of the stage (or of a stage upstream)
+def run_stage(items, queue, stopped):
+    try:
+        for item in items:
+            if not put(queue, item, stopped):
+                return
+        put(queue, None, stopped)
+    except BaseException as error:
+        put(queue, error, stopped)
+    finally:
+        items.close()
+
+# Number of CPUs this process may run on
+def available_cpus():
+    return len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count() or 1
+
+# Pipelined design: the targets are read and designed in batches of batch_size sequences, and the candidate generation,
+# off-target search and selection of successive batches run concurrently, connected by bounded queues:
+#     - candidates: process pool of the given number of processes, designing up to that many batches ahead
+#     - off-target search: a thread running blastn on the candidates of one batch at a time (the BLAST database is built
+#       once), or searching the k-mer index
+#     - selection: filters and pair selection of each batch in the calling thread, on_batch(ProbeSet of the batch) being
+#       called as soon as a batch is selected
+# The queues hold at most PIPELINE_QUEUE_SIZE batches, so a slow stage holds back the stages upstream and the memory stays
+# bounded. The selection of a sequence only depends on its own candidates and hits, so the design is the same as design()
+# without batches; the dimer screen is panel-wide and runs on all batches at the end (the pairs of the batches given to
+# on_batch are those before the screen).
+# The stages only overlap on several CPUs, and with several batches: on a single CPU, the batches run one stage after the
+# other in the calling thread, without process pool and threads, which would only add their start-up time.
+def design_pipelined(targets, reference, settings, log_file, processes=1, batch_size=PRIMER3_BATCH_SIZE, on_batch=None, regions=None):
+    import tempfile
+    import threading
+    import multiprocessing
+    import pandas as pd
+    from parse_blast_output import COLUMNS, sort_hits
+    from pair_selection import select_pairs
+    from probe_table import ProbeTable
+    from select_probe_pairs import filter_probes, final_selection
+
+    stopped = threading.Event()
+    candidates_queue, hits_queue = Queue(PIPELINE_QUEUE_SIZE), Queue(PIPELINE_QUEUE_SIZE)
+    executor = None
+    if available_cpus() > 1:
+        # spawned workers: the pool is started while the threads of the other stages run
+        executor = ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context("spawn"))
+
+    def generated():
+        batches = batched(iter_sequences(targets, targets=True), batch_size)
+        yield from candidate_batches(batches, settings, executor, processes, regions)
+
+    def searched(tables):
+        with tempfile.TemporaryDirectory() as directory:
+            search = offtarget_search(reference, settings, directory, processes)
+            for table in tables:
+                yield table, search(table)
+
+    threads = []
+    if executor is None:
+        searched_batches = searched(generated())
+    else:
+        threads = [threading.Thread(target=run_stage, args=(generated(), candidates_queue, stopped), daemon=True),
+                   threading.Thread(target=run_stage, args=(searched(iter_queue(candidates_queue, stopped)), hits_queue, stopped), daemon=True)]
+        searched_batches = iter_queue(hits_queue, stopped)
+    for thread in threads:
+        thread.start()
+    tables, keeps, all_hits = [], [], []
+    try:
+        for number, (table, hits) in enumerate(searched_batches, 1):
+            batch_log = io.StringIO()
+            batch_log.write(f"Batch {number}: number of sequences processed: {len(table.gene_ids)}\n")
+            table = filter_probes(table, hits, settings, batch_log, processes)
+            keep = select_pairs(table, hits, settings, processes)
+            log_file.write(batch_log.getvalue())
+            if on_batch is not None:
+                on_batch(ProbeSet(table.select(keep), hits, settings, batch_log.getvalue()))
+            tables.append(table)
+            keeps.append(keep)
+            all_hits.append(hits)
+    finally:
+        stopped.set()
+        for thread in threads:
+            thread.join()
+        searched_batches.close()
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    table = ProbeTable.concat(tables)
+    hits = sort_hits(pd.concat(all_hits, ignore_index=True)).reset_index(drop=True) if all_hits else pd.DataFrame(columns=COLUMNS)
+    keep = np.concatenate(keeps) if keeps else np.zeros(0, dtype=bool)
+    log_file.write(f"Number of sequences processed: {len(table.gene_ids)}\n")
+    return final_selection(table, keep, hits, settings, log_file, processes), hits
+
+# Design the probe pairs of the targets against the reference, keeping the candidates, hits and selection in memory. With a
+# batch size (argument or pipeline_batch in config.yaml), the stages run concurrently on batches of targets
+# (design_pipelined). With the shared regions of collapsed isoforms (isoform_regions.py, e.g. isoform_regions.tsv), the
+# candidates of their representatives are restricted to the regions shared by the isoforms.
+def design(targets, reference, config=None, processes=1, batch_size=None, on_batch=None, shared_regions=None):
+    settings = load_config()
+    settings.update(config or {})
+    batch_size = batch_size or settings["pipeline_batch"]
+    log_file = io.StringIO()
+    regions = None
+    if shared_regions:
+        from isoform_regions import read_regions
+        regions = read_regions(shared_regions)
+
+    if batch_size:
+        log_file.write(f"Designing candidates, searching off-target hits and selecting in batches of {batch_size} sequences...\n")
+        table, hits = design_pipelined(targets, reference, settings, log_file, processes, batch_size, on_batch, regions)
+        return ProbeSet(table, hits, settings, log_file.getvalue())
+
+    log_file.write("Designing candidates...\n")
+    table = candidates(iter_sequences(targets, targets=True), settings, processes, regions)
+    log_file.write(f"Number of sequences processed: {len(table.gene_ids)}\n")
+
+    log_file.write("Searching off-target hits...\n")
+    hits = offtarget_hits(table, reference, settings, processes)
+
+    from select_probe_pairs import select_probes
+    table = select_probes(table, hits, settings, log_file, processes)
+    return ProbeSet(table, hits, settings, log_file.getvalue())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Design the probe pairs of the target CDS sequences in a single process.")
+    parser.add_argument("targets", nargs="?", default="CDS_gene_targets.fa", help="CDS fasta file with formatted headers.")
+    parser.add_argument("reference", nargs="?", default="CDS_all.fa", help="Reference fasta file of the off-target search.")
+    parser.add_argument("--output-dir", default=".", help="Directory of the output files.")
+    parser.add_argument("--engine", choices=["primer3", "native"], help="Candidate generation engine, default: engine in config.yaml.")
+    parser.add_argument("--offtarget-engine", choices=["blast", "kmer"], help="Off-target search engine, default: offtarget_engine in config.yaml.")
+    parser.add_argument("--processes", type=int, default=1, help="Number of processes (primer3, blastn threads, selection).")
+    parser.add_argument("--batch-size", type=int, help="Sequences per batch of the pipelined design, default: pipeline_batch in config.yaml.")
+    parser.add_argument("--shared-regions", help="Shared regions of the collapsed isoforms, e.g. isoform_regions.tsv")
+    args = parser.parse_args()
+
+    overrides = {key: value for key, value in (("engine", args.engine), ("offtarget_engine", args.offtarget_engine)) if value}
+    # progress of the pipelined design, in the log of the Snakefile rule
+    report = lambda batch: print(f"Selected {len(batch)} probe pairs for {len(batch.table.gene_ids)} sequences", file=sys.stderr, flush=True)
+    design(args.targets, args.reference, overrides, args.processes, args.batch_size, report, args.shared_regions).write(args.output_dir)
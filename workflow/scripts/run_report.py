@@ -0,0 +1,142 @@
+"""
+Snakemake pipeline.
+
+Run report of the pipeline stages, written by the last rule of the Snakefile and of Snakefile_cross-hyb from the benchmark files of the rules
+(benchmarks/<rule>.tsv, or benchmarks/<rule>_<wildcards>.tsv for the jobs of a rule with wildcards, e.g. the shards) and the input and output files
+of each stage.
+
+Per stage:
+    - jobs, wall time (sum over the jobs and longest job, s), CPU time (s), peak RSS (MB), I/O read and written (MB),
+      from the Snakemake benchmark files
+    - number of records and bytes of the input and output files: fasta records, primer3 records, parquet rows or table
+      lines below the header. Sharded stages are reported on the gathered files, as the shards are temporary
+    - with profile enabled in config.yaml: the cProfile file of each job (profiles/<job>.prof) and the functions with the
+      most time spent in them (main process only, not the workers of a process pool)
+Stages without a benchmark file (rules not run, e.g. the BLAST rules with the kmer engine) are left out.
+
+Command in Snakefile rule:
+$ python3 run_report.py --stage create_primer3_input:CDS_gene_targets.fa:primer3_input_snakemake.txt [--stage ...] run_report.json run_report.tsv
+
+Output:
+- run_report.json: the stages and the totals, with the top profiled functions
+- run_report.tsv: one line per stage
+
+"""
+
+import os
+import glob
+import json
+import pstats
+import argparse
+import pandas as pd
+
+TOP_FUNCTIONS = 10 #functions listed per profiled stage
+COLUMNS = ["stage", "jobs", "wall_s", "wall_max_s", "cpu_s", "max_rss_mb", "io_in_mb", "io_out_mb",
+           "input_records", "input_bytes", "output_records", "output_bytes"]
+
+
+# Number of records of a file: fasta records, primer3 records ("=" lines), parquet rows or table lines below the header
+def count_records(path):
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path).metadata.num_rows
+    with open(path, "rb") as file:
+        if path.endswith((".fa", ".fasta")):
+            return sum(line.startswith(b">") for line in file)
+        if os.path.basename(path).startswith("primer3_"):
+            return sum(line == b"=\n" for line in file)
+        if path.endswith((".txt", ".csv", ".tsv")):
+            return max(0, sum(1 for _ in file) - 1)
+    return None
+
+# Total records and bytes of the existing files of a list, None when none of them exists
+def file_stats(paths):
+    paths = [path for path in paths if os.path.exists(path)]
+    if not paths:
+        return None, None
+    counts = [count_records(path) for path in paths]
+    records = None if any(count is None for count in counts) else sum(counts)
+    return records, sum(os.path.getsize(path) for path in paths)
+
+# Files of a directory grouped by rule: <rule>.<extension>, or <rule>_<wildcards>.<extension> for the jobs of a rule with
+# wildcards. A file goes to the longest matching rule name, so that rules sharing a prefix are kept apart.
+def files_by_rule(directory, rules, extension):
+    grouped = {rule: [] for rule in rules}
+    for path in sorted(glob.glob(os.path.join(directory, "*" + extension))):
+        name = os.path.basename(path)[:-len(extension)]
+        matches = [rule for rule in rules if name == rule or name.startswith(rule + "_")]
+        if matches:
+            grouped[max(matches, key=len)].append(path)
+    return grouped
+
+# Metrics of a rule summed (times, I/O) or maxed (peak RSS, longest job) over its jobs. Older Snakemake versions do not
+# record the CPU time.
+def benchmark_stats(paths):
+    table = pd.concat([pd.read_csv(path, sep="\t") for path in paths], ignore_index=True)
+    column = lambda name: pd.to_numeric(table[name], errors="coerce") if name in table else pd.Series(dtype=float)
+    return {
+        "jobs": len(paths),
+        "wall_s": round(float(column("s").sum()), 3),
+        "wall_max_s": round(float(column("s").max()), 3),
+        "cpu_s": round(float(column("cpu_time").sum()), 3) if "cpu_time" in table else None,
+        "max_rss_mb": round(float(column("max_rss").max()), 2) if "max_rss" in table else None,
+        "io_in_mb": round(float(column("io_in").sum()), 2) if "io_in" in table else None,
+        "io_out_mb": round(float(column("io_out").sum()), 2) if "io_out" in table else None,
+    }
+
+# Functions with the most time spent in them (excluding their callees) over the profiles of the jobs of a rule
+def top_functions(profile_files, limit=TOP_FUNCTIONS):
+    stats = pstats.Stats(*profile_files)
+    rows = []
+    for (file_name, line, function), (calls, _, total_time, cumulative_time, _) in stats.stats.items():
+        rows.append({"function": f"{os.path.basename(file_name)}:{line}({function})", "calls": calls,
+                     "tottime_s": round(total_time, 4), "cumtime_s": round(cumulative_time, 4)})
+    return sorted(rows, key=lambda row: -row["tottime_s"])[:limit]
+
+# Parse a --stage argument: <rule>:<input>,<input>:<output>,<output>
+def parse_stage(argument):
+    rule, inputs, outputs = (argument.split(":") + ["", ""])[:3]
+    return rule, [path for path in inputs.split(",") if path], [path for path in outputs.split(",") if path]
+
+def run_report(stages, benchmark_dir="benchmarks", profile_dir="profiles"):
+    rules = [rule for rule, _, _ in stages]
+    benchmarks = files_by_rule(benchmark_dir, rules, ".tsv")
+    profiles = files_by_rule(profile_dir, rules, ".prof")
+    report = []
+    for rule, inputs, outputs in stages:
+        if not benchmarks[rule]:
+            continue
+        stage = {"stage": rule, **benchmark_stats(benchmarks[rule])}
+        stage["input_records"], stage["input_bytes"] = file_stats(inputs)
+        stage["output_records"], stage["output_bytes"] = file_stats(outputs)
+        if profiles[rule]:
+            stage["profiles"] = profiles[rule]
+            stage["top_functions"] = top_functions(profiles[rule])
+        report.append(stage)
+    return report
+
+def totals(report):
+    values = lambda key: [stage[key] for stage in report if stage.get(key) is not None]
+    return {
+        "jobs": sum(values("jobs")),
+        "wall_s": round(sum(values("wall_s")), 3),
+        "cpu_s": round(sum(values("cpu_s")), 3) if values("cpu_s") else None,
+        "max_rss_mb": max(values("max_rss_mb"), default=None),
+    }
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write the run report of the pipeline stages from the Snakemake benchmark files.")
+    parser.add_argument("--stage", action="append", default=[], type=parse_stage, help="Stage as <rule>:<inputs>:<outputs>, files separated by commas.")
+    parser.add_argument("--benchmarks", default="benchmarks", help="Directory of the Snakemake benchmark files.")
+    parser.add_argument("--profiles", default="profiles", help="Directory of the cProfile files.")
+    parser.add_argument("json_file", help="Output JSON report, e.g. run_report.json")
+    parser.add_argument("tsv_file", help="Output TSV report, e.g. run_report.tsv")
+    args = parser.parse_args()
+
+    report = run_report(args.stage, args.benchmarks, args.profiles)
+    with open(args.json_file, "w") as file:
+        json.dump({"stages": report, "total": totals(report)}, file, indent=2)
+    table = pd.DataFrame(report, columns=COLUMNS)
+    counts = ["jobs", "input_records", "input_bytes", "output_records", "output_bytes"]
+    table[counts] = table[counts].astype("Int64") #empty for missing files, not NaN
+    table.to_csv(args.tsv_file, sep="\t", index=False)
@@ -3,157 +3,170 @@ Snakemake pipeline. Author: Sofia Rouot.
 
 This is a script for selecting final probe pairs based on: 
 - off-target hybridization (BLAST output)
-- non-overlapping target region
 - max homopolymer repeats RHS = 5 
-- max probe pairs per gene = 3
+- optionally, Tm, hairpin and LHS/RHS heterodimer thresholds (thermo_filter in config.yaml, thermodynamics.py)
+- non-overlapping target region, max probe pairs per gene = 3 (max_pairs and min_spacing in config.yaml), selected by
+  pair_selection.py as the best scoring set with as many pairs as possible
+- optionally, no cross-dimers between the probes of the panel (dimer_screen in config.yaml, dimer_screen.py)
 
 Input: 
-- python code for generating initial probe pairs LHS+RHS (generate_probe_pairs.py) 
+- python code for generating initial probe pairs LHS+RHS (generate_probe_pairs.py, or native_candidates.py with the native engine) 
 - trimmed BLAST output generated from previous Snakefile rule using target_specificity_trim.py 
 
 Output: 
 - final probe pairs overview txt file 
+- selected probe table (Parquet, one row per probe pair), input of the cross-hybridisation workflow
 - probe quantifications txt file 
 - probe reference csv file compatible with Space Ranger
 
 """
 
+import numpy as np
 import pandas as pd 
-import sys
+import argparse
 import generate_probe_pairs
+from design_config import load_config, params_key
+from design_cache import DesignCache, reference_key
+from probe_table import longest_repeat
+from pair_selection import select_pairs
+
+MAX_HOMOPOLYMER = 5 #max length of homopolymer repeat in the RHS
+
+
+# Create SpaceRanger compatible CSV reference file, built column-wise from the probe table.
+# "Region" Column not included because probes have not been designed specifically for bridging splice junctions 
+def write_probe_set(table, probes_csv):
+    genes = table.probes["gene"]
+    sequence_ids = np.array([gene_id.split('_')[0] for gene_id in table.gene_ids], dtype=object)
+    gene_names = np.array([gene_id.split('_')[1] for gene_id in table.gene_ids], dtype=object)
+    #gene_names = np.array(["gene_" + str(gene + 1) for gene in range(len(table.gene_ids))], dtype=object) #generate incrementing gene names, in case you don't have gene name annotations for your genome
+    probe_ref = pd.DataFrame({
+        "gene_id": sequence_ids[genes],
+        "probe_seq": np.char.decode(np.char.add(table.probes["lhs"], table.probes["rhs"]), "ascii").astype(object),
+        "probe_id": sequence_ids[genes] + "|" + gene_names[genes] + "|" + np.char.decode(table.probes["hash_id"], "ascii").astype(object),
+        "included": "TRUE",
+    }, columns=["gene_id", "probe_seq", "probe_id", "included"])
+    probe_ref = probe_ref.drop_duplicates().sort_values(by=['probe_id'], kind="stable")
+    probe_ref.to_csv(probes_csv, index=False) #export dataframe to csv
+
+# Save overview of generated probes in txt file 
+def write_selected_probes(table, selected_probes):
+    with open(selected_probes, "w", buffering=1 << 20) as file:
+        generate_probe_pairs.printer(table.sequences(), file)
+
+# Save probe counts and other quantifications in txt file 
+def write_quantifications(table, probe_quantifications, max_pairs=3):
+    # Number of sequences with n probes, for n = 0 to at least 4 (or max_pairs)
+    sequences_with = np.bincount(table.gene_counts(), minlength=max(5, max_pairs + 1))
+    with open(probe_quantifications, "w") as file:
+        file.write(f"the final amount of probes is:  {len(table)} \n\n")
+        file.write(f"the total amount of sequences designed probes for:  {len(table.gene_ids) - sequences_with[0]}\n")
+        for i, count in enumerate(sequences_with.tolist()):
+            file.write(f"the amount of sequences containing  {i}  probes:  {count}\n")
+
+# Save the selected probe pairs as a table (Parquet), read by the cross-hybridisation workflow
+def write_selected_table(table, selected_table):
+    table.to_frame().to_parquet(selected_table, index=False)
+
+
+# Select the final probe pairs of a candidate table with their off-target hits, logging the probes left after each step.
+# Returns the table of the selected probe pairs.
+def select_probes(table, hits, config, log_file, processes=1):
+    table = filter_probes(table, hits, config, log_file, processes)
+    return final_selection(table, select_pairs(table, hits, config, processes), hits, config, log_file, processes)
+
+# Filters of the candidates of each sequence before the pair selection: specificity, homopolymers and thermodynamics
+def filter_probes(table, hits, config, log_file, processes=1):
+    log_file.write(f"Number of BLAST hits: {len(hits)}\n")
 
+    # Delete probes which have >1 BLAST hits on the RHS and LHS (non-specific probes) Based on the 10X guidelines, at least one of the two probe sides needs to have >5 mismatches to prevent off-target hybridisation  
+    hits2 = hits[hits['probe_id'].duplicated(keep=False)] #keeps all duplicates for each duplicated probe_id value, corresponding to off-target hits.
+        #The parameter keep=False means it marks all occurrences of duplicated values as True
+    nonspec_probes = set(hits2['probe_id'])
+    log_file.write(f"Number of non-specific probes: {len(hits2)}\n")
 
+    # Delete non-specific probes 
+    table = table.select(~table.id_mask(nonspec_probes, "LHS"))
+    for sequence_id, count in zip(table.gene_ids, table.gene_counts()):
+        log_file.write(f"Number of probes after specificity filter for sequence {sequence_id}: {count}\n")
 
-def main(primer3_output_file, blast_output_file, probes_csv, selected_probes, probe_quantifications, log_process):
+    # Delete probes (RHS) which contain a homopolymer repeat of >5 identical nucleotides 
+    table = table.select(longest_repeat(table.rhs_bases()) <= MAX_HOMOPOLYMER)
+
+    # Delete probes with a Tm out of range, a stable hairpin or a stable LHS/RHS heterodimer (thermodynamics.py)
+    if config["thermo_filter"]:
+        from thermodynamics import thermo_mask # primer3 bindings, only loaded with the filter enabled
+        table = table.select(thermo_mask(table, config, processes))
+        for sequence_id, count in zip(table.gene_ids, table.gene_counts()):
+            log_file.write(f"Number of probes after thermodynamic filter for sequence {sequence_id}: {count}\n")
+    return table
+
+# Selected table from the filtered table and the pairs kept by pair_selection.select_pairs (the best set of up to max_pairs
+# non-overlapping probe pairs per sequence)
+def final_selection(table, keep, hits, config, log_file, processes=1):
+    # Replace or delete probe pairs forming cross-dimers with other probes of the panel (dimer_screen.py)
+    if config["dimer_screen"]:
+        import dimer_screen
+        keep = dimer_screen.screen(table, keep, hits, config, log_file, processes)
+    table = table.select(keep)
+    for sequence_id, count in zip(table.gene_ids, table.gene_counts()):
+        log_file.write(f"Number of probes after selecting up to {config['max_pairs']} non-overlapping pairs for sequence {sequence_id}: {count}\n")
+    return table
+
+
+def main(primer3_output_file, blast_output_file, probes_csv, selected_probes, probe_quantifications, log_process, engine="primer3", cache_file=None, targets_file="CDS_gene_targets.fa", reference_file="CDS_all.fa", processes=1, selected_table=None, regions_file=None):
     # Open a log file to record debug information
     log_file = open(log_process, 'w')
+    config = load_config()
+    config["engine"] = engine
+    cache = DesignCache(cache_file, params_key(config)) if cache_file else None
 
-    # Import initial probe pairs 
+    # Import initial probe pairs into a probe table 
     log_file.write("Reading primer3 output file...\n")
-    sequences = generate_probe_pairs.process(primer3_output_file)
-    log_file.write(f"Number of sequences processed: {len(sequences)}\n")
+    regions = None
+    if regions_file:
+        from isoform_regions import read_regions # shared regions of the collapsed isoforms
+        regions = read_regions(regions_file)
+    table = generate_probe_pairs.load_table(primer3_output_file, config, cache, targets_file, regions)
+    log_file.write(f"Number of sequences processed: {len(table.gene_ids)}\n")
 
     # Import BLAST output for off-target hybridisation
     log_file.write("Reading BLAST output file...\n")
     hits = pd.read_csv(blast_output_file, sep = ' ')
-    log_file.write(f"Number of BLAST hits: {len(hits)}\n")
-
-    # Delete probes which have >1 BLAST hits on the RHS and LHS (non-specific probes) Based on the 10X guidelines, at least one of the two probe sides needs to have >5 mismatches to prevent off-target hybridisation  
-    hits2 = hits[hits['probe_id'].duplicated(keep=False)] #keeps all duplicates for each duplicated probe_id value, corresponding to off-target hits.
-        #The parameter keep=False means it marks all occurrences of duplicated values as True
-    nonspec_probes = hits2['probe_id'].values.tolist()
-    log_file.write(f"Number of non-specific probes: {len(nonspec_probes)}\n")
-
-    for sequence in sequences:
-    # Create a new list without non-specific probes
-        sequence.PROBES = [
-            probe for probe in sequence.PROBES if probe.LHS_ID not in nonspec_probes
-    ]
-        
-    log_file.write(f"Number of probes after specificity filter for sequence {sequence.ID}: {len(sequence.PROBES)}\n")
-
-    # Delete probes (RHS) which contain a homopolymer repeat of >5 identical nucleotides 
-    K = 5 #initiate max length of homopolymer repeat 
-    for sequence in sequences:
-        for i, probe in enumerate(sequence.PROBES):
-            hyb_RHS = probe.RHS[:25]
-            for idx, ele in enumerate(hyb_RHS):
-                substr = ele * K #create equi string
-                if hyb_RHS[idx : idx + K] > substr:
-                    del sequence.PROBES[i]
-                    break
-
-    # Delete probes which overlap 
-    for sequence in sequences:
-        iterator = 0
-        while iterator < len(sequence.PROBES)-1:
-            if (int(sequence.PROBES[iterator].START) + 4)> int(sequence.PROBES[iterator+1].END): #have a minimum space of 4 nucleotides between two probe pairs (hyb regions). Somewhat arbitrarily chosen. 
-                del sequence.PROBES[iterator+1]
-            else:
-                iterator += 1
-        log_file.write(f"Number of probes after overlap filter for sequence {sequence.ID}: {len(sequence.PROBES)}\n")
-
-    # Keep first 3 probe pairs 
-    for index, sequence in enumerate(sequences): 
-        while len(sequence.PROBES) > 3:
-            del sequence.PROBES[-1]
-        log_file.write(f"Number of probes after limiting to 3 for sequence {sequence.ID}: {len(sequence.PROBES)}\n")
-
+    if cache is not None:
+        hits_key = reference_key(reference_file, config)
+        hits = cache.merge_hits(table, hits, hits_key) #add the cached hits of the sequences which were not BLASTed in this run
+    table = select_probes(table, hits, config, log_file, processes)
     
-    # Generate the 3 output files
-
-    # Create SpaceRanger compatible CSV reference file.
-    # "Region" Column not included because probes have not been designed specifically for bridging splice junctions 
-    probe_ref = pd.DataFrame(columns = ["gene_id", "probe_seq", "probe_id", "included"])
-    x = 1 
-    for sequence in sequences: 
-        #gene_name = "gene_" + str(x) #generate incrementing gene names, in case you don't have gene name annotations for your genome
-        for probe in sequence.PROBES:
-            hyb_LHS = probe.LHS[-25:] #only take the hybrdising part of the probe, i.e. the last 25 nucleotides    
-            hyb_RHS = probe.RHS[:25] #only take the hybridising part of the probe, i.e. the first 25 nucleotides 
-            full_probe = hyb_LHS + hyb_RHS 
-            sequence_id = sequence.ID.split('_')[0]
-            gene_name = sequence.ID.split('_')[1]
-            probe_id = str(sequence_id + "|" + gene_name + "|" + probe.HASH_ID)
-            df_temp = pd.DataFrame({"gene_id": sequence_id, "probe_seq": full_probe, "probe_id": probe_id, "included": "TRUE"}, index = [0])
-            probe_ref = probe_ref.drop_duplicates()
-            probe_ref = pd.concat([df_temp, probe_ref.loc[:]]).reset_index(drop=True)
-        x = x + 1
-    probe_ref = probe_ref.sort_values(by = ['probe_id'])
-    probe_ref.to_csv(probes_csv, index = False) #export dataframe to csv
-
-    # Save overview of generated probes in txt file 
-    file = open(selected_probes, "w")
-    sys.stdout = file
-    generate_probe_pairs.printer(sequences)
-    file.close()
-
-
-    # Count final amount of probes, for the last file
-    def probe_counter(sequences):
-        n = 0
-        for sequence in sequences: 
-            for probe in sequence.PROBES:
-                n = n + 1 
-        return n
-
-    # Create dictionary counting the occurrences of n probes per gene, for the last file   
-    count_occurrences = {} 
-    for sequence in sequences:
-        sequence.PROBES_count = len(sequence.PROBES)
-        if sequence.PROBES_count in count_occurrences:
-            count_occurrences[sequence.PROBES_count] += 1
-        else:
-            count_occurrences[sequence.PROBES_count] = 1
-
-    # Save probe counts and other quantifications in txt file 
-    file = open(probe_quantifications, "w")
-    sys.stdout = file 
-    print("the final amount of probes is: ", probe_counter(sequences), "\n")   
-    print("the total amount of sequences designed probes for: ", len(sequences)- count_occurrences[0])
-    for i in range(0,5): #adjust range of to the maximum amount of probes per gene which you are interested in
-        if i in count_occurrences:
-            print("the amount of sequences containing ", i, " probes: ", count_occurrences[i])    
-        else:
-            print('the amount of sequences containing ', i, ' probes:  0')
-    file.close()
+    if cache is not None:
+        cache.close()
 
+    # Generate the 3 output files
+    write_probe_set(table, probes_csv)
+    write_selected_probes(table, selected_probes)
+    write_quantifications(table, probe_quantifications, config["max_pairs"])
+    if selected_table:
+        write_selected_table(table, selected_table)
 
     # Close the log file
     log_file.close()
 
 if __name__ == "__main__":
-    if len(sys.argv) != 7:
-        print("Usage: python3 select_probe_pairs.py <primer3_output_file> <blast_output_file> <probes_csv> <selected_probes> <probe_quantifications> <log_process> ")
-        sys.exit(1)
-
-    primer3_output_file = sys.argv[1]
-    blast_output_file = sys.argv[2]
-    probes_csv = sys.argv[3]
-    selected_probes = sys.argv[4]
-    probe_quantifications = sys.argv[5]
-    log_process = sys.argv[6]
-
-    main(primer3_output_file, blast_output_file, probes_csv, selected_probes, probe_quantifications, log_process)
-
-
+    parser = argparse.ArgumentParser(description="Select the final probe pairs.")
+    parser.add_argument("primer3_output_file", help="primer3 output file, or CDS fasta file with --engine native.")
+    parser.add_argument("blast_output_file", help="Trimmed BLAST output file.")
+    parser.add_argument("probes_csv")
+    parser.add_argument("selected_probes")
+    parser.add_argument("probe_quantifications")
+    parser.add_argument("log_process")
+    parser.add_argument("--engine", choices=["primer3", "native"], default="primer3", help="Candidate generation engine.")
+    parser.add_argument("--cache", help="Design cache file.")
+    parser.add_argument("--targets", default="CDS_gene_targets.fa", help="CDS fasta file, used with --cache.")
+    parser.add_argument("--reference", default="CDS_all.fa", help="BLAST reference fasta file, used with --cache.")
+    parser.add_argument("--table", help="Selected probe table (Parquet), e.g. selected_probes.parquet")
+    parser.add_argument("--processes", type=int, default=1, help="Number of processes selecting the probe pairs of the sequences.")
+    parser.add_argument("--shared-regions", help="Shared regions of the collapsed isoforms, e.g. isoform_regions.tsv")
+    args = parser.parse_args()
+
+    main(args.primer3_output_file, args.blast_output_file, args.probes_csv, args.selected_probes, args.probe_quantifications, args.log_process,
+         args.engine, args.cache, args.targets, args.reference, args.processes, args.table, args.shared_regions)
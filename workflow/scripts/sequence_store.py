@@ -0,0 +1,210 @@
+"""
+Snakemake pipeline.
+
+2-bit packed, memory-mapped store of a fasta file, written once by the pack_reference rule from CDS_all.fa and read by
+kmer_offtarget.py instead of parsing the fasta text.
+
+A store is two files:
+    - <name>.pack: the nucleotides packed 4 per byte (A=0, C=1, G=2, T=3, first nucleotide in the high bits), every sequence
+      starting at a byte boundary. The file is opened with numpy.memmap, so the processes reading the same store share one
+      page-cached copy, a quarter of the size of the fasta file.
+    - <name>.pack.npz: the index. Per sequence: the name, the gene ID, the byte offset and the length. Per run of unknown
+      nucleotides (N or any other letter, which 2 bits cannot hold): the start, in nucleotides from the start of the file,
+      and the length.
+The names are the fasta record IDs, and the gene IDs are the record IDs up to the first "." (the gene_id of the trimmed
+off-target hits, parse_blast_output.py). With --targets, the fasta file is read as CDS_gene_targets.fa: the names are the
+"_" separated sequence IDs of the formatted headers (primer3_input_design.py) and the gene IDs their gene_ID field.
+Lower case nucleotides are stored as upper case.
+
+The k-mer search (kmer_offtarget.py) works on the memory map itself: it reads 32 nucleotides at a time as 64-bit words of
+the mapped bytes (an unaligned view, no copy), and decodes the index chunk by chunk. Decoding allocates only the nucleotides
+asked for: a whole sequence, or a range of the sequence or of the file. Stores of (name, sequence) records can also be built in
+memory (SequenceStore.from_records), with the same layout.
+
+Command in Snakefile rule:
+$ python3 sequence_store.py CDS_all.fa CDS_all.pack
+
+Output:
+- CDS_all.pack and CDS_all.pack.npz
+
+"""
+
+import os
+import argparse
+import numpy as np
+from Bio import SeqIO
+
+UNKNOWN = 4 #code of unknown nucleotides, never matching in the k-mer search (kmer_offtarget.py)
+CODES = np.full(256, UNKNOWN, dtype=np.uint8)
+for base, code in zip(b"ACGTacgt", [0, 1, 2, 3, 0, 1, 2, 3]):
+    CODES[base] = code
+BASES = np.frombuffer(b"ACGTN", dtype=np.uint8) #nucleotide of each code
+SHIFTS = np.array([6, 4, 2, 0], dtype=np.uint8) #bit offsets of the 4 nucleotides of a byte
+
+
+# Pack codes 0-3 four per byte, padding the last byte with A
+def pack(codes):
+    padded = np.zeros((len(codes) + 3) // 4 * 4, dtype=np.uint8)
+    padded[:len(codes)] = codes
+    quads = padded.reshape(-1, 4)
+    return (quads[:, 0] << 6) | (quads[:, 1] << 4) | (quads[:, 2] << 2) | quads[:, 3]
+
+# Codes of all the nucleotides of packed bytes
+def unpack(packed):
+    return ((np.asarray(packed)[:, None] >> SHIFTS) & 3).astype(np.uint8).ravel()
+
+# Start and length of the runs of unknown nucleotides of an encoded sequence
+def unknown_runs(codes):
+    edges = np.diff(np.concatenate(([0], (codes == UNKNOWN).view(np.int8), [0])))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    return starts, ends - starts
+
+# (name, gene ID, sequence) records of a fasta file
+def iter_named(fasta_file, targets=False):
+    if targets:
+        from primer3_input_design import sequence_id
+    for record in SeqIO.parse(fasta_file, "fasta"):
+        if targets:
+            yield sequence_id(record.description), record.description.split(" ")[0].split(":")[1], str(record.seq)
+        else:
+            yield record.id, record.id.split('.')[0], str(record.seq)
+
+# Pack (name, gene ID, sequence) records one at a time, passing the packed bytes of each to write, and return the index
+def pack_records(named, write):
+    names, gene_ids, offsets, lengths, unknown_starts, unknown_lengths = [], [], [], [], [], []
+    offset = 0
+    for name, gene_id, sequence in named:
+        codes = CODES[np.frombuffer(sequence.encode("ascii"), dtype=np.uint8)]
+        starts, run_lengths = unknown_runs(codes)
+        unknown_starts.append(starts + 4 * offset)
+        unknown_lengths.append(run_lengths)
+        packed = pack(np.where(codes == UNKNOWN, 0, codes))
+        write(packed.tobytes())
+        names.append(name)
+        gene_ids.append(gene_id)
+        offsets.append(offset)
+        lengths.append(len(codes))
+        offset += len(packed)
+    return {"names": np.array(names, dtype=str), "gene_ids": np.array(gene_ids, dtype=str),
+            "offsets": np.array(offsets, dtype=np.int64), "lengths": np.array(lengths, dtype=np.int64),
+            "unknown_starts": np.concatenate(unknown_starts or [np.zeros(0, dtype=np.int64)]).astype(np.int64),
+            "unknown_lengths": np.concatenate(unknown_lengths or [np.zeros(0, dtype=np.int64)]).astype(np.int64)}
+
+# Write the store of a fasta file, one sequence at a time
+def write_store(fasta_file, store_file, targets=False):
+    with open(store_file, "wb") as file:
+        index = pack_records(iter_named(fasta_file, targets), file.write)
+    with open(store_file + ".npz", "wb") as file: #np.savez would add .npz to a name without it only
+        np.savez(file, **index)
+
+
+class SequenceStore:
+    """Read-only view of a store written by write_store, with the packed nucleotides memory-mapped."""
+
+    def __init__(self, store_file):
+        #np.memmap cannot map an empty file
+        data = np.memmap(store_file, dtype=np.uint8, mode="r") if os.path.getsize(store_file) else np.zeros(0, dtype=np.uint8)
+        with np.load(store_file + ".npz") as index:
+            self.load(index, data)
+
+    # Store of (name, sequence) records, packed in memory. The gene IDs are the names up to the first "."
+    @classmethod
+    def from_records(cls, records):
+        chunks = []
+        index = pack_records(((name, name.split('.')[0], sequence) for name, sequence in records), chunks.append)
+        store = cls.__new__(cls)
+        store.load(index, np.frombuffer(b"".join(chunks), dtype=np.uint8))
+        return store
+
+    # Set the index arrays and the packed bytes
+    def load(self, index, data):
+        self.names = index["names"].tolist()
+        self.gene_ids = index["gene_ids"].tolist()
+        self.offsets = index["offsets"]
+        self.lengths = index["lengths"]
+        self.unknown_starts = index["unknown_starts"]
+        self.unknown_ends = self.unknown_starts + index["unknown_lengths"]
+        self.data = data
+        # Big-endian 64-bit words starting at every byte: an unaligned view of the packed bytes, no copy
+        self.word_view = np.ndarray((max(len(data) - 7, 0),), dtype=">u8", buffer=data, strides=(1,))
+        self.numbers = {name: number for number, name in enumerate(self.names)}
+        self.genes = {}
+        for number, gene_id in enumerate(self.gene_ids):
+            self.genes.setdefault(gene_id, []).append(number)
+
+    def __len__(self):
+        return len(self.names)
+
+    # Numbers of the sequences of a gene, e.g. its transcripts
+    def transcripts(self, gene_id):
+        return self.genes.get(gene_id, [])
+
+    # Unknown nucleotides among the given positions (from the start of the file)
+    def unknown(self, positions):
+        if not len(self.unknown_starts):
+            return np.zeros(np.shape(positions), dtype=bool)
+        run = np.searchsorted(self.unknown_starts, positions, side="right") - 1
+        return (run >= 0) & (positions < self.unknown_ends[np.maximum(run, 0)])
+
+    # Whether the ranges starts:ends of the file hold unknown nucleotides
+    def has_unknown(self, starts, ends):
+        if not len(self.unknown_starts):
+            return np.zeros(np.shape(starts), dtype=bool)
+        run = np.searchsorted(self.unknown_ends, starts, side="right") #first run ending after the start
+        return (run < len(self.unknown_starts)) & (self.unknown_starts[np.minimum(run, len(self.unknown_starts) - 1)] < ends)
+
+    # Codes 0-3 of the nucleotides start:end of the file, UNKNOWN for unknown nucleotides and positions outside the file
+    def span(self, start, end):
+        codes = np.full(max(end - start, 0), UNKNOWN, dtype=np.uint8)
+        first, last = max(start, 0), min(end, 4 * len(self.data))
+        if first >= last:
+            return codes
+        codes[first - start:last - start] = unpack(self.data[first // 4:(last + 3) // 4])[first % 4:first % 4 + last - first]
+        # Runs of unknown nucleotides overlapping the range
+        runs = slice(np.searchsorted(self.unknown_ends, first, side="right"), np.searchsorted(self.unknown_starts, last, side="left"))
+        for run_start, run_end in zip(self.unknown_starts[runs].tolist(), self.unknown_ends[runs].tolist()):
+            codes[max(run_start, first) - start:min(run_end, last) - start] = UNKNOWN
+        return codes
+
+    # Codes 0-3 of the nucleotides start:end of a sequence, UNKNOWN for unknown nucleotides
+    def codes(self, number, start=0, end=None):
+        length = int(self.lengths[number])
+        end = length if end is None else min(end, length)
+        first = int(self.offsets[number]) * 4 #position of the first nucleotide in the file
+        return self.span(first + start, first + end)
+
+    # The 32 nucleotides from the start of the byte holding each position of the file, as 64-bit integers (2 bits per
+    # nucleotide, the first in the high bits), read from the word view. Bytes outside the file read as A.
+    def words(self, positions):
+        first = np.asarray(positions, dtype=np.int64) >> 2
+        words = np.zeros(len(first), dtype=np.uint64)
+        inner = (first >= 0) & (first < len(self.word_view))
+        words[inner] = self.word_view[first[inner]]
+        edge = np.flatnonzero(~inner)
+        if len(edge) and len(self.data):
+            offsets = first[edge, None] + np.arange(8)
+            data = np.where((offsets >= 0) & (offsets < len(self.data)), self.data[np.clip(offsets, 0, len(self.data) - 1)], 0)
+            words[edge] = (data.astype(np.uint64) << np.arange(56, -1, -8, dtype=np.uint64)).sum(axis=1, dtype=np.uint64)
+        return words
+
+    def sequence(self, number, start=0, end=None):
+        return BASES[self.codes(number, start, end)].tobytes().decode("ascii")
+
+    # (name, sequence) records, in the order of the fasta file
+    def records(self):
+        for number, name in enumerate(self.names):
+            yield name, self.sequence(number)
+
+
+# Whether a path names a store (its .pack data file) rather than a fasta file
+def is_store(path):
+    return str(path).endswith(".pack")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write the 2-bit packed, memory-mapped store of a fasta file.")
+    parser.add_argument("fasta_file", help="Fasta file, e.g. CDS_all.fa")
+    parser.add_argument("store_file", help="Packed data file, e.g. CDS_all.pack (the index is written next to it, CDS_all.pack.npz)")
+    parser.add_argument("--targets", action="store_true", help="Read the formatted headers of CDS_gene_targets.fa.")
+    args = parser.parse_args()
+    write_store(args.fasta_file, args.store_file, args.targets)
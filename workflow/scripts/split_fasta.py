@@ -0,0 +1,51 @@
+"""
+Snakemake pipeline.
+
+Scatter a fasta file into N balanced shards of consecutive records, e.g. to run BLAST on the probe sequences as parallel jobs.
+
+Command in Snakefile rule:
+$ python3 split_fasta.py probes_hybparts_snakemake.fasta blast_shards/query_0.fasta ... blast_shards/query_N.fasta
+
+The shards are balanced on file size. Concatenating the outputs of the shards in shard order keeps the record order of the input.
+
+"""
+
+import os
+import sys
+
+# Generator yielding the records of a fasta file as lists of lines, header included
+def iter_records(fasta_file):
+    record = []
+    with open(fasta_file, 'r') as file:
+        for line in file:
+            if line.startswith('>') and record:
+                yield record
+                record = []
+            record.append(line)
+    if record:
+        yield record
+
+def split(fasta_file, shard_files):
+    total_size = os.path.getsize(fasta_file)
+    n_shards = len(shard_files)
+    shard = 0
+    written = 0
+    out = open(shard_files[shard], 'w')
+    for record in iter_records(fasta_file):
+        out.writelines(record)
+        written += sum(len(line) for line in record)
+        # Move on to the next shard once this one holds its share of the input
+        if shard < n_shards - 1 and written >= total_size * (shard + 1) / n_shards:
+            out.close()
+            shard += 1
+            out = open(shard_files[shard], 'w')
+    out.close()
+    # Create the remaining shards, left empty when there are fewer records than shards
+    for shard_file in shard_files[shard + 1:]:
+        open(shard_file, 'w').close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        raise ValueError("Usage: python3 split_fasta.py input.fasta shard_0.fasta [shard_1.fasta ...]")
+    split(sys.argv[1], sys.argv[2:])
@@ -0,0 +1,63 @@
+"""
+Snakemake pipeline.
+
+Scatter the primer3 input file into N record-aligned shards, so primer3 can run as independent parallel jobs.
+
+Command in Snakefile rule:
+$ python3 split_primer3_input.py primer3_input_snakemake.txt primer3_shards/input_0.txt ... primer3_shards/input_N.txt
+
+The shards hold consecutive records and are balanced on file size, so concatenating the primer3 outputs in shard order 
+keeps the gene order of the input file. 
+primer3 global settings (PRIMER_* tags) persist from one record to the next within a primer3 run. The global tags of the 
+first record are therefore copied into the first record of every shard, unless that record sets them itself.
+
+"""
+
+import os
+import sys
+
+# Generator yielding the records of a primer3 Boulder-IO file as lists of lines, terminator included
+def iter_records(primer3_input_file):
+    record = []
+    with open(primer3_input_file, 'r') as file:
+        for line in file:
+            record.append(line)
+            if line.rstrip('\n') == "=":
+                yield record
+                record = []
+    if record:
+        yield record
+
+def split(primer3_input_file, shard_files):
+    total_size = os.path.getsize(primer3_input_file)
+    n_shards = len(shard_files)
+    global_tags = None
+    shard = 0
+    written = 0
+    out = open(shard_files[shard], 'w')
+    first_record = True
+    for record in iter_records(primer3_input_file):
+        written += sum(len(line) for line in record) #bytes of the input read so far, without the copied global tags
+        if global_tags is None:
+            global_tags = [line for line in record if line.startswith("PRIMER_")]
+        elif first_record:
+            own_tags = {line.split('=')[0] for line in record}
+            record = [line for line in global_tags if line.split('=')[0] not in own_tags] + record
+        out.writelines(record)
+        first_record = False
+        # Move on to the next shard once the shards hold their share of the input
+        if shard < n_shards - 1 and written >= total_size * (shard + 1) / n_shards:
+            out.close()
+            shard += 1
+            out = open(shard_files[shard], 'w')
+            first_record = True
+    out.close()
+    # Create the remaining shards, left empty when there are fewer records than shards
+    for shard_file in shard_files[shard + 1:]:
+        open(shard_file, 'w').close()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        raise ValueError("Usage: python3 split_primer3_input.py primer3_input_snakemake.txt shard_0.txt [shard_1.txt ...]")
+    split(sys.argv[1], sys.argv[2:])
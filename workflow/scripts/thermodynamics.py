@@ -0,0 +1,107 @@
+"""
+Snakemake pipeline.
+
+Thermodynamic screening of the probe pair candidates with the primer3 Python bindings (primer3-py), used by
+select_probe_pairs.py as a filter before the final selection when thermo_filter is enabled in config.yaml.
+
+For every candidate pair:
+    - melting temperature of the LHS and RHS hybridising parts
+    - hairpin dG of the full LHS and RHS probes (with handles)
+    - heterodimer dG between the full LHS and RHS probes
+
+Pairs are kept when both Tm are within [min_tm, max_tm], both hairpin dG are at least max_hairpin_dg and the heterodimer dG
+is at least max_dimer_dg (kcal/mol, more negative is more stable). The calculations use primer3's default salt and
+oligo concentrations, overridable with thermo_conditions in config.yaml. Each primer3 function gets the settings it accepts:
+the concentrations go to all of them, the Tm method settings to the Tm only and the alignment settings (temp_c, max_loop) to
+the hairpin and dimer calculations only. Unknown settings are rejected before any calculation.
+
+Identical sequences and pairs are evaluated once (the candidates of overlapping windows often share a side), and the
+unique sequences and pairs are evaluated in batches over one process pool.
+
+"""
+
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import primer3
+
+from probe_table import LHS_HANDLE, RHS_HANDLE
+
+BATCH_SIZE = 2048 #sequences evaluated per worker task
+# thermo_conditions settings accepted by primer3.calc_tm, and by primer3.calc_hairpin and calc_heterodimer
+CONCENTRATIONS = ["mv_conc", "dv_conc", "dntp_conc", "dna_conc"]
+TM_SETTINGS = CONCENTRATIONS + ["dmso_conc", "dmso_fact", "formamide_conc", "annealing_temp_c", "max_nn_length", "tm_method",
+                                "salt_corrections_method"]
+ALIGNMENT_SETTINGS = CONCENTRATIONS + ["temp_c", "max_loop"]
+
+
+# Tm of a hybridising part and hairpin dG (kcal/mol) of its full probe
+def sequence_thermo(hybridising, probe, conditions):
+    tm = primer3.calc_tm(hybridising, **settings(conditions, TM_SETTINGS))
+    return tm, primer3.calc_hairpin(probe, **settings(conditions, ALIGNMENT_SETTINGS)).dg / 1000.0
+
+# Heterodimer dG (kcal/mol) of two full probes
+def dimer_thermo(probe_a, probe_b, conditions):
+    return primer3.calc_heterodimer(probe_a, probe_b, **settings(conditions, ALIGNMENT_SETTINGS)).dg / 1000.0
+
+# Keyword arguments of a primer3 function: the conditions among the settings it accepts
+def settings(conditions, accepted):
+    return {key: value for key, value in conditions if key in accepted}
+
+def sequence_batch(batch, conditions):
+    return [sequence_thermo(hybridising, probe, conditions) for hybridising, probe in batch]
+
+def dimer_batch(batch, conditions):
+    return [dimer_thermo(probe_a, probe_b, conditions) for probe_a, probe_b in batch]
+
+# Apply a batch function to all items, in the given process pool, or in a new one when processes > 1
+def run_batches(function, items, conditions, processes=1, executor=None):
+    batches = [items[i:i + BATCH_SIZE] for i in range(0, len(items), BATCH_SIZE)]
+    if executor is None and processes > 1 and len(batches) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            return run_batches(function, items, conditions, executor=executor)
+    if executor is not None and len(batches) > 1:
+        results = executor.map(function, batches, [conditions] * len(batches))
+        return [value for batch in results for value in batch]
+    return [value for batch in batches for value in function(batch, conditions)]
+
+# Salt and oligo concentrations and other settings passed to primer3, as a hashable tuple
+def thermo_conditions(config):
+    conditions = config.get("thermo_conditions") or {}
+    unknown = sorted(set(conditions) - set(TM_SETTINGS) - set(ALIGNMENT_SETTINGS))
+    if unknown:
+        raise ValueError(f"thermo_conditions in config.yaml: unknown primer3 settings {', '.join(unknown)} "
+                         f"(accepted: {', '.join(TM_SETTINGS + ALIGNMENT_SETTINGS[len(CONCENTRATIONS):])})")
+    return tuple(sorted(conditions.items()))
+
+# Tm, hairpin dG and heterodimer dG of every candidate pair of the table, as a dict of float arrays
+def evaluate(table, config, processes=1):
+    conditions = thermo_conditions(config)
+    with ProcessPoolExecutor(max_workers=processes) if processes > 1 else nullcontext() as executor:
+        values = {}
+        for side, column in (("lhs", "lhs"), ("rhs", "rhs")):
+            unique, inverse = np.unique(table.probes[column], return_inverse=True)
+            hybridising = np.char.decode(unique, "ascii").tolist()
+            probes = [LHS_HANDLE + sequence for sequence in hybridising] if side == "lhs" else [sequence + RHS_HANDLE for sequence in hybridising]
+            results = np.array(run_batches(sequence_batch, list(zip(hybridising, probes)), conditions, executor=executor), dtype=np.float64).reshape(-1, 2)
+            values[f"{side}_tm"] = results[inverse.ravel(), 0]
+            values[f"{side}_hairpin_dg"] = results[inverse.ravel(), 1]
+
+        pairs = np.char.add(table.probes["lhs"], table.probes["rhs"])
+        unique, inverse = np.unique(pairs, return_inverse=True)
+        hyb_size = table.probes.dtype["lhs"].itemsize
+        items = [(LHS_HANDLE + pair[:hyb_size], pair[hyb_size:] + RHS_HANDLE) for pair in np.char.decode(unique, "ascii").tolist()]
+        values["dimer_dg"] = np.array(run_batches(dimer_batch, items, conditions, executor=executor), dtype=np.float64)[inverse.ravel()]
+        return values
+
+# Boolean mask of the candidate pairs passing the thermodynamic thresholds
+def thermo_mask(table, config, processes=1):
+    if len(table) == 0:
+        return np.zeros(0, dtype=bool)
+    values = evaluate(table, config, processes)
+    return (
+        (values["lhs_tm"] >= config["min_tm"]) & (values["lhs_tm"] <= config["max_tm"])
+        & (values["rhs_tm"] >= config["min_tm"]) & (values["rhs_tm"] <= config["max_tm"])
+        & (values["lhs_hairpin_dg"] >= config["max_hairpin_dg"]) & (values["rhs_hairpin_dg"] >= config["max_hairpin_dg"])
+        & (values["dimer_dg"] >= config["max_dimer_dg"])
+    )